@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# PeerDrive
+# Copyright (C) 2012  Jan Klötzke <jan DOT kloetzke AT freenet DOT de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Measures the three-way text merge of views/diff3.py on a corpus made of
+# the Python sources of the client, repeated until it has the requested
+# number of lines. Both versions get the same number of random edits
+# (replaced, deleted and inserted blocks of lines) and a few of them hit
+# the same place to provoke conflicts. Additionally one version deletes and
+# the other one inserts a large block of lines, which is where the old
+# forward scanning merge goes quadratic. It is only run if its source is
+# given and only up to --old-max lines. Runs without a server.
+
+import sys, os, os.path, time, random, optparse, glob, imp
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+from views import diff3
+
+def corpus(lines):
+	source = []
+	for name in sorted(glob.glob(os.path.join(root, '*.py')) +
+			glob.glob(os.path.join(root, 'peerdrive', '*.py')) +
+			glob.glob(os.path.join(root, 'views', '*.py'))):
+		with open(name) as f:
+			source.extend(f.readlines())
+	result = []
+	while len(result) < lines:
+		result.extend(source)
+	return result[:lines]
+
+def edit(rnd, lines, positions):
+	result = lines[:]
+	for pos in sorted(positions, reverse=True):
+		kind = rnd.randrange(3)
+		if kind == 0:
+			result[pos:pos+rnd.randint(1, 5)] = [ "changed %d\n" % rnd.getrandbits(32)
+				for i in xrange(rnd.randint(1, 5)) ]
+		elif kind == 1:
+			del result[pos:pos+rnd.randint(1, 10)]
+		else:
+			result[pos:pos] = [ "inserted %d\n" % rnd.getrandbits(32)
+				for i in xrange(rnd.randint(1, 10)) ]
+	return result
+
+def makeVersions(lines, edits, seed):
+	rnd = random.Random(seed)
+	old = corpus(lines)
+	positions = rnd.sample(xrange(0, lines, 20), 2 * edits)
+	shared = positions[:edits/10]
+	other = edit(rnd, old, positions[:edits])
+	new = edit(rnd, old, shared + positions[edits:2*edits-len(shared)])
+	block = lines / 50
+	del other[lines/10:lines/10+block]
+	new[lines/2:lines/2] = [ "block %d\n" % i for i in xrange(block) ]
+	return (''.join(old), ''.join(other), ''.join(new))
+
+def measure(module, versions):
+	start = time.time()
+	result = module.text_merge(*versions)
+	return (time.time() - start, result.count('<<<<<<<<<<<<<<<<<<<<<<<<<\n'),
+		result.count('\n'))
+
+
+parser = optparse.OptionParser(usage="usage: %prog [options]")
+parser.add_option("-s", "--sizes", default="1000,10000,100000",
+	help="comma separated list of line counts [default: %default]")
+parser.add_option("-e", "--edits", type="int", default=0,
+	help="edits per version [default: one per 500 lines]")
+parser.add_option("--old-max", type="int", default=10000,
+	help="largest size for the old algorithm [default: %default]")
+parser.add_option("--old", metavar="PATH",
+	help="diff3.py of the old algorithm, e.g. from 'git show'")
+(options, args) = parser.parse_args()
+if len(args) != 0:
+	parser.error("incorrect number of arguments")
+
+old = imp.load_source('olddiff3', options.old) if options.old else None
+print "%8s %6s %10s %10s %10s %10s" % ("lines", "edits", "new", "old",
+	"conflicts", "result")
+for size in [ int(s) for s in options.sizes.split(',') ]:
+	edits = options.edits or max(size / 500, 2)
+	versions = makeVersions(size, edits, size)
+	(newTime, conflicts, lines) = measure(diff3, versions)
+	result = "%d" % lines
+	if old and size <= options.old_max:
+		(oldTime, oldConflicts, oldLines) = measure(old, versions)
+		oldTime = "%9.3fs" % oldTime
+		result += "/%d" % oldLines
+	else:
+		oldTime = "-"
+	print "%8d %6d %9.3fs %10s %10d %10s" % (size, edits, newTime, oldTime,
+		conflicts, result)
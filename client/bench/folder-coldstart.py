@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# PeerDrive
+# Copyright (C) 2011  Jan Klötzke <jan DOT kloetzke AT freenet DOT de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+
+# Measures the time a freshly started client needs to fetch everything the
+# folder view displays: the folder itself, the lookups of all entries, their
+# stats and annotations. Every round uses a new connection so that the
+# in-memory caches start empty. With the persistent cache the first round
+# fills a temporary cache database which is then used by all other rounds.
+# Needs a running server.
+
+import sys, os, os.path, time, optparse, tempfile, shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from peerdrive import connector
+from peerdrive.connector import Link
+
+ANNOTATION = "/org.peerdrive.annotation"
+
+def openFolder(c, store, doc):
+	rev = c.lookupDoc(doc, [store]).rev(store)
+	with c.peek(store, rev) as r:
+		items = r.getData('/org.peerdrive.folder')
+	links = [ item[''] for item in items ]
+	lookups = c.lookupDocMany([ link.doc() for link in links if link.doc() ])
+	revs = set([ link.rev() for link in links if not link.doc() ])
+	for l in lookups.values():
+		if not isinstance(l, IOError) and (store in l.stores()):
+			revs.add(l.rev(store))
+	c.statMany(revs)
+	c.getDataMany([ (store, x, ANNOTATION) for x in revs ], raw=True)
+	return len(links)
+
+def measure(store, doc, rounds, cachePath=None):
+	times = []
+	for i in xrange(rounds):
+		start = time.time()
+		c = connector._Connector()
+		if cachePath:
+			c.enableDiskCache(cachePath)
+		entries = openFolder(c, store, doc)
+		c.disableDiskCache()
+		times.append(time.time() - start)
+		c.close()
+	return (entries, times)
+
+
+parser = optparse.OptionParser(usage="usage: %prog [options] <folder>")
+parser.add_option("-r", "--rounds", type="int", default=5,
+	help="number of client starts per mode [default: %default]")
+(options, args) = parser.parse_args()
+if len(args) != 1:
+	parser.error("incorrect number of arguments")
+link = Link(args[0])
+link.update()
+
+tmp = tempfile.mkdtemp()
+try:
+	for (name, cachePath) in [("cold", None),
+			("disk", os.path.join(tmp, 'revcache.db'))]:
+		(entries, times) = measure(link.store(), link.doc(), options.rounds,
+			cachePath)
+		# the first round of the persistent cache fills the database
+		warm = times[1:] if cachePath else times
+		print "%-5s %6d entries  first %7.3fs  best %7.3fs  avg %7.3fs" % (name,
+			entries, times[0], min(warm), sum(warm) / len(warm))
+finally:
+	shutil.rmtree(tmp)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# PeerDrive
+# Copyright (C) 2011  Jan Klötzke <jan DOT kloetzke AT freenet DOT de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Imports a large file into the system store of the running server and
+# reports the throughput and the peak RSS of the client process. The
+# imported document is not linked anywhere and will be garbage collected by
+# the server.
+
+import sys, os, os.path, time, tempfile, resource, optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from peerdrive import Connector, importer
+
+
+def makeFile(size):
+	(fd, path) = tempfile.mkstemp(prefix='peerdrive-bench-')
+	block = os.urandom(1 << 20)
+	with os.fdopen(fd, 'wb') as f:
+		for i in xrange(size):
+			f.write(block)
+	return path
+
+
+def progress(path, done=None, total=None):
+	if done is not None:
+		sys.stdout.write("\r%d / %d MiB" % (done >> 20, total >> 20))
+		sys.stdout.flush()
+
+
+parser = optparse.OptionParser()
+parser.add_option("-s", "--size", type="int", default=2048,
+	help="size of the imported file in MiB [default: %default]")
+(options, args) = parser.parse_args()
+
+path = makeFile(options.size)
+try:
+	store = Connector().enum().sysStore().sid
+	start = time.time()
+	handle = importer.importFile(store, path, progress=progress)
+	duration = time.time() - start
+	handle.close()
+finally:
+	os.remove(path)
+
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform == 'darwin':
+	rss = rss >> 10
+print
+print "imported %d MiB in %.1fs (%.1f MiB/s), peak RSS %d MiB" % (options.size,
+	duration, options.size / duration, rss >> 10)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# PeerDrive
+# Copyright (C) 2012  Jan Klötzke <jan DOT kloetzke AT freenet DOT de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compares the merge base computation of RevGraph with the old per-revision
+# walk of DocumentView. The history is synthetic: a number of branches that
+# are merged into each other at random, including criss-cross merges. The
+# server is simulated in-process and every round trip costs the given
+# latency. The persistent history index is measured twice: the first run
+# indexes the complete history of both revisions in a temporary index, the
+# second one is served by it. Runs without a server.
+
+import sys, os, os.path, time, random, optparse, tempfile, shutil
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from peerdrive import dag
+
+class FakeStat(object):
+	def __init__(self, parents, mtime):
+		self.__parents = parents
+		self.__mtime = datetime.fromtimestamp(mtime)
+
+	def parents(self):
+		return self.__parents
+
+	def mtime(self):
+		return self.__mtime
+
+class FakeConnector(object):
+	def __init__(self, graph, latency):
+		self.graph = graph
+		self.latency = latency
+		self.roundTrips = 0
+
+	def __roundTrip(self):
+		self.roundTrips += 1
+		if self.latency:
+			time.sleep(self.latency)
+
+	def stat(self, rev, stores=[]):
+		self.__roundTrip()
+		return FakeStat(*self.graph[rev])
+
+	def statMany(self, revs, stores=[]):
+		self.__roundTrip()
+		return dict((rev, FakeStat(*self.graph[rev])) for rev in revs)
+
+# Returns a dict rev -> (parents, mtime) and the heads of all branches
+def makeHistory(revisions, branches, mergeRatio, seed):
+	rnd = random.Random(seed)
+	graph = { 'r0' : ([], 0) }
+	heads = ['r0'] * branches
+	for i in xrange(1, revisions):
+		rev = 'r%d' % i
+		b = rnd.randrange(branches)
+		parents = [heads[b]]
+		if rnd.random() < mergeRatio:
+			other = heads[rnd.randrange(branches)]
+			if other != heads[b]:
+				parents.append(other)
+		graph[rev] = (parents, i)
+		heads[b] = rev
+	return (graph, heads)
+
+# the algorithm that DocumentView.__calculateMergeBase used to have
+def oldMergeBase(c, baseVersions):
+	heads = [[rev] for rev in baseVersions]
+	paths = [set([rev]) for rev in baseVersions]
+	times = { }
+	addedSth = True
+	while addedSth:
+		addedSth = False
+		for i in xrange(len(heads)):
+			newHeads = []
+			for head in heads[i]:
+				stat = c.stat(head)
+				times[head] = stat.mtime()
+				for parent in stat.parents():
+					newHeads.append(parent)
+					paths[i].add(parent)
+					addedSth = True
+			heads[i] = newHeads
+	commonBase = reduce(lambda x, y: x&y, paths)
+	return max(commonBase, key=lambda x: times[x])
+
+def newMergeBase(c, baseVersions, index=None):
+	return dag.RevGraph(connector=c, index=index).mergeBase(*baseVersions)
+
+def indexMergeBase(c, baseVersions, index):
+	graph = dag.RevGraph(connector=c, index=index)
+	for rev in baseVersions:
+		graph.history(rev)
+	return graph.mergeBase(*baseVersions)
+
+
+parser = optparse.OptionParser(usage="usage: %prog [options]")
+parser.add_option("-n", "--revisions", type="int", default=400,
+	help="size of the history [default: %default]")
+parser.add_option("-b", "--branches", type="int", default=4,
+	help="number of concurrent branches [default: %default]")
+parser.add_option("-m", "--merges", type="float", default=0.1,
+	help="ratio of merge revisions [default: %default]")
+parser.add_option("-l", "--latency", type="float", default=0.0002,
+	help="simulated round trip time in seconds [default: %default]")
+parser.add_option("-s", "--seed", type="int", default=42)
+parser.add_option("--skip-old", action="store_true",
+	help="do not run the old algorithm (which can take very long)")
+(options, args) = parser.parse_args()
+if len(args) != 0:
+	parser.error("incorrect number of arguments")
+
+(graph, heads) = makeHistory(options.revisions, options.branches,
+	options.merges, options.seed)
+revs = (heads[0], heads[-1])
+print "history: %d revisions, heads %s and %s" % (len(graph), revs[0], revs[1])
+
+tmp = tempfile.mkdtemp()
+try:
+	index = dag.HistoryIndex(os.path.join(tmp, 'history.db'))
+	algorithms = [
+		("new", newMergeBase),
+		("cold", lambda c, revs: indexMergeBase(c, revs, index)),
+		("warm", lambda c, revs: newMergeBase(c, revs, index))
+	]
+	if not options.skip_old:
+		algorithms.insert(0, ("old", oldMergeBase))
+	for (name, fun) in algorithms:
+		c = FakeConnector(graph, options.latency)
+		start = time.time()
+		base = fun(c, revs)
+		index.flush()
+		print "%-4s base %-8s %7d round trips %8.3fs" % (name, base,
+			c.roundTrips, time.time() - start)
+	index.close()
+finally:
+	shutil.rmtree(tmp)
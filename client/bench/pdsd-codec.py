@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# PeerDrive
+# Copyright (C) 2011  Jan Klötzke <jan DOT kloetzke AT freenet DOT de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Encodes and decodes a large folder document with the PDSD codec and reports
+# the throughput of the former codec compared to the current pure Python one
+# and, if built, the accelerated one. All must produce the same bytes.
+
+import sys, os, os.path, struct, time, optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from peerdrive import connector
+from peerdrive.connector import DocLink, RevLink
+
+
+class OldDecoder(object):
+	# the decoder as it was before: if/elif chain and calcsize per scalar
+	def __init__(self, store):
+		self.__store = store
+
+	def decode(self, s):
+		self._s = s
+		self._i = 0
+		return self._decodeDoc()
+
+	def _getStore(self):
+		return self.__store
+
+	def _getInt(self, code):
+		length = struct.calcsize('<'+code)
+		value = struct.unpack_from('<'+code, self._s, self._i)[0]
+		self._i += length
+		return value
+
+	def _getStr(self, length):
+		res = self._s[self._i:self._i+length]
+		self._i += length
+		return res
+
+	def _decodeDoc(self):
+		tag = self._getInt('B')
+		if tag == 0x00:
+			res = self._decodeDict()
+		elif tag == 0x10:
+			res = self._decodeList()
+		elif tag == 0x20:
+			res = self._decodeString()
+		elif tag == 0x30:
+			res = (self._getInt('B') != 0)
+		elif tag == 0x40:
+			res = RevLink()
+			res._fromStruct(self)
+		elif tag == 0x41:
+			res = DocLink()
+			res._fromStruct(self)
+		else:
+			res = self._getInt({ 0x50 : 'f', 0x51 : 'd', 0x60 : 'B', 0x61 : 'b',
+				0x62 : 'H', 0x63 : 'h', 0x64 : 'L', 0x65 : 'l', 0x66 : 'Q',
+				0x67 : 'q' }[tag])
+		return res
+
+	def _decodeDict(self):
+		elements = self._getInt('L')
+		d = { }
+		for i in range(elements):
+			key = self._decodeString()
+			value = self._decodeDoc()
+			d[key] = value
+		return d
+
+	def _decodeList(self):
+		elements = self._getInt('L')
+		l = []
+		for i in range(elements):
+			l.append(self._decodeDoc())
+		return l
+
+	def _decodeString(self):
+		length = self._getInt('L')
+		return self._getStr(length).decode('utf-8')
+
+
+class OldEncoder(object):
+	# the encoder as it was before: string concatenation
+	def encode(self, o):
+		if isinstance(o, dict):
+			data = struct.pack('<BL', 0x00, len(o))
+			for key, value in o.iteritems():
+				if isinstance(key, unicode):
+					key = key.encode('utf-8')
+				data += struct.pack('<L', len(key)) + key + self.encode(value)
+			return data
+		elif isinstance(o, (list, tuple)):
+			data = struct.pack('<BL', 0x10, len(o))
+			for i in o:
+				data += self.encode(i)
+			return data
+		elif isinstance(o, basestring):
+			if isinstance(o, unicode):
+				o = o.encode('utf-8')
+			return struct.pack('<BL', 0x20, len(o)) + o
+		elif o is True:
+			return struct.pack('BB', 0x30, 1)
+		elif o is False:
+			return struct.pack('BB', 0x30, 0)
+		elif isinstance(o, (RevLink, DocLink)):
+			return o._toStruct()
+		elif isinstance(o, float):
+			return struct.pack('<Bd', 0x51, o)
+		elif o < 0:
+			for (limit, code, tag) in [(-128, 'b', 0x61), (-32768, 'h', 0x63),
+					(-2147483648, 'l', 0x65)]:
+				if o >= limit:
+					return struct.pack('<B'+code, tag, o)
+			return struct.pack('<Bq', 0x67, o)
+		else:
+			for (limit, code, tag) in [(0xff, 'B', 0x60), (0xffff, 'H', 0x62),
+					(0xffffffff, 'L', 0x64)]:
+				if o <= limit:
+					return struct.pack('<B'+code, tag, o)
+			return struct.pack('<BQ', 0x66, o)
+
+
+def makeFolder(entries):
+	store = 's' * 16
+	content = []
+	for i in xrange(entries):
+		content.append({
+			'' : DocLink(store, struct.pack('>Q', i) * 2, False),
+			'rev' : RevLink(store, struct.pack('>Q', i) * 2),
+			'name' : u"Entry %d ä" % i,
+			'size' : i * 1000,
+			'offset' : -i,
+			'ratio' : i / 3.0,
+			'hidden' : bool(i & 1),
+		})
+	return (store, {
+		"org.peerdrive.folder" : content,
+		"org.peerdrive.annotation" : { "title" : "Big folder" }
+	})
+
+
+def measure(fun, *args):
+	start = time.time()
+	res = fun(*args)
+	return (time.time() - start, res)
+
+
+parser = optparse.OptionParser()
+parser.add_option("-n", "--entries", type="int", default=100000,
+	help="number of folder entries [default: %default]")
+(options, args) = parser.parse_args()
+
+(store, folder) = makeFolder(options.entries)
+
+codecs = [
+	("old", OldEncoder().encode, lambda s: OldDecoder(store).decode(s)),
+	("python", connector.Encoder().encode, lambda s: connector.Decoder(store).decode(s)),
+]
+if connector._pdsd:
+	codecs.append(("native", connector._pdsd.encode,
+		lambda s: connector._pdsd.decode(store, s)))
+
+results = []
+reference = None
+for (name, encode, decode) in codecs:
+	(encTime, data) = measure(encode, folder)
+	if reference is None:
+		reference = data
+	elif data != reference:
+		sys.exit("Encoder '%s' differs!" % name)
+	(decTime, obj) = measure(decode, reference)
+	if obj != folder:
+		sys.exit("Decoder '%s' differs!" % name)
+	results.append((name, encTime, decTime))
+
+size = len(reference) / float(1 << 20)
+print "%d entries, %.1f MiB encoded" % (options.entries, size)
+for (name, encTime, decTime) in results:
+	print "%-8s encode %6.2fs %8.1f MiB/s   decode %6.2fs %8.1f MiB/s" % (name,
+		encTime, size / encTime, decTime, size / decTime)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# PeerDrive
+# Copyright (C) 2011  Jan Klötzke <jan DOT kloetzke AT freenet DOT de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Feeds framed READ_MSG confirmations through the receive buffer of the
+# connector and reports the throughput of the old string based framing
+# compared to the current _PacketBuffer.
+
+import sys, os, os.path, struct, time, optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from peerdrive.connector import _PacketBuffer
+
+
+class StringBuffer(object):
+	# the framing as it was done before: concatenate and slice off
+	def __init__(self):
+		self.buf = ''
+
+	def feed(self, data):
+		self.buf = self.buf + data
+
+	def pop(self):
+		if len(self.buf) > 2:
+			expect = struct.unpack_from('>H', self.buf, 0)[0] + 2
+			if expect <= len(self.buf):
+				packet = self.buf[2:expect]
+				self.buf = self.buf[expect:]
+				(ref, msg) = struct.unpack_from('>LH', packet, 0)
+				return (ref, msg, packet[6:])
+		return None
+
+
+def makeStream(packetSize, total):
+	payload = 'x' * packetSize
+	packets = []
+	for ref in xrange(64):
+		packet = struct.pack('>LH', ref, (0x000b << 4) | 1) + payload
+		packets.append(struct.pack('>H', len(packet)) + packet)
+	chunk = ''.join(packets)
+	return (chunk, (total + len(chunk) - 1) // len(chunk))
+
+
+def run(bufClass, chunk, repeat, readSize):
+	buf = bufClass()
+	stream = chunk * (readSize // len(chunk) + 2)
+	received = 0
+	count = 0
+	start = time.time()
+	pos = 0
+	total = len(chunk) * repeat
+	while received < total:
+		# emulate socket.readAll() returning 'readSize' bytes at once
+		data = stream[pos:pos+readSize]
+		pos = (pos + readSize) % len(chunk)
+		if received + len(data) > total:
+			data = data[:total-received]
+		received += len(data)
+		buf.feed(data)
+		while True:
+			packet = buf.pop()
+			if packet is None:
+				break
+			count += 1
+	return (time.time() - start, count)
+
+
+parser = optparse.OptionParser()
+parser.add_option("-s", "--size", type="int", default=100,
+	help="total amount of data in MiB [default: %default]")
+parser.add_option("-p", "--packet", type="int", default=4096,
+	help="payload size of each packet [default: %default]")
+parser.add_option("-r", "--read", type="int", default=1024,
+	help="bytes per simulated socket read in KiB [default: %default]")
+(options, args) = parser.parse_args()
+
+(chunk, repeat) = makeStream(options.packet, options.size << 20)
+for (name, cls) in [("old (str)", StringBuffer), ("new (bytearray)", _PacketBuffer)]:
+	(duration, count) = run(cls, chunk, repeat, options.read << 10)
+	size = len(chunk) * repeat
+	print "%-16s %8d packets %8.2fs %8.1f MiB/s" % (name, count, duration,
+		size / duration / (1 << 20))
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# PeerDrive
+# Copyright (C) 2011  Jan Klötzke <jan DOT kloetzke AT freenet DOT de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Classifies a number of generated file names through the registry and
+# reports the throughput of the former linear scans compared to the
+# precomputed indexes of _Registry. The registry is read from the server
+# sources, no running server is needed.
+
+import sys, os, os.path, json, random, time, optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from peerdrive.registry import _Registry
+
+
+class OfflineRegistry(_Registry):
+	def __init__(self, registry):
+		self._buildIndexes(registry)
+
+
+# the lookups as they were done before
+def linearUtiFromExtension(registry, ext, default = "public.data"):
+	for (uti, spec) in registry.items():
+		if "extensions" in spec:
+			if ext in spec["extensions"]:
+				return uti
+	return default
+
+def linearConformes(registry, uti, superClass):
+	if uti == superClass:
+		return True
+	result = False
+	item = registry.get(uti, {})
+	for i in item.get("conforming", []):
+		result = result or linearConformes(registry, i, superClass)
+	return result
+
+def linearSearch(registry, uti, key):
+	if uti not in registry:
+		return None
+	item = registry[uti]
+	if key in item:
+		return item[key]
+	for i in item.get("conforming", []):
+		data = linearSearch(registry, i, key)
+		if not (data is None):
+			return data
+	return None
+
+
+def classify(names, utiFromExtension, conformes, search):
+	start = time.time()
+	for name in names:
+		uti = utiFromExtension(os.path.splitext(name)[1].lower())
+		conformes(uti, "public.content")
+		search(uti, "icon")
+	return time.time() - start
+
+
+parser = optparse.OptionParser()
+parser.add_option("-n", "--names", type="int", default=100000,
+	help="number of file names to classify [default: %default]")
+parser.add_option("-r", "--registry", metavar="FILE",
+	default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..',
+		'server', 'apps', 'peerdrive', 'priv', 'registry.json'),
+	help="registry definition [default: %default]")
+(options, args) = parser.parse_args()
+
+with open(options.registry) as f:
+	registry = json.load(f)
+extensions = [ ext for spec in registry.values() for ext in spec.get("extensions", []) ]
+extensions.extend([".unknown", ""])
+random.seed(0)
+names = [ "file%d%s" % (i, random.choice(extensions)) for i in xrange(options.names) ]
+
+reg = OfflineRegistry(registry)
+for (name, args) in [
+		("linear", (lambda e: linearUtiFromExtension(registry, e),
+		            lambda u, s: linearConformes(registry, u, s),
+		            lambda u, k: linearSearch(registry, u, k))),
+		("indexed", (reg.getUtiFromExtension, reg.conformes, reg.search)) ]:
+	duration = classify(names, *args)
+	print "%-8s %8d names %8.2fs %10.0f names/s" % (name, len(names), duration,
+		len(names) / duration)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# PeerDrive
+# Copyright (C) 2011  Jan Klötzke <jan DOT kloetzke AT freenet DOT de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Measures how long the command line tools need to start. Every entry point
+# is run with '--help' in a fresh interpreter which covers the import cost
+# only. The first RPC (connect and enum()) is measured separately, once with
+# the plain socket transport and once with PyQt4 already loaded as it is the
+# case in the GUI applications. The RPC rows need a running server.
+
+import sys, os, os.path, time, optparse, subprocess
+
+CLIENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+ENTRY_POINTS = [
+	'mount.py',
+	'umount.py',
+	'import-file.py',
+	'import-object.py',
+	'public.data.py',
+	'revcache.py',
+]
+
+FIRST_RPC = "import peerdrive; peerdrive.Connector().enum()"
+FIRST_RPC_QT = "import PyQt4.QtCore; " + FIRST_RPC
+
+def run(args):
+	with open(os.devnull, 'w') as null:
+		start = time.time()
+		subprocess.call([sys.executable] + args, cwd=CLIENT, stdout=null,
+			stderr=null)
+		return time.time() - start
+
+def best(args, rounds):
+	return min(run(args) for i in xrange(rounds))
+
+parser = optparse.OptionParser(usage="usage: %prog [options]")
+parser.add_option("-r", "--rounds", dest="rounds", type="int", default=5,
+	help="Number of runs per entry point, the best is reported [default: %default]")
+parser.add_option("-n", "--no-rpc", dest="rpc", action="store_false",
+	default=True, help="Do not measure the first RPC (no server needed)")
+(options, args) = parser.parse_args()
+
+print "%-18s %7.1fms" % ("Baseline:", best(['-c', 'pass'], options.rounds) * 1000)
+print "%-18s %7.1fms" % ("Import:", best(['-c', 'import peerdrive'], options.rounds) * 1000)
+for script in ENTRY_POINTS:
+	t = best([script, '--help'], options.rounds)
+	print "%-18s %7.1fms" % (script + ':', t * 1000)
+if options.rpc:
+	print "%-18s %7.1fms" % ("First RPC:", best(['-c', FIRST_RPC], options.rounds) * 1000)
+	print "%-18s %7.1fms" % ("First RPC (Qt):", best(['-c', FIRST_RPC_QT], options.rounds) * 1000)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# PeerDrive
+# Copyright (C) 2012  Jan Klötzke <jan DOT kloetzke AT freenet DOT de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Measures struct.merge() on folder like lists of growing size. Every entry
+# is a dict with a DocLink and some meta data, like in a PDSD folder. Two
+# versions diverge from the base: each one removes and adds 5% of the
+# entries. The old quadratic list merge is only run up to --old-max entries.
+# Runs without a server.
+
+import sys, os, os.path, time, random, optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from peerdrive import struct, connector
+
+STORE = 's' * 16
+
+def entry(rnd):
+	doc = "%016x" % rnd.getrandbits(64)
+	return { '' : connector.DocLink(STORE, doc, False), 'size' : rnd.randrange(1 << 20) }
+
+def makeVersions(size, seed):
+	rnd = random.Random(seed)
+	base = [ entry(rnd) for i in xrange(size) ]
+	versions = []
+	for i in xrange(2):
+		ver = base[:]
+		rnd.shuffle(ver)
+		ver = ver[size/20:] + [ entry(rnd) for j in xrange(size/20) ]
+		versions.append(ver)
+	return (base, versions)
+
+def measure(fun, base, versions):
+	start = time.time()
+	(result, conflict) = fun(base, versions)
+	return (time.time() - start, len(result))
+
+
+parser = optparse.OptionParser(usage="usage: %prog [options]")
+parser.add_option("-s", "--sizes", default="1000,10000,100000,1000000",
+	help="comma separated list of entry counts [default: %default]")
+parser.add_option("--old-max", type="int", default=5000,
+	help="largest size for the old algorithm [default: %default]")
+(options, args) = parser.parse_args()
+if len(args) != 0:
+	parser.error("incorrect number of arguments")
+
+old = getattr(struct, '__mergeListSlow')
+print "%9s %10s %10s %9s" % ("entries", "new", "old", "result")
+for size in [ int(s) for s in options.sizes.split(',') ]:
+	(base, versions) = makeVersions(size, size)
+	(newTime, length) = measure(struct.merge, base, versions)
+	if size <= options.old_max:
+		(oldTime, oldLength) = measure(old, base, versions)
+		assert oldLength == length
+		oldTime = "%9.3fs" % oldTime
+	else:
+		oldTime = "-"
+	print "%9d %9.3fs %10s %9d" % (size, newTime, oldTime, length)
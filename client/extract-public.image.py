@@ -17,21 +17,22 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import sys, json
+import sys
 from PyQt4 import QtGui
+from peerdrive.extractor import main
 
 # create a QApplication; QImage needs it
 app = QtGui.QApplication(sys.argv)
 
-image = QtGui.QImage()
-image.load(sys.argv[1].decode('utf8'))
+def extract(path):
+	image = QtGui.QImage()
+	image.load(path.decode('utf8'))
 
-data = {
-	"public.image" : {
-		"width"  : image.width(),
-		"height" : image.height()
+	return {
+		"public.image" : {
+			"width"  : image.width(),
+			"height" : image.height()
+		}
 	}
-}
-
-print json.dumps(data)
 
+main(extract)
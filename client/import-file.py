@@ -17,34 +17,49 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import sys, os
+import optparse, time
 
 from peerdrive.importer import importFileByPath
 
 
-def usage():
-	print """Usage: hp-import-file.py <hp-path-spec> file [file...]
-"""
-	sys.exit(1)
-
-
 def progress(fileName, newName):
 	print "Import '%s'..." % fileName
 
 def error(fileName, newName):
 	print "  FAILED!"
 
+stats = { 'files' : 0, 'size' : 0 }
+
+def done(fileName, size):
+	stats['files'] += 1
+	stats['size'] += size
+
 # === main
 
-if len(sys.argv) < 3:
-	usage()
+parser = optparse.OptionParser(usage="usage: %prog [options] <hp-path-spec> file [file...]")
+parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1, metavar="N",
+	help="Number of worker threads for importing directories [default: %default]")
+parser.add_option("-s", "--stats", action="store_true", dest="stats",
+	help="Print import throughput when done")
+(options, args) = parser.parse_args()
+if len(args) < 2:
+	parser.error("incorrect number of arguments")
+if options.jobs < 1:
+	parser.error("invalid number of jobs")
 
-# parse command line
-importPath = sys.argv[1]
+importPath = args[0]
+start = time.time()
 
 # let's do it
-if len(sys.argv) > 3:
-	importFileByPath(importPath, sys.argv[2:], progress=progress, error=error)
+if len(args) > 2:
+	importFileByPath(importPath, args[1:], progress=progress, error=error,
+		jobs=options.jobs, done=done)
 else:
-	importFileByPath(importPath, sys.argv[2])
+	importFileByPath(importPath, args[1], jobs=options.jobs, done=done)
 
+if options.stats:
+	elapsed = max(time.time() - start, 1e-6)
+	files = stats['files']
+	size = stats['size']
+	print "Imported %d files (%.1f MB) in %.2fs: %.1f files/s, %.2f MB/s" % (
+		files, size / 1e6, elapsed, files / elapsed, size / 1e6 / elapsed)
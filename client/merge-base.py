@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# PeerDrive
+# Copyright (C) 2012  Jan Klötzke <jan DOT kloetzke AT freenet DOT de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys, optparse
+from peerdrive import connector, dag
+
+parser = optparse.OptionParser(usage="usage: %prog [options] <link> <link>",
+	description="Find the best common ancestor(s) of two revisions. Links "
+		"may be given as 'rev:<store>:<rev>', 'doc:<store>:<doc>' or as path.")
+parser.add_option("-a", "--all", action="store_true",
+	help="Print all best common ancestors instead of only the newest one")
+parser.add_option("--is-ancestor", action="store_true",
+	help="Exit with 0 if the first revision is an ancestor of the second one, 1 otherwise")
+parser.add_option("--no-index", action="store_true",
+	help="Do not use the persistent history index")
+
+(options, args) = parser.parse_args()
+if len(args) != 2:
+	parser.error("incorrect number of arguments")
+
+try:
+	links = [ connector.Link(arg) for arg in args ]
+	revs = [ link.rev() for link in links ]
+	if None in revs:
+		print >>sys.stderr, "Document '%s' not found" % args[revs.index(None)]
+		sys.exit(2)
+	index = None if options.no_index else dag.historyIndex()
+	graph = dag.RevGraph(set(link.store() for link in links), index=index)
+	if options.is_ancestor:
+		sys.exit(0 if graph.isAncestor(revs[0], revs[1]) else 1)
+	bases = graph.mergeBases(revs[0], revs[1])
+except IOError as error:
+	print >>sys.stderr, "Merge base failed: " + str(error)
+	sys.exit(2)
+
+if not bases:
+	sys.exit(1)
+if not options.all:
+	bases = bases[:1]
+for rev in bases:
+	print rev.encode('hex')
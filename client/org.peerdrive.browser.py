@@ -18,10 +18,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from PyQt4 import QtCore, QtGui#, QtOpenGL
-from datetime import datetime
-import itertools, optparse, copy, pickle, os.path
+import itertools, optparse, copy, pickle, os.path, bisect, collections
 
-from peerdrive import Connector, Registry, connector, settingsPath
+from peerdrive import Connector, Registry, connector, settingsPath, dag
 from peerdrive.gui import utils
 from peerdrive.gui.widgets import DocumentView, DocButton
 
@@ -173,6 +172,47 @@ class WarpProxy(QtGui.QGraphicsProxyWidget):
 		self.__curLevel = self.__newLevel
 
 
+# Revisions of the history sorted by their mtime. Lookups and insertions are
+# binary searches. Positions count from the newest revision, i.e. position 0
+# is the present.
+class Timeline(object):
+
+	def __init__(self):
+		self.__keys = []
+		self.__mtimes = {}
+
+	def __len__(self):
+		return len(self.__keys)
+
+	def __contains__(self, rev):
+		return rev in self.__mtimes
+
+	def insert(self, rev, mtime):
+		if rev not in self.__mtimes:
+			self.__mtimes[rev] = mtime
+			bisect.insort(self.__keys, (mtime, rev))
+
+	def remove(self, rev):
+		pos = bisect.bisect_left(self.__keys, (self.__mtimes.pop(rev), rev))
+		del self.__keys[pos]
+
+	def position(self, rev):
+		pos = bisect.bisect_left(self.__keys, (self.__mtimes[rev], rev))
+		return len(self.__keys) - 1 - pos
+
+	def rev(self, position):
+		return self.__keys[len(self.__keys) - 1 - position][1]
+
+	# returns the revisions from position 'start' up to 'end' (exclusive)
+	def revs(self, start, end):
+		start = max(start, 0)
+		end = min(end, len(self.__keys))
+		if start >= end:
+			return []
+		l = len(self.__keys)
+		return [ rev for (mtime, rev) in reversed(self.__keys[l-end:l-start]) ]
+
+
 class WarpItem(connector.Watch):
 
 	def __init__(self, view, cls, size, scene, store, rev):
@@ -185,12 +225,8 @@ class WarpItem(connector.Watch):
 		self.__store = store
 		self.__rev = rev
 		self.__widget = None
-		self.__available = False
-		self.__seen = False
 		self.__watching = False
-		self.__mtime = datetime.fromtimestamp(0)
 		self.__state = {}
-		self.__update()
 
 	def setState(self, state):
 		self.__state = state
@@ -210,15 +246,9 @@ class WarpItem(connector.Watch):
 	def getWidget(self):
 		return self.__widget.widget()
 
-	def available(self):
-		return self.__available
-
 	def rev(self):
 		return self.__rev
 
-	def mtime(self):
-		return self.__mtime
-
 	def setEnabled(self, enable):
 		if self.__widget:
 			self.__widget.setEnabled(enable)
@@ -232,14 +262,14 @@ class WarpItem(connector.Watch):
 	def fadeIn(self, level):
 		if self.__widget:
 			self.__widget.setLevel(level)
-		elif self.__available:
+		else:
 			self.__createWidget(level)
 			self.__widget.fadeIn()
 
 	def fadeFull(self, level):
 		if self.__widget:
 			self.__widget.setLevel(level)
-		elif self.__available:
+		else:
 			self.__createWidget(level)
 			self.__widget.fadeFull()
 
@@ -253,13 +283,7 @@ class WarpItem(connector.Watch):
 
 	def triggered(self, event, store):
 		if event == connector.Watch.EVENT_DISAPPEARED:
-			self.__available = False
-			self.__watch()
-			self.__view._update(0)
-		elif event == connector.Watch.EVENT_APPEARED:
-			self.__update()
-			if self.__available:
-				self.__view._update(0)
+			self.__view._revDisappeared(self.__rev)
 
 	def setCacheMode(self, mode):
 		if self.__widget:
@@ -285,23 +309,6 @@ class WarpItem(connector.Watch):
 			self.__scene.removeItem(self.__widget)
 			self.__widget = None
 
-	def __update(self):
-		if self.__seen:
-			self.__unwatch()
-			self.__available = len(Connector().lookupRev(self.__rev)) > 0
-		else:
-			self.__available = False
-			try:
-				stat = Connector().stat(self.__rev)
-				self.__mtime = stat.mtime()
-				self.__seen = True
-				self.__available = True
-				self.__view._addParents(stat.parents())
-				self.__unwatch()
-			except IOError:
-				self.__watch()
-				return
-
 	def __watch(self):
 		if not self.__watching:
 			Connector().watch(self)
@@ -316,8 +323,33 @@ class WarpItem(connector.Watch):
 		self.__view._open(link)
 
 
+# Waits for a revision that could not be found to (re)appear
+class MissingRev(connector.Watch):
+
+	def __init__(self, view, rev):
+		connector.Watch.__init__(self, connector.Watch.TYPE_REV, rev)
+		self.__view = view
+		Connector().watch(self)
+
+	def delete(self):
+		Connector().unwatch(self)
+
+	def triggered(self, event, store):
+		if event == connector.Watch.EVENT_APPEARED:
+			self.__view._revAppeared(self.getHash())
+
+
+# Shows the history of a document. The stat()s of the revisions are fetched
+# in batches of PREFETCH_BATCH in the background, starting with the newest
+# ones, and sorted into the Timeline. WarpItems only exist for the three
+# visible revisions and WINDOW_MARGIN revisions before and after them. All
+# others are just entries in the Timeline.
 class WarpView(QtGui.QGraphicsView):
 
+	VISIBLE = 3
+	WINDOW_MARGIN = 2
+	PREFETCH_BATCH = 64
+
 	openItem = QtCore.pyqtSignal(connector.RevLink, object)
 
 	def __init__(self, cls, store, rev, state):
@@ -335,11 +367,13 @@ class WarpView(QtGui.QGraphicsView):
 #		self.setBackgroundBrush(QtGui.QBrush(QtGui.QPixmap("space_warp.jpg")))
 #		self.setViewport(QtOpenGL.QGLWidget(QtOpenGL.QGLFormat(QtOpenGL.QGL.SampleBuffers)))
 
-		self.__parentTimer = QtCore.QTimer(self)
-		self.__parentTimer.timeout.connect(self.__inspectParents)
-		self.__parentTimer.setSingleShot(True)
-		self.__parentTimer.setInterval(100)
-		self.__parentBacklog = []
+		self.__prefetchTimer = QtCore.QTimer(self)
+		self.__prefetchTimer.timeout.connect(self.__prefetch)
+		self.__prefetchTimer.setSingleShot(True)
+		self.__prefetchTimer.setInterval(10)
+		self.__backlog = collections.deque()
+		self.__known = set()
+		self.__missing = {}
 
 		self.__goPast = QtGui.QPushButton("Past")
 		self.__goPast.clicked.connect(self.__movePast)
@@ -351,17 +385,27 @@ class WarpView(QtGui.QGraphicsView):
 		self.__scene.addWidget(self.__goPresent)
 		self.__scene.addWidget(self.__openBtn)
 
-		item = WarpItem(self, self.__class, self.size(), self.__scene, store, rev)
-		item.fadeFull(0)
-		item.setState(state)
 		self.__distance = 1
 		self.__zoom = 1
 		self.__state = state
-		self.__allItems = { rev : item }
-		self.__availItems = []
+		self.__timeline = Timeline()
+		self.__items = {}
 		self.__visibleItems = []
-		self.__curItem = item
-		self._update(0)
+		self.__curRev = rev
+		self.__unindexedRev = rev
+
+		# The whole history of an indexed revision is indexed too. Queue it
+		# right away, newest first, instead of discovering it one generation
+		# at a time.
+		index = dag.historyIndex()
+		if index is not None and index.get([rev]):
+			self.__enqueue([rev] + dag.RevGraph(index=index).history(rev))
+			self.__unindexedRev = None
+		else:
+			self.__enqueue([rev])
+		self.__prefetch()
+		if rev in self.__items:
+			self.__items[rev].fadeFull(0)
 
 		self.__initTimeLine = QtCore.QTimeLine(250, self)
 		self.__initTimeLine.valueChanged.connect(self.__initValueChanged)
@@ -369,37 +413,69 @@ class WarpView(QtGui.QGraphicsView):
 		self.__initTimeLine.start()
 
 	def delete(self):
-		for item in self.__allItems.values():
+		self.__prefetchTimer.stop()
+		self.__backlog.clear()
+		for item in self.__items.values():
 			item.delete()
+		for watch in self.__missing.values():
+			watch.delete()
 		self.__visibleItems = []
-		self.__allItems = {}
-		self.__availItems = []
-		self.__curItem = None
+		self.__items = {}
+		self.__missing = {}
+		self.__timeline = Timeline()
+		self.__curRev = None
 
 	def getCurrentView(self):
-		return self.__curItem.getWidget()
+		return self.__items[self.__curRev].getWidget()
 
 	def resizeEvent(self, event):
 		super(WarpView, self).resizeEvent(event)
 		self.__resize()
 
-	def _addParents(self, parents):
-		self.__parentBacklog.extend(parents)
-		if not self.__parentTimer.isActive():
-			self.__parentTimer.start()
+	def __enqueue(self, revs):
+		for rev in revs:
+			if rev not in self.__known:
+				self.__known.add(rev)
+				self.__backlog.append(rev)
+		if self.__backlog and not self.__prefetchTimer.isActive():
+			self.__prefetchTimer.start()
+
+	def _revDisappeared(self, rev):
+		if rev in self.__timeline:
+			self.__timeline.remove(rev)
+			self.__missing[rev] = MissingRev(self, rev)
+			self._update(0)
+
+	def _revAppeared(self, rev):
+		if rev in self.__missing:
+			self.__missing.pop(rev).delete()
+			self.__backlog.appendleft(rev)
+			if not self.__prefetchTimer.isActive():
+				self.__prefetchTimer.start()
 
 	def _update(self, motion):
-		# sort items by time
-		self.__availItems = [item for item in self.__allItems.values()
-			if item.available()]
-		self.__availItems.sort(key=lambda item: item.mtime(), reverse=True)
-		if self.__curItem not in self.__availItems:
-			self.__state = self.__curItem.getState()
-			self.__curItem = self.__availItems[0] # FIXME
+		if not len(self.__timeline):
+			return
+		if self.__curRev not in self.__timeline:
+			if self.__curRev in self.__items:
+				self.__state = self.__items[self.__curRev].getState()
+			self.__curRev = self.__timeline.rev(0) # FIXME
 
 		old = self.__visibleItems[:]
-		index = self.__availItems.index(self.__curItem)
-		self.__visibleItems = self.__availItems[index:index+3]
+		index = self.__timeline.position(self.__curRev)
+		window = self.__timeline.revs(index - WarpView.WINDOW_MARGIN,
+			index + WarpView.VISIBLE + WarpView.WINDOW_MARGIN)
+		for rev in self.__items.keys():
+			if rev not in window:
+				self.__items.pop(rev).delete()
+		size = self.size() * self.__distance
+		for rev in window:
+			if rev not in self.__items:
+				self.__items[rev] = WarpItem(self, self.__class, size,
+					self.__scene, self.__store, rev)
+
+		self.__visibleItems = [ self.__items[rev] for rev in
+			self.__timeline.revs(index, index + WarpView.VISIBLE) ]
 		for (pos, item) in zip(itertools.count(0), old):
 			if item not in self.__visibleItems:
 				item.setEnabled(False)
@@ -414,24 +490,31 @@ class WarpView(QtGui.QGraphicsView):
 			item.setEnabled(pos == 0)
 			item.setState(self.__state)
 
-		self.__goPast.setEnabled(index < len(self.__availItems)-1)
+		self.__goPast.setEnabled(index < len(self.__timeline)-1)
 		self.__goPresent.setEnabled(index > 0)
 
-	def __inspectParents(self):
-		trigger = False
-		todo = self.__parentBacklog[0:3]
-		del self.__parentBacklog[0:3]
-
-		for rev in todo:
-			if rev not in self.__allItems:
-				self.__allItems[rev] = WarpItem(self, self.__class,
-					self.size()*self.__distance, self.__scene, self.__store, rev)
-				trigger = True
+	def __prefetch(self):
+		batch = []
+		while self.__backlog and len(batch) < WarpView.PREFETCH_BATCH:
+			batch.append(self.__backlog.popleft())
+		parents = []
+		for (rev, stat) in Connector().statMany(batch).items():
+			if isinstance(stat, IOError):
+				if rev not in self.__missing:
+					self.__missing[rev] = MissingRev(self, rev)
+			else:
+				self.__timeline.insert(rev, stat.mtime())
+				parents.extend(stat.parents())
+		self.__enqueue(parents)
+		self._update(0)
 
-		if trigger:
-			self._update(0)
-		if self.__parentBacklog and not self.__parentTimer.isActive():
-			self.__parentTimer.start()
+		# All stat()s are cached by now so indexing the history for the next
+		# time does not need the server.
+		if not self.__backlog and self.__unindexedRev:
+			index = dag.historyIndex()
+			if index is not None:
+				dag.RevGraph(index=index).history(self.__unindexedRev)
+			self.__unindexedRev = None
 
 	def __resize(self):
 		size = self.size()
@@ -450,7 +533,7 @@ class WarpView(QtGui.QGraphicsView):
 			self.height()/2-h-2-offset)
 
 		size = self.size() * self.__distance
-		for item in self.__allItems.values():
+		for item in self.__items.values():
 			item.resize(size)
 
 	def __initValueChanged(self, step):
@@ -467,19 +550,20 @@ class WarpView(QtGui.QGraphicsView):
 				item.setCacheMode(QtGui.QGraphicsItem.DeviceCoordinateCache)
 
 	def __movePast(self):
-		self.__state = self.__curItem.getState()
-		self.__curItem = self.__visibleItems[1]
+		self.__state = self.__items[self.__curRev].getState()
+		index = self.__timeline.position(self.__curRev)
+		self.__curRev = self.__timeline.rev(index+1)
 		self._update(-1)
 
 	def __movePresent(self):
-		self.__state = self.__curItem.getState()
-		index = self.__availItems.index(self.__curItem)
-		self.__curItem = self.__availItems[index-1]
+		self.__state = self.__items[self.__curRev].getState()
+		index = self.__timeline.position(self.__curRev)
+		self.__curRev = self.__timeline.rev(index-1)
 		self._update(1)
 
 	def __open(self):
-		self.__state = self.__curItem.getState()
-		link = connector.RevLink(self.__store, self.__curItem.rev())
+		self.__state = self.__items[self.__curRev].getState()
+		link = connector.RevLink(self.__store, self.__curRev)
 		state = self.__state
 		self.__initTimeLine.setDirection(QtCore.QTimeLine.Backward)
 		self.__initTimeLine.finished.connect(
@@ -843,6 +927,11 @@ if __name__ == '__main__':
 	import sys
 
 	app = QtGui.QApplication(sys.argv)
+	Connector().enableDocCache()
+	try:
+		Connector().enableDiskCache()
+	except IOError:
+		pass
 	mainWin = BrowserWindow()
 	mainWin.open(sys.argv)
 	mainWin.show()
@@ -114,6 +114,11 @@ if __name__ == '__main__':
 	import sys
 
 	app = QtGui.QApplication(sys.argv)
+	Connector().enableDocCache()
+	try:
+		Connector().enableDiskCache()
+	except IOError:
+		pass
 	mainWin = FolderWindow()
 	mainWin.open(sys.argv)
 	mainWin.show()
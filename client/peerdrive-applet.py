@@ -132,11 +132,18 @@ class Launchbox(QtGui.QDialog):
 	def __fillMenu(self, menu, menuLink, store=None):
 		menu.clear()
 		c = struct.Folder(menuLink)
+		items = c.items()
+		struct.updateLinks([ link for (title, link) in items ])
+
+		# stat all entries in one go
+		with Connector().pipeline() as pipe:
+			stats = [ (title, link, pipe.stat(link.rev())) for (title, link)
+				in items if link.rev() ]
+
 		listing = []
-		for (title, link) in c.items():
-			link.update()
+		for (title, link, stat) in stats:
 			try:
-				type = Connector().stat(link.rev()).type()
+				type = stat.result().type()
 			except IOError:
 				type = None
 
@@ -583,6 +590,7 @@ if basePath:
 
 app = QtGui.QApplication(sys.argv)
 app.setQuitOnLastWindowClosed(False)
+Connector().enableDocCache()
 dialog = Launchbox()
 sys.exit(app.exec_())
 
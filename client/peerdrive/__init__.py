@@ -20,7 +20,6 @@ from __future__ import absolute_import
 
 import os
 from .connector import Connector
-from .registry  import Registry
 
 _settingsPath = None
 
@@ -33,3 +32,9 @@ def settingsPath():
 				break
 	return _settingsPath
 
+
+# The registry module pulls in the struct module and its first use walks the
+# system store. Import it only when a tool actually needs it.
+def Registry():
+	from .registry import Registry
+	return Registry()
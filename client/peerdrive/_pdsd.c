@@ -0,0 +1,702 @@
+/*
+ * PeerDrive
+ * Copyright (C) 2011  Jan Klötzke <jan DOT kloetzke AT freenet DOT de>
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/*
+ * Optional accelerated PDSD codec. It implements the same wire format as
+ * connector.Encoder and connector.Decoder and is used by loadPDSD() and
+ * dumpPDSD() when available. The link classes are registered by the
+ * connector through setup().
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <string.h>
+
+#define TAG_DICT	0x00
+#define TAG_LIST	0x10
+#define TAG_STRING	0x20
+#define TAG_BOOL	0x30
+#define TAG_RLINK	0x40
+#define TAG_DLINK	0x41
+#define TAG_FLOAT	0x50
+#define TAG_DOUBLE	0x51
+#define TAG_UINT8	0x60
+#define TAG_INT8	0x61
+#define TAG_UINT16	0x62
+#define TAG_INT16	0x63
+#define TAG_UINT32	0x64
+#define TAG_INT32	0x65
+#define TAG_UINT64	0x66
+#define TAG_INT64	0x67
+
+static PyObject *rev_link_type;
+static PyObject *doc_link_type;
+static PyObject *struct_error;
+
+
+/* Encoder ***************************************************************/
+
+struct buffer {
+	char *data;
+	Py_ssize_t len;
+	Py_ssize_t size;
+};
+
+static int buf_reserve(struct buffer *buf, Py_ssize_t len)
+{
+	Py_ssize_t size;
+	char *data;
+
+	if (buf->len + len <= buf->size)
+		return 0;
+
+	size = buf->size;
+	while (size < buf->len + len)
+		size *= 2;
+	data = PyMem_Realloc(buf->data, size);
+	if (!data) {
+		PyErr_NoMemory();
+		return -1;
+	}
+
+	buf->data = data;
+	buf->size = size;
+	return 0;
+}
+
+static int buf_append(struct buffer *buf, const char *data, Py_ssize_t len)
+{
+	if (buf_reserve(buf, len))
+		return -1;
+	memcpy(buf->data + buf->len, data, len);
+	buf->len += len;
+	return 0;
+}
+
+static int buf_append_le(struct buffer *buf, unsigned char tag,
+                         unsigned PY_LONG_LONG val, int bytes)
+{
+	char *p;
+	int i;
+
+	if (buf_reserve(buf, bytes + 1))
+		return -1;
+	p = buf->data + buf->len;
+	*p++ = tag;
+	for (i = 0; i < bytes; i++) {
+		*p++ = val & 0xff;
+		val >>= 8;
+	}
+	buf->len += bytes + 1;
+	return 0;
+}
+
+static int buf_append_len(struct buffer *buf, Py_ssize_t len)
+{
+	char tmp[4];
+
+	if (len > 0xffffffffLL) {
+		PyErr_SetString(struct_error, "object too large");
+		return -1;
+	}
+	tmp[0] = len & 0xff;
+	tmp[1] = (len >> 8) & 0xff;
+	tmp[2] = (len >> 16) & 0xff;
+	tmp[3] = (len >> 24) & 0xff;
+	return buf_append(buf, tmp, 4);
+}
+
+static int buf_append_tag_len(struct buffer *buf, unsigned char tag,
+                              Py_ssize_t len)
+{
+	if (buf_append(buf, (char *)&tag, 1))
+		return -1;
+	return buf_append_len(buf, len);
+}
+
+static int encode(struct buffer *buf, PyObject *o);
+
+static int encode_string(struct buffer *buf, PyObject *str)
+{
+	if (buf_append_tag_len(buf, TAG_STRING, PyString_GET_SIZE(str)))
+		return -1;
+	return buf_append(buf, PyString_AS_STRING(str), PyString_GET_SIZE(str));
+}
+
+static int encode_unicode(struct buffer *buf, PyObject *o)
+{
+	PyObject *str;
+	int ret;
+
+	str = PyUnicode_AsUTF8String(o);
+	if (!str)
+		return -1;
+	ret = encode_string(buf, str);
+	Py_DECREF(str);
+	return ret;
+}
+
+static int encode_key(struct buffer *buf, PyObject *key)
+{
+	PyObject *str, *repr;
+	int ret;
+
+	if (PyUnicode_Check(key)) {
+		str = PyUnicode_AsUTF8String(key);
+		if (!str)
+			return -1;
+	} else if (PyString_Check(key)) {
+		str = key;
+		Py_INCREF(str);
+	} else {
+		repr = PyObject_Repr(key);
+		if (repr) {
+			PyErr_Format(PyExc_TypeError, "Invalid dict key: %s",
+				PyString_AS_STRING(repr));
+			Py_DECREF(repr);
+		}
+		return -1;
+	}
+
+	ret = buf_append_len(buf, PyString_GET_SIZE(str));
+	if (!ret)
+		ret = buf_append(buf, PyString_AS_STRING(str), PyString_GET_SIZE(str));
+	Py_DECREF(str);
+	return ret;
+}
+
+static int encode_dict(struct buffer *buf, PyObject *d)
+{
+	PyObject *key, *value, *items, *item;
+	Py_ssize_t pos = 0, len;
+	int ret = 0;
+
+	len = PyObject_Size(d);
+	if (len < 0 || buf_append_tag_len(buf, TAG_DICT, len))
+		return -1;
+
+	if (PyDict_CheckExact(d)) {
+		while (PyDict_Next(d, &pos, &key, &value)) {
+			if (encode_key(buf, key) || encode(buf, value))
+				return -1;
+		}
+		return 0;
+	}
+
+	/* subclasses may define their own order, e.g. OrderedDict */
+	items = PyObject_CallMethod(d, "iteritems", NULL);
+	if (!items)
+		return -1;
+	while ((item = PyIter_Next(items))) {
+		if (!PyTuple_Check(item) || PyTuple_GET_SIZE(item) != 2) {
+			PyErr_SetString(PyExc_TypeError, "Invalid dict item");
+			ret = -1;
+		} else if (encode_key(buf, PyTuple_GET_ITEM(item, 0)) ||
+		           encode(buf, PyTuple_GET_ITEM(item, 1)))
+			ret = -1;
+		Py_DECREF(item);
+		if (ret)
+			break;
+	}
+	Py_DECREF(items);
+	if (PyErr_Occurred())
+		ret = -1;
+	return ret;
+}
+
+static int encode_list(struct buffer *buf, PyObject *l)
+{
+	PyObject *seq;
+	Py_ssize_t i, len;
+	int ret = 0;
+
+	seq = PySequence_Fast(l, "Invalid list");
+	if (!seq)
+		return -1;
+
+	len = PySequence_Fast_GET_SIZE(seq);
+	if (buf_append_tag_len(buf, TAG_LIST, len))
+		ret = -1;
+	for (i = 0; !ret && i < len; i++)
+		ret = encode(buf, PySequence_Fast_GET_ITEM(seq, i));
+
+	Py_DECREF(seq);
+	return ret;
+}
+
+static int encode_link(struct buffer *buf, PyObject *o)
+{
+	PyObject *str;
+	int ret;
+
+	str = PyObject_CallMethod(o, "_toStruct", NULL);
+	if (!str)
+		return -1;
+	if (!PyString_Check(str)) {
+		PyErr_SetString(PyExc_TypeError, "Invalid link encoding");
+		ret = -1;
+	} else
+		ret = buf_append(buf, PyString_AS_STRING(str), PyString_GET_SIZE(str));
+	Py_DECREF(str);
+	return ret;
+}
+
+static int encode_double(struct buffer *buf, double val)
+{
+	char tmp[9];
+
+	tmp[0] = TAG_DOUBLE;
+	if (_PyFloat_Pack8(val, (unsigned char *)tmp + 1, 1))
+		return -1;
+	return buf_append(buf, tmp, 9);
+}
+
+static int encode_int(struct buffer *buf, PyObject *o)
+{
+	PY_LONG_LONG val;
+	unsigned PY_LONG_LONG uval;
+	int overflow;
+
+	val = PyLong_AsLongLongAndOverflow(o, &overflow);
+	if (val == -1 && PyErr_Occurred())
+		return -1;
+
+	if (overflow < 0) {
+		PyErr_SetString(struct_error, "integer out of range");
+		return -1;
+	} else if (overflow > 0) {
+		uval = PyLong_AsUnsignedLongLong(o);
+		if (uval == (unsigned PY_LONG_LONG)-1 && PyErr_Occurred()) {
+			PyErr_Clear();
+			PyErr_SetString(struct_error, "integer out of range");
+			return -1;
+		}
+		return buf_append_le(buf, TAG_UINT64, uval, 8);
+	}
+
+	if (val < 0) {
+		if (val >= -128)
+			return buf_append_le(buf, TAG_INT8, val, 1);
+		else if (val >= -32768)
+			return buf_append_le(buf, TAG_INT16, val, 2);
+		else if (val >= -2147483648LL)
+			return buf_append_le(buf, TAG_INT32, val, 4);
+		else
+			return buf_append_le(buf, TAG_INT64, val, 8);
+	} else {
+		if (val <= 0xff)
+			return buf_append_le(buf, TAG_UINT8, val, 1);
+		else if (val <= 0xffff)
+			return buf_append_le(buf, TAG_UINT16, val, 2);
+		else if (val <= 0xffffffffLL)
+			return buf_append_le(buf, TAG_UINT32, val, 4);
+		else
+			return buf_append_le(buf, TAG_UINT64, val, 8);
+	}
+}
+
+static int encode(struct buffer *buf, PyObject *o)
+{
+	PyObject *repr;
+	int ret;
+
+	if (Py_EnterRecursiveCall(" while encoding PDSD"))
+		return -1;
+
+	/* same order of checks as connector._pdsdEncode */
+	if (o == Py_True || o == Py_False)
+		ret = buf_append_le(buf, TAG_BOOL, o == Py_True, 1);
+	else if (PyDict_Check(o))
+		ret = encode_dict(buf, o);
+	else if (PyList_Check(o) || PyTuple_Check(o))
+		ret = encode_list(buf, o);
+	else if (PyString_Check(o))
+		ret = encode_string(buf, o);
+	else if (PyUnicode_Check(o))
+		ret = encode_unicode(buf, o);
+	else if (PyObject_IsInstance(o, rev_link_type) > 0 ||
+	         PyObject_IsInstance(o, doc_link_type) > 0)
+		ret = encode_link(buf, o);
+	else if (PyFloat_Check(o))
+		ret = encode_double(buf, PyFloat_AS_DOUBLE(o));
+	else if (PyInt_Check(o) || PyLong_Check(o))
+		ret = encode_int(buf, o);
+	else {
+		ret = -1;
+		if (!PyErr_Occurred()) {
+			repr = PyObject_Repr(o);
+			if (repr) {
+				PyErr_Format(PyExc_TypeError, "Invalid object: %s",
+					PyString_AS_STRING(repr));
+				Py_DECREF(repr);
+			}
+		}
+	}
+
+	Py_LeaveRecursiveCall();
+	return ret;
+}
+
+static PyObject *pdsd_encode(PyObject *self, PyObject *o)
+{
+	struct buffer buf;
+	PyObject *ret;
+
+	if (!rev_link_type) {
+		PyErr_SetString(PyExc_RuntimeError, "Not set up");
+		return NULL;
+	}
+
+	buf.len = 0;
+	buf.size = 256;
+	buf.data = PyMem_Malloc(buf.size);
+	if (!buf.data)
+		return PyErr_NoMemory();
+
+	if (encode(&buf, o))
+		ret = NULL;
+	else
+		ret = PyString_FromStringAndSize(buf.data, buf.len);
+
+	PyMem_Free(buf.data);
+	return ret;
+}
+
+
+/* Decoder ***************************************************************/
+
+struct decoder {
+	const unsigned char *data;
+	Py_ssize_t len;
+	Py_ssize_t pos;
+	PyObject *store;
+};
+
+static int get_le(struct decoder *dec, int bytes, unsigned PY_LONG_LONG *val)
+{
+	int i;
+
+	if (dec->pos + bytes > dec->len) {
+		PyErr_SetString(struct_error, "Truncated PDSD data");
+		return -1;
+	}
+
+	*val = 0;
+	for (i = bytes - 1; i >= 0; i--)
+		*val = (*val << 8) | dec->data[dec->pos + i];
+	dec->pos += bytes;
+	return 0;
+}
+
+/* like slicing a string the result is cut at the end of the data */
+static const char *get_str(struct decoder *dec, Py_ssize_t *len)
+{
+	const char *str = (const char *)dec->data + dec->pos;
+
+	if (*len > dec->len - dec->pos)
+		*len = dec->len - dec->pos;
+	dec->pos += *len;
+	return str;
+}
+
+static PyObject *decode_string(struct decoder *dec)
+{
+	unsigned PY_LONG_LONG len;
+	Py_ssize_t size;
+	const char *str;
+
+	if (get_le(dec, 4, &len))
+		return NULL;
+	size = len;
+	str = get_str(dec, &size);
+	return PyUnicode_DecodeUTF8(str, size, "strict");
+}
+
+static PyObject *decode(struct decoder *dec);
+
+static PyObject *decode_dict(struct decoder *dec)
+{
+	unsigned PY_LONG_LONG elements, i;
+	PyObject *d, *key, *value;
+	int ret;
+
+	if (get_le(dec, 4, &elements))
+		return NULL;
+
+	d = PyDict_New();
+	if (!d)
+		return NULL;
+
+	for (i = 0; i < elements; i++) {
+		key = decode_string(dec);
+		if (!key)
+			goto error;
+		value = decode(dec);
+		if (!value) {
+			Py_DECREF(key);
+			goto error;
+		}
+		ret = PyDict_SetItem(d, key, value);
+		Py_DECREF(key);
+		Py_DECREF(value);
+		if (ret)
+			goto error;
+	}
+
+	return d;
+
+error:
+	Py_DECREF(d);
+	return NULL;
+}
+
+static PyObject *decode_list(struct decoder *dec)
+{
+	unsigned PY_LONG_LONG elements, i;
+	PyObject *l, *value;
+	int ret;
+
+	if (get_le(dec, 4, &elements))
+		return NULL;
+
+	l = PyList_New(0);
+	if (!l)
+		return NULL;
+
+	for (i = 0; i < elements; i++) {
+		value = decode(dec);
+		if (!value)
+			goto error;
+		ret = PyList_Append(l, value);
+		Py_DECREF(value);
+		if (ret)
+			goto error;
+	}
+
+	return l;
+
+error:
+	Py_DECREF(l);
+	return NULL;
+}
+
+static PyObject *decode_link(struct decoder *dec, int doc)
+{
+	unsigned PY_LONG_LONG len;
+	Py_ssize_t size;
+	const char *str;
+
+	if (get_le(dec, 1, &len))
+		return NULL;
+	size = len;
+	str = get_str(dec, &size);
+
+	if (doc)
+		return PyObject_CallFunction(doc_link_type, "Os#O", dec->store, str,
+			size, Py_False);
+	else
+		return PyObject_CallFunction(rev_link_type, "Os#", dec->store, str,
+			size);
+}
+
+static PyObject *decode_signed(struct decoder *dec, int bytes)
+{
+	unsigned PY_LONG_LONG val;
+	PY_LONG_LONG sval;
+	int shift = 64 - bytes * 8;
+
+	if (get_le(dec, bytes, &val))
+		return NULL;
+
+	/* sign extension */
+	sval = (PY_LONG_LONG)(val << shift) >> shift;
+	if (sval >= LONG_MIN && sval <= LONG_MAX)
+		return PyInt_FromLong((long)sval);
+	return PyLong_FromLongLong(sval);
+}
+
+static PyObject *decode_unsigned(struct decoder *dec, int bytes)
+{
+	unsigned PY_LONG_LONG val;
+
+	if (get_le(dec, bytes, &val))
+		return NULL;
+
+	if (val <= LONG_MAX)
+		return PyInt_FromLong((long)val);
+	return PyLong_FromUnsignedLongLong(val);
+}
+
+static PyObject *decode_float(struct decoder *dec, int bytes)
+{
+	double val;
+
+	if (dec->pos + bytes > dec->len) {
+		PyErr_SetString(struct_error, "Truncated PDSD data");
+		return NULL;
+	}
+
+	if (bytes == 4)
+		val = _PyFloat_Unpack4(dec->data + dec->pos, 1);
+	else
+		val = _PyFloat_Unpack8(dec->data + dec->pos, 1);
+	if (val == -1.0 && PyErr_Occurred())
+		return NULL;
+
+	dec->pos += bytes;
+	return PyFloat_FromDouble(val);
+}
+
+static PyObject *decode(struct decoder *dec)
+{
+	unsigned PY_LONG_LONG tag;
+	PyObject *ret;
+
+	if (get_le(dec, 1, &tag))
+		return NULL;
+
+	if (Py_EnterRecursiveCall(" while decoding PDSD"))
+		return NULL;
+
+	switch (tag) {
+		case TAG_DICT:
+			ret = decode_dict(dec);
+			break;
+		case TAG_LIST:
+			ret = decode_list(dec);
+			break;
+		case TAG_STRING:
+			ret = decode_string(dec);
+			break;
+		case TAG_BOOL:
+			if (get_le(dec, 1, &tag))
+				ret = NULL;
+			else {
+				ret = tag ? Py_True : Py_False;
+				Py_INCREF(ret);
+			}
+			break;
+		case TAG_RLINK:
+			ret = decode_link(dec, 0);
+			break;
+		case TAG_DLINK:
+			ret = decode_link(dec, 1);
+			break;
+		case TAG_FLOAT:
+			ret = decode_float(dec, 4);
+			break;
+		case TAG_DOUBLE:
+			ret = decode_float(dec, 8);
+			break;
+		case TAG_UINT8:
+			ret = decode_unsigned(dec, 1);
+			break;
+		case TAG_INT8:
+			ret = decode_signed(dec, 1);
+			break;
+		case TAG_UINT16:
+			ret = decode_unsigned(dec, 2);
+			break;
+		case TAG_INT16:
+			ret = decode_signed(dec, 2);
+			break;
+		case TAG_UINT32:
+			ret = decode_unsigned(dec, 4);
+			break;
+		case TAG_INT32:
+			ret = decode_signed(dec, 4);
+			break;
+		case TAG_UINT64:
+			ret = decode_unsigned(dec, 8);
+			break;
+		case TAG_INT64:
+			ret = decode_signed(dec, 8);
+			break;
+		default:
+			PyErr_SetString(PyExc_TypeError, "Invalid tag");
+			ret = NULL;
+	}
+
+	Py_LeaveRecursiveCall();
+	return ret;
+}
+
+static PyObject *pdsd_decode(PyObject *self, PyObject *args)
+{
+	struct decoder dec;
+	const char *data;
+
+	if (!PyArg_ParseTuple(args, "Os#:decode", &dec.store, &data, &dec.len))
+		return NULL;
+
+	if (!rev_link_type) {
+		PyErr_SetString(PyExc_RuntimeError, "Not set up");
+		return NULL;
+	}
+
+	dec.data = (const unsigned char *)data;
+	dec.pos = 0;
+	return decode(&dec);
+}
+
+
+/* Module ****************************************************************/
+
+static PyObject *pdsd_setup(PyObject *self, PyObject *args)
+{
+	PyObject *rev_link, *doc_link;
+
+	if (!PyArg_ParseTuple(args, "OO:setup", &rev_link, &doc_link))
+		return NULL;
+
+	Py_XDECREF(rev_link_type);
+	Py_XDECREF(doc_link_type);
+	Py_INCREF(rev_link);
+	Py_INCREF(doc_link);
+	rev_link_type = rev_link;
+	doc_link_type = doc_link;
+
+	Py_RETURN_NONE;
+}
+
+static PyMethodDef pdsd_methods[] = {
+	{"setup", pdsd_setup, METH_VARARGS,
+		"setup(RevLink, DocLink) -- register the link classes"},
+	{"encode", pdsd_encode, METH_O,
+		"encode(obj) -> str -- encode an object as PDSD"},
+	{"decode", pdsd_decode, METH_VARARGS,
+		"decode(store, str) -> obj -- decode a PDSD string"},
+	{NULL, NULL, 0, NULL}
+};
+
+PyMODINIT_FUNC init_pdsd(void)
+{
+	PyObject *module, *struct_mod;
+
+	struct_mod = PyImport_ImportModule("struct");
+	if (!struct_mod)
+		return;
+	struct_error = PyObject_GetAttrString(struct_mod, "error");
+	Py_DECREF(struct_mod);
+	if (!struct_error)
+		return;
+
+	module = Py_InitModule3("_pdsd", pdsd_methods, "Accelerated PDSD codec");
+	if (!module)
+		return;
+}
@@ -0,0 +1,854 @@
+# vim: set fileencoding=utf-8 :
+#
+# PeerDrive
+# Copyright (C) 2011  Jan Klötzke <jan DOT kloetzke AT freenet DOT de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import sys, socket, select, errno, heapq, time, weakref, functools, types
+import collections
+
+from . import connector
+from .connector import _Protocol, RevCache, loadPDSD, _serverAddress, \
+	_errorCodes, _revCacheKey
+
+# Event loop based client interface for services that do not use Qt. There
+# is no asyncio in Python 2, so this module brings a small select() based
+# event loop and generator based coroutines in the style of Twisted's
+# inlineCallbacks:
+#
+#	@aio.coroutine
+#	def titles(revs):
+#		c = yield aio.connect()
+#		stats = yield aio.gather([ c.stat(rev) for rev in revs ])
+#		raise aio.Return([ stat.type() for stat in stats ])
+#
+#	print aio.getLoop().runUntilComplete(titles(revs))
+#
+# Every RPC of the AsyncConnector returns a Future immediately, hence any
+# number of requests may be in flight on one connection. The protocol
+# itself (framing, references, confirmations and indications) is shared with
+# the blocking connector through connector._Protocol.
+
+
+# Raised by a coroutine to return a value. Generators cannot return values
+# in Python 2.
+class Return(Exception):
+	def __init__(self, value=None):
+		Exception.__init__(self, value)
+		self.value = value
+
+
+# Result of an asynchronous operation. The callbacks are called from the
+# event loop, never from within setResult() or setException().
+class Future(object):
+
+	def __init__(self, loop=None):
+		self.__loop = loop or getLoop()
+		self.__done = False
+		self.__result = None
+		self.__error = None
+		self.__callbacks = []
+
+	def done(self):
+		return self.__done
+
+	def result(self):
+		if not self.__done:
+			raise RuntimeError("Future is not done")
+		if self.__error is not None:
+			(typ, value, tb) = self.__error
+			raise typ, value, tb
+		return self.__result
+
+	def exception(self):
+		if not self.__done:
+			raise RuntimeError("Future is not done")
+		if self.__error is not None:
+			return self.__error[1]
+		return None
+
+	def _excInfo(self):
+		return self.__error
+
+	def addDoneCallback(self, callback):
+		if self.__done:
+			self.__loop.callSoon(callback, self)
+		else:
+			self.__callbacks.append(callback)
+
+	def setResult(self, result):
+		self.__result = result
+		self.__complete()
+
+	# 'tb' is the traceback from sys.exc_info() if available
+	def setException(self, error, tb=None):
+		self.__error = (type(error), error, tb)
+		self.__complete()
+
+	def __complete(self):
+		if self.__done:
+			raise RuntimeError("Future is already done")
+		self.__done = True
+		callbacks = self.__callbacks
+		self.__callbacks = []
+		for callback in callbacks:
+			self.__loop.callSoon(callback, self)
+
+
+# Drives a generator. Every yielded Future suspends the generator until the
+# Future is done. The generator is resumed with the result or the exception
+# is raised at the yield. The generator runs up to its first yield right
+# away so that the first requests are sent immediately.
+class Task(Future):
+
+	def __init__(self, gen, loop=None):
+		Future.__init__(self, loop)
+		self.__gen = gen
+		self.__step(None, None)
+
+	def __step(self, value, excInfo):
+		try:
+			if excInfo is None:
+				future = self.__gen.send(value)
+			else:
+				future = self.__gen.throw(*excInfo)
+		except StopIteration:
+			self.setResult(None)
+		except Return as r:
+			self.setResult(r.value)
+		except Exception as e:
+			self.setException(e, sys.exc_info()[2])
+		else:
+			if isinstance(future, Future):
+				future.addDoneCallback(self.__wakeup)
+			else:
+				error = TypeError("Coroutine yielded %r instead of a Future" % (future,))
+				self.__step(None, (TypeError, error, None))
+
+	def __wakeup(self, future):
+		excInfo = future._excInfo()
+		if excInfo is None:
+			self.__step(future.result(), None)
+		else:
+			self.__step(None, excInfo)
+
+
+# Decorator for generator based coroutines. Calling the decorated function
+# returns a Task.
+def coroutine(func):
+	@functools.wraps(func)
+	def wrapper(*args, **kwargs):
+		try:
+			result = func(*args, **kwargs)
+		except Return as r:
+			result = r.value
+		except Exception as e:
+			future = Future()
+			future.setException(e, sys.exc_info()[2])
+			return future
+		if isinstance(result, types.GeneratorType):
+			return Task(result)
+		future = Future()
+		future.setResult(result)
+		return future
+	return wrapper
+
+
+# Returns a Future of the list of results of all futures. The first
+# exception is raised unless returnExceptions is True in which case the
+# exceptions take the place of the results.
+def gather(futures, returnExceptions=False):
+	futures = list(futures)
+	result = Future()
+	remaining = [len(futures)]
+	if not futures:
+		result.setResult([])
+		return result
+
+	def done(future):
+		if result.done():
+			return
+		if not returnExceptions and future._excInfo() is not None:
+			(typ, value, tb) = future._excInfo()
+			result.setException(value, tb)
+			return
+		remaining[0] -= 1
+		if remaining[0] == 0:
+			if returnExceptions:
+				result.setResult([ f.exception() or f.result() for f in futures ])
+			else:
+				result.setResult([ f.result() for f in futures ])
+
+	for future in futures:
+		future.addDoneCallback(done)
+	return result
+
+
+def sleep(delay, result=None):
+	future = Future()
+	getLoop().callLater(delay, future.setResult, result)
+	return future
+
+
+class Loop(object):
+
+	def __init__(self):
+		self.__ready = collections.deque()
+		self.__timers = []
+		self.__sequence = 0
+		self.__readers = {}
+		self.__writers = {}
+		self.__stopped = False
+
+	def callSoon(self, callback, *args):
+		self.__ready.append((callback, args))
+
+	def callLater(self, delay, callback, *args):
+		self.__sequence += 1
+		heapq.heappush(self.__timers, (time.time() + delay, self.__sequence,
+			callback, args))
+
+	def addReader(self, fd, callback):
+		self.__readers[fd] = callback
+
+	def removeReader(self, fd):
+		self.__readers.pop(fd, None)
+
+	def addWriter(self, fd, callback):
+		self.__writers[fd] = callback
+
+	def removeWriter(self, fd):
+		self.__writers.pop(fd, None)
+
+	def stop(self):
+		self.__stopped = True
+
+	def runForever(self):
+		self.__stopped = False
+		while not self.__stopped:
+			self.runOnce()
+
+	def runUntilComplete(self, future):
+		if not isinstance(future, Future):
+			future = Task(future, self)
+		future.addDoneCallback(lambda f: self.stop())
+		self.runForever()
+		return future.result()
+
+	# Runs all callbacks that are ready and waits up to 'timeout' seconds
+	# for I/O or the next timer.
+	def runOnce(self, timeout=None):
+		if self.__ready:
+			timeout = 0
+		elif self.__timers:
+			delay = max(self.__timers[0][0] - time.time(), 0)
+			if timeout is None or delay < timeout:
+				timeout = delay
+		elif timeout is None and not self.__readers and not self.__writers:
+			raise RuntimeError("Event loop has nothing to wait for")
+
+		if self.__readers or self.__writers:
+			while True:
+				try:
+					(readable, writable, x) = select.select(self.__readers.keys(),
+						self.__writers.keys(), [], timeout)
+					break
+				except select.error as e:
+					if e.args[0] != errno.EINTR:
+						raise
+			for fd in writable:
+				if fd in self.__writers:
+					self.__writers[fd]()
+			for fd in readable:
+				if fd in self.__readers:
+					self.__readers[fd]()
+		elif timeout:
+			time.sleep(timeout)
+
+		now = time.time()
+		while self.__timers and self.__timers[0][0] <= now:
+			(when, seq, callback, args) = heapq.heappop(self.__timers)
+			self.__ready.append((callback, args))
+
+		# callbacks that are scheduled from now on run in the next round
+		for i in xrange(len(self.__ready)):
+			(callback, args) = self.__ready.popleft()
+			callback(*args)
+
+
+_loop = None
+
+def getLoop():
+	global _loop
+	if _loop is None:
+		_loop = Loop()
+	return _loop
+
+def setLoop(loop):
+	global _loop
+	_loop = loop
+
+
+# Opens a connection to the server and does the protocol handshake. Returns
+# a Future of the AsyncConnector.
+@coroutine
+def connect(address=None):
+	c = AsyncConnector(address)
+	try:
+		yield c._init()
+	except:
+		c.close()
+		raise
+	raise Return(c)
+
+
+class AsyncConnector(_Protocol):
+	RECV_SIZE = 0x10000
+
+	# Use connect() instead of creating the object directly
+	def __init__(self, address=None):
+		_Protocol.__init__(self)
+		(host, port, self.__cookie) = _serverAddress(address)
+		self.loop = getLoop()
+		self.revCache = RevCache()
+		self.maxPacketSize = None
+		self.__pending = collections.deque()
+		self.__dispatchScheduled = False
+		self.__error = None
+		try:
+			self.__socket = socket.create_connection((host, port), 1.0)
+			self.__socket.setblocking(0)
+			self.__socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		except socket.error:
+			raise IOError("Could not connect to server!")
+		self.__fd = self.__socket.fileno()
+		self.loop.addReader(self.__fd, self.__readReady)
+
+	def _init(self):
+		def done(reply):
+			self.maxPacketSize = connector._initCnf(reply)
+			return self.maxPacketSize
+		return self._rpc(_Protocol.INIT_MSG, connector._initReq(self.__cookie),
+			done)
+
+	def close(self):
+		self.__shutdown(IOError("Connection closed"))
+
+	# Number of requests that wait for their confirmation
+	def inFlight(self):
+		return len(self.confirmations)
+
+	def enum(self):
+		return self._rpc(_Protocol.ENUM_MSG, '', connector._enumCnf)
+
+	def lookupDoc(self, doc, stores=[]):
+		return self._rpc(_Protocol.LOOKUP_DOC_MSG,
+			connector._lookupDocReq(doc, stores), connector._lookupDocCnf)
+
+	def lookupRev(self, rev, stores=[]):
+		return self._rpc(_Protocol.LOOKUP_REV_MSG,
+			connector._lookupRevReq(rev, stores), connector._lookupRevCnf)
+
+	def stat(self, rev, stores=[]):
+		key = _revCacheKey('stat', rev, stores)
+		return self.__cached(key) or self._rpc(_Protocol.STAT_MSG,
+			connector._statReq(rev, stores),
+			connector._cacheReply(self.revCache, key, connector._statCnf))
+
+	def getLinks(self, rev, stores=[]):
+		key = _revCacheKey('links', rev, stores)
+		return self.__cached(key) or self._rpc(_Protocol.GET_LINKS_MSG,
+			connector._getLinksReq(rev, stores),
+			connector._cacheReply(self.revCache, key, connector._getLinksCnf))
+
+	def peek(self, store, rev):
+		return self._rpc(_Protocol.PEEK_MSG, connector._peekReq(store, rev),
+			lambda reply: AsyncHandle(self, store,
+				connector.pb.PeekCnf.FromString(reply).handle, None, rev))
+
+	def create(self, store, typ, creator):
+		def done(reply):
+			(handle, doc) = connector._createCnf(reply)
+			return AsyncHandle(self, store, handle, doc, None)
+		return self._rpc(_Protocol.CREATE_MSG,
+			connector._createReq(store, typ, creator), done)
+
+	def fork(self, store, rev, creator):
+		def done(reply):
+			(handle, doc) = connector._forkCnf(reply)
+			return AsyncHandle(self, store, handle, doc, rev)
+		return self._rpc(_Protocol.FORK_MSG,
+			connector._forkReq(store, rev, creator), done)
+
+	def update(self, store, doc, rev, creator=None):
+		return self._rpc(_Protocol.UPDATE_MSG,
+			connector._updateReq(store, doc, rev, creator),
+			lambda reply: AsyncHandle(self, store,
+				connector._updateCnf(reply), doc, rev))
+
+	def resume(self, store, doc, rev, creator=None):
+		return self._rpc(_Protocol.RESUME_MSG,
+			connector._resumeReq(store, doc, rev, creator),
+			lambda reply: AsyncHandle(self, store,
+				connector._resumeCnf(reply), doc, rev))
+
+	def forget(self, store, doc, rev):
+		return self._rpc(_Protocol.FORGET_MSG,
+			connector._forgetReq(store, doc, rev))
+
+	def deleteDoc(self, store, doc, rev):
+		return self._rpc(_Protocol.DELETE_DOC_MSG,
+			connector._deleteDocReq(store, doc, rev))
+
+	def deleteRev(self, store, rev):
+		return self._rpc(_Protocol.DELETE_REV_MSG,
+			connector._deleteRevReq(store, rev))
+
+	def forwardDoc(self, store, doc, fromRev, toRev, srcStore, depth=None, verbose=False):
+		return self._rpc(_Protocol.FORWARD_DOC_MSG, connector._forwardDocReq(
+			store, doc, fromRev, toRev, srcStore, depth, verbose))
+
+	def replicateDoc(self, srcStore, doc, dstStore, depth=None, verbose=False):
+		return self._rpc(_Protocol.REPLICATE_DOC_MSG,
+			connector._replicateDocReq(srcStore, doc, dstStore, depth, verbose),
+			lambda reply: AsyncReplicateHandle(self,
+				connector.pb.ReplicateDocCnf.FromString(reply).handle))
+
+	def replicateRev(self, srcStore, rev, dstStore, depth=None, verbose=False):
+		return self._rpc(_Protocol.REPLICATE_REV_MSG,
+			connector._replicateRevReq(srcStore, rev, dstStore, depth, verbose),
+			lambda reply: AsyncReplicateHandle(self,
+				connector.pb.ReplicateRevCnf.FromString(reply).handle))
+
+	def mount(self, src, label, type, options=None, credentials=None):
+		return self._rpc(_Protocol.MOUNT_MSG,
+			connector._mountReq(src, label, type, options, credentials),
+			lambda reply: connector.pb.MountCnf.FromString(reply).sid)
+
+	def unmount(self, sid):
+		return self._rpc(_Protocol.UNMOUNT_MSG, connector._unmountReq(sid))
+
+	def getDocPath(self, store, doc):
+		return self._rpc(_Protocol.GET_PATH_MSG,
+			connector._getPathReq(store, doc, False), connector._getPathCnf)
+
+	def getRevPath(self, store, rev):
+		return self._rpc(_Protocol.GET_PATH_MSG,
+			connector._getPathReq(store, rev, True), connector._getPathCnf)
+
+	def walkPath(self, path):
+		return self._rpc(_Protocol.WALK_PATH_MSG, connector._walkPathReq(path),
+			connector._walkPathCnf)
+
+	# The watch is armed when the returned Future is done. Watches are
+	# referenced weakly like in the blocking connector.
+	@coroutine
+	def watch(self, w):
+		if w._incWatchRef() != 1:
+			return
+		(typ, h) = ref = w._getRef()
+		add = ref not in self.watchHandlers
+		if add:
+			self.watchHandlers[ref] = []
+		self.watchHandlers[ref].append(weakref.ref(w,
+			lambda r, ref=ref: self.__delWatch(r, ref)))
+		if add:
+			try:
+				yield self._rpc(_Protocol.WATCH_ADD_MSG,
+					connector._watchAddReq(typ, h))
+			except IOError:
+				for r in self.watchHandlers.pop(ref, []):
+					r = r()
+					if r is not None:
+						r._decWatchRef()
+				raise
+
+	@coroutine
+	def unwatch(self, w):
+		if w._decWatchRef() != 0:
+			return
+		(typ, h) = ref = w._getRef()
+		handlers = [ r for r in self.watchHandlers[ref] if r() != w ]
+		if handlers:
+			self.watchHandlers[ref] = handlers
+		else:
+			del self.watchHandlers[ref]
+			yield self._rpc(_Protocol.WATCH_REM_MSG,
+				connector._watchRemReq(typ, h))
+
+	def __delWatch(self, watchObjRef, ref):
+		handlers = self.watchHandlers.get(ref)
+		if handlers is None or watchObjRef not in handlers:
+			return
+		handlers.remove(watchObjRef)
+		if not handlers:
+			del self.watchHandlers[ref]
+			(typ, h) = ref
+			self._rpc(_Protocol.WATCH_REM_MSG, connector._watchRemReq(typ, h))
+
+	@coroutine
+	def regProgressHandler(self, start=None, progress=None, stop=None):
+		handlers = [ (e, h) for (e, h) in [(_Protocol.PROGRESS_START_MSG, start),
+			(_Protocol.PROGRESS_MSG, progress), (_Protocol.PROGRESS_END_MSG, stop)]
+			if h ]
+		if not handlers:
+			return
+		enable = not self.progressHandlers
+		self.progressHandlers.extend(handlers)
+		if enable:
+			yield self._rpc(_Protocol.WATCH_PROGRESS_MSG,
+				connector._watchProgressReq(True))
+		if start or progress:
+			cnf = yield self._rpc(_Protocol.PROGRESS_QUERY_MSG, '',
+				connector.pb.ProgressQueryCnf.FromString)
+			for item in cnf.items:
+				if start:
+					self._dispatchProgressStart(item.item, [start])
+				if progress:
+					self._dispatchProgress(item.state, [progress])
+
+	@coroutine
+	def unregProgressHandler(self, start=None, progress=None, stop=None):
+		for (e, h) in [(_Protocol.PROGRESS_START_MSG, start),
+				(_Protocol.PROGRESS_MSG, progress), (_Protocol.PROGRESS_END_MSG, stop)]:
+			if h:
+				self.progressHandlers.remove((e, h))
+		if not self.progressHandlers and (start or progress or stop):
+			yield self._rpc(_Protocol.WATCH_PROGRESS_MSG,
+				connector._watchProgressReq(False))
+
+	def progressPause(self, tag):
+		return self._rpc(_Protocol.PROGRESS_END_MSG,
+			connector._progressEndReq(tag, True))
+
+	def progressStop(self, tag):
+		return self._rpc(_Protocol.PROGRESS_END_MSG,
+			connector._progressEndReq(tag, False))
+
+	def progressResume(self, tag, skip=None):
+		return self._rpc(_Protocol.PROGRESS_START_MSG,
+			connector._progressStartReq(tag, skip))
+
+	# protected functions
+
+	class _Completion(object):
+		__slots__ = ['__msg', '__future', '__done']
+		def __init__(self, msg, future, done):
+			self.__msg = msg
+			self.__future = future
+			self.__done = done
+
+		def setResult(self, cnf, reply):
+			if cnf == self.__msg:
+				try:
+					result = self.__done(reply)
+				except Exception as e:
+					self.__future.setException(e, sys.exc_info()[2])
+				else:
+					self.__future.setResult(result)
+			elif cnf == _Protocol.ERROR_MSG:
+				error = connector.pb.ErrorCnf.FromString(reply).error
+				self.__future.setException(IOError(_errorCodes.get(error,
+					'Unknown error')))
+			else:
+				self.__future.setException(IOError("Invalid server reply!"))
+
+		def setError(self, error):
+			self.__future.setException(error)
+
+	def _rpc(self, msg, request='', done=lambda x: x):
+		future = Future(self.loop)
+		if self.__error is not None:
+			future.setException(self.__error)
+		else:
+			self._request(msg, request, AsyncConnector._Completion(msg, future,
+				done))
+		return future
+
+	def _write(self, data):
+		if not self.__pending:
+			try:
+				sent = self.__socket.send(data)
+			except socket.error as e:
+				if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+					self.loop.callSoon(self.__shutdown,
+						IOError("Could not send request to server: " + str(e)))
+					return
+				sent = 0
+			if sent == len(data):
+				return
+			data = data[sent:]
+			self.loop.addWriter(self.__fd, self.__writeReady)
+		self.__pending.append(data)
+
+	# private functions
+
+	def __cached(self, key):
+		value = self.revCache.get(key)
+		if value is None:
+			return None
+		future = Future(self.loop)
+		future.setResult(value)
+		return future
+
+	def __writeReady(self):
+		while self.__pending:
+			data = self.__pending.popleft()
+			try:
+				sent = self.__socket.send(data)
+			except socket.error as e:
+				self.__pending.appendleft(data)
+				if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+					self.__shutdown(IOError("Could not send request to server: "
+						+ str(e)))
+				return
+			if sent < len(data):
+				self.__pending.appendleft(data[sent:])
+				return
+		self.loop.removeWriter(self.__fd)
+
+	def __readReady(self):
+		received = []
+		while True:
+			try:
+				data = self.__socket.recv(AsyncConnector.RECV_SIZE)
+			except socket.error as e:
+				if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+					break
+				elif e.args[0] == errno.EINTR:
+					continue
+				self.__shutdown(IOError("Error while waiting for data from server: "
+					+ str(e)))
+				return
+			if not data:
+				if received and self._feed(''.join(received)):
+					self.__scheduleDispatch()
+				self.__shutdown(IOError("Connection closed by server"))
+				return
+			received.append(data)
+		if received and self._feed(''.join(received)):
+			self.__scheduleDispatch()
+
+	def __scheduleDispatch(self):
+		if not self.__dispatchScheduled:
+			self.__dispatchScheduled = True
+			self.loop.callSoon(self.__dispatch)
+
+	def __dispatch(self):
+		self.__dispatchScheduled = False
+		self._dispatchIndications()
+
+	def __shutdown(self, error):
+		if self.__error is not None:
+			return
+		self.__error = error
+		self.loop.removeReader(self.__fd)
+		self.loop.removeWriter(self.__fd)
+		self.__pending.clear()
+		self.__socket.close()
+		self._abort(error)
+
+
+class AsyncHandle(object):
+	# Number of READ_MSG requests that are in flight if the length of the
+	# read is not known
+	READ_AHEAD = 8
+
+	def __init__(self, connector, store, handle, doc, rev):
+		self.connector = connector
+		self.__store = store
+		self.handle = handle
+		self.doc = doc
+		self.rev = rev
+		self.active = True
+
+	def __del__(self):
+		if self.active:
+			self.close()
+
+	def getDoc(self):
+		return self.doc
+
+	def getRev(self):
+		return self.rev
+
+	def getStore(self):
+		return self.__store
+
+	def getData(self, selector):
+		return self.__rpc(_Protocol.GET_DATA_MSG,
+			connector._getDataReq(self.handle, selector),
+			lambda reply: loadPDSD(self.__store, self.__rawData(selector, reply)))
+
+	def getRawData(self, selector):
+		key = self.__dataCacheKey(selector)
+		raw = None if key is None else self.connector.revCache.get(key)
+		if raw is not None:
+			future = Future(self.connector.loop)
+			future.setResult(raw)
+			return future
+		return self.__rpc(_Protocol.GET_DATA_MSG,
+			connector._getDataReq(self.handle, selector),
+			lambda reply: self.__rawData(selector, reply))
+
+	def setData(self, selector, data):
+		return self.__rpc(_Protocol.SET_DATA_MSG,
+			connector._setDataReq(self.handle, selector, data))
+
+	# Reads 'length' bytes or up to the end of the part starting at 'offset'.
+	# All chunks of a known length are requested at once.
+	@coroutine
+	def read(self, part, offset=0, length=None):
+		packetSize = self.connector.maxPacketSize
+		chunks = []
+		while length is None or length > 0:
+			if length is None:
+				sizes = [packetSize] * AsyncHandle.READ_AHEAD
+			else:
+				sizes = [packetSize] * (length // packetSize)
+				if length % packetSize:
+					sizes.append(length % packetSize)
+			futures = []
+			for size in sizes:
+				futures.append(self.__rpc(_Protocol.READ_MSG,
+					connector._readReq(self.handle, part, offset, size),
+					connector._readCnf))
+				offset += size
+			result = yield gather(futures)
+			for (size, data) in zip(sizes, result):
+				chunks.append(data)
+				if len(data) < size:
+					raise Return(''.join(chunks))
+			if length is not None:
+				break
+		raise Return(''.join(chunks))
+
+	# Writes the data at 'offset'. The chunks are buffered by the server and
+	# committed every connector.Handle.WRITE_SEGMENT bytes.
+	def write(self, part, data, offset=0):
+		packetSize = self.connector.maxPacketSize
+		segmentSize = connector.Handle.WRITE_SEGMENT
+		futures = []
+		for segment in xrange(0, max(len(data), 1), segmentSize):
+			chunk = data[segment:segment+segmentSize]
+			end = len(chunk)
+			pos = 0
+			while end - pos > packetSize:
+				futures.append(self.__rpc(_Protocol.WRITE_BUFFER_MSG,
+					connector._writeBufferReq(self.handle, part,
+						chunk[pos:pos+packetSize])))
+				pos += packetSize
+			futures.append(self.__rpc(_Protocol.WRITE_COMMIT_MSG,
+				connector._writeCommitReq(self.handle, part, offset + segment,
+					chunk[pos:])))
+		return gather(futures)
+
+	def truncate(self, part, offset=0):
+		return self.__rpc(_Protocol.TRUNC_MSG,
+			connector._truncReq(self.handle, part, offset))
+
+	@coroutine
+	def writeAll(self, part, data):
+		yield self.truncate(part)
+		yield self.write(part, data)
+
+	def commit(self, comment=None):
+		return self.__rpc(_Protocol.COMMIT_MSG,
+			connector._commitReq(self.handle, comment), self.__committed)
+
+	def suspend(self, comment=None):
+		return self.__rpc(_Protocol.SUSPEND_MSG,
+			connector._suspendReq(self.handle, comment), self.__suspended)
+
+	def close(self):
+		if not self.active:
+			raise IOError('Handle expired')
+		self.active = False
+		return self.connector._rpc(_Protocol.CLOSE_MSG,
+			connector._closeReq(self.handle))
+
+	def stat(self):
+		if self.doc is None and self.rev is not None:
+			key = _revCacheKey('stat', self.rev, [self.__store])
+		else:
+			key = None
+		return self.__rpc(_Protocol.FSTAT_MSG, connector._fstatReq(self.handle),
+			connector._cacheReply(self.connector.revCache, key, connector._statCnf)
+				if key else connector._statCnf)
+
+	def setFlags(self, flags):
+		return self.__rpc(_Protocol.SET_FLAGS_MSG,
+			connector._setFlagsReq(self.handle, flags))
+
+	def setType(self, uti):
+		return self.__rpc(_Protocol.SET_TYPE_MSG,
+			connector._setTypeReq(self.handle, uti))
+
+	def setMTime(self, attachment, mtime):
+		return self.__rpc(_Protocol.SET_MTIME_MSG,
+			connector._setMTimeReq(self.handle, attachment, mtime))
+
+	def merge(self, store, rev, depth=None, verbose=False):
+		return self.__rpc(_Protocol.MERGE_MSG,
+			connector._mergeReq(self.handle, store, rev, depth, verbose))
+
+	def rebase(self, parent):
+		return self.__rpc(_Protocol.REBASE_MSG,
+			connector._rebaseReq(self.handle, parent))
+
+	def __rpc(self, msg, request, done=lambda x: x):
+		if not self.active:
+			future = Future(self.connector.loop)
+			future.setException(IOError('Handle expired'))
+			return future
+		return self.connector._rpc(msg, request, done)
+
+	def __dataCacheKey(self, selector):
+		if self.doc is None and self.rev is not None:
+			return ('data', self.__store, self.rev, selector)
+		else:
+			return None
+
+	def __rawData(self, selector, reply):
+		return connector._cacheRawData(self.connector.revCache,
+			self.__dataCacheKey(selector))(reply)
+
+	def __committed(self, reply):
+		self.rev = connector._commitCnf(reply)
+		return self.rev
+
+	def __suspended(self, reply):
+		self.rev = connector._suspendCnf(reply)
+		return self.rev
+
+
+class AsyncReplicateHandle(object):
+	def __init__(self, connector, handle):
+		self.connector = connector
+		self.handle = handle
+		self.active = True
+
+	def __del__(self):
+		if self.active:
+			self.close()
+
+	def close(self):
+		if not self.active:
+			raise IOError('Handle expired')
+		self.active = False
+		return self.connector._rpc(_Protocol.CLOSE_MSG,
+			connector._closeReq(self.handle))
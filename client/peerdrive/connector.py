@@ -18,9 +18,9 @@
 
 from __future__ import absolute_import
 
-from PyQt4 import QtCore, QtNetwork
 from datetime import datetime
-import sys, struct, atexit, weakref, traceback, os, os.path, json, time
+import sys, struct, atexit, weakref, traceback, os, os.path, json, time, io, collections
+import socket, select, errno, threading, contextlib
 from . import peerdrive_client_pb2 as pb
 
 if sys.platform == "win32":
@@ -231,7 +231,847 @@ def _raiseError(error):
 		raise IOError('Unknown error')
 
 
-class _Connector(QtCore.QObject):
+def _tryQueue(request, *args):
+	try:
+		return request(*args)
+	except IOError as e:
+		return e
+
+
+def _gather(pending):
+	result = {}
+	for (key, future) in pending:
+		if isinstance(future, IOError):
+			result[key] = future
+		else:
+			try:
+				result[key] = future.result()
+			except IOError as e:
+				result[key] = e
+	return result
+
+
+def _initReq(cookie):
+	req = pb.InitReq()
+	req.major = 2
+	req.minor = 0
+	req.cookie = cookie
+	return req.SerializeToString()
+
+
+# returns the maximum packet size of the server
+def _initCnf(reply):
+	cnf = pb.InitCnf.FromString(reply)
+	if cnf.major != 2 or cnf.minor != 0:
+		raise IOError("Unsupported protocol version!")
+	return cnf.max_packet_size
+
+
+def _enumCnf(reply):
+	return Enum(pb.EnumCnf.FromString(reply))
+
+
+def _lookupDocReq(doc, stores):
+	req = pb.LookupDocReq()
+	req.doc = _checkUuid(doc)
+	for store in stores:
+		req.stores.append(_checkUuid(store))
+	return req.SerializeToString()
+
+
+def _lookupDocCnf(reply):
+	return Lookup(pb.LookupDocCnf.FromString(reply))
+
+
+def _lookupRevReq(rev, stores):
+	req = pb.LookupRevReq()
+	req.rev = _checkUuid(rev)
+	for store in stores:
+		req.stores.append(_checkUuid(store))
+	return req.SerializeToString()
+
+
+def _lookupRevCnf(reply):
+	return pb.LookupRevCnf.FromString(reply).stores
+
+
+def _statReq(rev, stores):
+	req = pb.StatReq()
+	req.rev = _checkUuid(rev)
+	for store in stores:
+		req.stores.append(_checkUuid(store))
+	return req.SerializeToString()
+
+
+def _statCnf(reply):
+	return Stat(pb.StatCnf.FromString(reply))
+
+
+def _getLinksReq(rev, stores):
+	req = pb.GetLinksReq()
+	req.rev = _checkUuid(rev)
+	for store in stores:
+		req.stores.append(_checkUuid(store))
+	return req.SerializeToString()
+
+
+def _getLinksCnf(reply):
+	cnf = pb.GetLinksCnf.FromString(reply)
+	return (cnf.doc_links, cnf.rev_links)
+
+
+def _peekReq(store, rev):
+	req = pb.PeekReq()
+	req.store = _checkUuid(store)
+	req.rev = _checkUuid(rev)
+	return req.SerializeToString()
+
+
+def _peekCnf(connector, store, rev, reply):
+	cnf = pb.PeekCnf.FromString(reply)
+	return Handle(connector, store, cnf.handle, None, rev)
+
+
+def _getDataReq(handle, selector):
+	req = pb.GetDataReq()
+	req.handle = handle
+	req.selector = selector
+	return req.SerializeToString()
+
+
+def _getRawDataCnf(reply):
+	return pb.GetDataCnf.FromString(reply).data
+
+
+def _readReq(handle, part, offset, length):
+	req = pb.ReadReq()
+	req.handle = handle
+	req.part = part
+	req.offset = offset
+	req.length = length
+	return req.SerializeToString()
+
+
+def _readCnf(reply):
+	return pb.ReadCnf.FromString(reply).data
+
+
+def _writeBufferReq(handle, part, data):
+	req = pb.WriteBufferReq()
+	req.handle = handle
+	req.part = part
+	req.data = data
+	return req.SerializeToString()
+
+
+def _writeCommitReq(handle, part, offset, data):
+	req = pb.WriteCommitReq()
+	req.handle = handle
+	req.part = part
+	req.offset = offset
+	req.data = data
+	return req.SerializeToString()
+
+
+def _closeReq(handle):
+	req = pb.CloseReq()
+	req.handle = handle
+	return req.SerializeToString()
+
+
+def _createReq(store, typ, creator):
+	req = pb.CreateReq()
+	req.store = _checkUuid(store)
+	req.type_code = typ
+	req.creator_code = creator
+	return req.SerializeToString()
+
+
+def _createCnf(reply):
+	cnf = pb.CreateCnf.FromString(reply)
+	return (cnf.handle, cnf.doc)
+
+
+def _forkReq(store, rev, creator):
+	req = pb.ForkReq()
+	req.store = _checkUuid(store)
+	req.rev = _checkUuid(rev)
+	req.creator_code = creator
+	return req.SerializeToString()
+
+
+def _forkCnf(reply):
+	cnf = pb.ForkCnf.FromString(reply)
+	return (cnf.handle, cnf.doc)
+
+
+def _updateReq(store, doc, rev, creator):
+	req = pb.UpdateReq()
+	req.store = _checkUuid(store)
+	req.doc = _checkUuid(doc)
+	req.rev = _checkUuid(rev)
+	if creator is not None:
+		req.creator_code = creator
+	return req.SerializeToString()
+
+
+def _updateCnf(reply):
+	return pb.UpdateCnf.FromString(reply).handle
+
+
+def _resumeReq(store, doc, rev, creator):
+	req = pb.ResumeReq()
+	req.store = _checkUuid(store)
+	req.doc = _checkUuid(doc)
+	req.rev = _checkUuid(rev)
+	if creator is not None:
+		req.creator_code = creator
+	return req.SerializeToString()
+
+
+def _resumeCnf(reply):
+	return pb.ResumeCnf.FromString(reply).handle
+
+
+def _watchAddReq(typ, h):
+	req = pb.WatchAddReq()
+	req.type = typ
+	req.element = _checkUuid(h)
+	return req.SerializeToString()
+
+
+def _watchRemReq(typ, h):
+	req = pb.WatchRemReq()
+	req.type = typ
+	req.element = h
+	return req.SerializeToString()
+
+
+def _forgetReq(store, doc, rev):
+	req = pb.ForgetReq()
+	req.store = _checkUuid(store)
+	req.doc = _checkUuid(doc)
+	req.rev = _checkUuid(rev)
+	return req.SerializeToString()
+
+
+def _deleteDocReq(store, doc, rev):
+	req = pb.DeleteDocReq()
+	req.store = _checkUuid(store)
+	req.doc = _checkUuid(doc)
+	req.rev = _checkUuid(rev)
+	return req.SerializeToString()
+
+
+def _deleteRevReq(store, rev):
+	req = pb.DeleteRevReq()
+	req.store = _checkUuid(store)
+	req.rev = _checkUuid(rev)
+	return req.SerializeToString()
+
+
+def _forwardDocReq(store, doc, fromRev, toRev, srcStore, depth, verbose):
+	req = pb.ForwardDocReq()
+	req.store = _checkUuid(store)
+	req.doc = _checkUuid(doc)
+	req.from_rev = _checkUuid(fromRev)
+	req.to_rev = _checkUuid(toRev)
+	req.src_store = _checkUuid(srcStore)
+	if depth is not None:
+		req.depth = depth
+	if verbose: req.verbose = verbose
+	return req.SerializeToString()
+
+
+def _replicateDocReq(srcStore, doc, dstStore, depth, verbose):
+	req = pb.ReplicateDocReq()
+	req.src_store = _checkUuid(srcStore)
+	req.doc = _checkUuid(doc)
+	req.dst_store = _checkUuid(dstStore)
+	if depth is not None:
+		req.depth = depth
+	if verbose: req.verbose = verbose
+	return req.SerializeToString()
+
+
+def _replicateRevReq(srcStore, rev, dstStore, depth, verbose):
+	req = pb.ReplicateRevReq()
+	req.src_store = _checkUuid(srcStore)
+	req.rev = _checkUuid(rev)
+	req.dst_store = _checkUuid(dstStore)
+	if depth is not None:
+		req.depth = depth
+	if verbose: req.verbose = verbose
+	return req.SerializeToString()
+
+
+def _mountReq(src, label, type, options, credentials):
+	req = pb.MountReq()
+	req.src = src
+	req.label = label
+	req.type = type
+	if options is not None: req.options = options
+	if credentials is not None: req.credentials = credentials
+	return req.SerializeToString()
+
+
+def _unmountReq(sid):
+	req = pb.UnmountReq()
+	req.sid = sid
+	return req.SerializeToString()
+
+
+def _getPathReq(store, obj, isRev):
+	req = pb.GetPathReq()
+	req.store = _checkUuid(store)
+	req.object = _checkUuid(obj)
+	req.is_rev = isRev
+	return req.SerializeToString()
+
+
+def _getPathCnf(reply):
+	return pb.GetPathCnf.FromString(reply).path
+
+
+def _walkPathReq(path):
+	req = pb.WalkPathReq()
+	req.path = path
+	return req.SerializeToString()
+
+
+def _walkPathCnf(reply):
+	cnf = pb.WalkPathCnf.FromString(reply)
+	return [ (item.store, item.doc) for item in cnf.items ]
+
+
+def _watchProgressReq(enable):
+	req = pb.WatchProgressReq()
+	req.enable = enable
+	return req.SerializeToString()
+
+
+def _progressEndReq(tag, pause):
+	req = pb.ProgressEndReq()
+	req.tag = tag
+	req.pause = pause
+	return req.SerializeToString()
+
+
+def _progressStartReq(tag, skip):
+	req = pb.ProgressStartReq()
+	req.tag = tag
+	if skip is not None:
+		req.skip = skip
+	return req.SerializeToString()
+
+
+def _setDataReq(handle, selector, data):
+	req = pb.SetDataReq()
+	req.handle = handle
+	req.selector = selector
+	req.data = dumpPDSD(data)
+	return req.SerializeToString()
+
+
+def _truncReq(handle, part, offset):
+	req = pb.TruncReq()
+	req.handle = handle
+	req.part = part
+	req.offset = offset
+	return req.SerializeToString()
+
+
+def _commitReq(handle, comment):
+	req = pb.CommitReq()
+	req.handle = handle
+	if comment is not None: req.comment = comment
+	return req.SerializeToString()
+
+
+def _commitCnf(reply):
+	return pb.CommitCnf.FromString(reply).rev
+
+
+def _suspendReq(handle, comment):
+	req = pb.SuspendReq()
+	req.handle = handle
+	if comment is not None: req.comment = comment
+	return req.SerializeToString()
+
+
+def _suspendCnf(reply):
+	return pb.SuspendCnf.FromString(reply).rev
+
+
+def _fstatReq(handle):
+	req = pb.FStatReq()
+	req.handle = handle
+	return req.SerializeToString()
+
+
+def _setFlagsReq(handle, flags):
+	req = pb.SetFlagsReq()
+	req.handle = handle
+	req.flags = reduce(lambda x,y: x|y, [ 1 << f for f in flags ], 0)
+	return req.SerializeToString()
+
+
+def _setTypeReq(handle, uti):
+	req = pb.SetTypeReq()
+	req.handle = handle
+	req.type_code = uti
+	return req.SerializeToString()
+
+
+def _setMTimeReq(handle, attachment, mtime):
+	req = pb.SetMTimeReq()
+	req.handle = handle
+	req.attachment = attachment
+	req.mtime = mtime
+	return req.SerializeToString()
+
+
+def _mergeReq(handle, store, rev, depth, verbose):
+	req = pb.MergeReq()
+	req.handle = handle
+	req.store = _checkUuid(store)
+	req.rev = _checkUuid(rev)
+	if depth is not None:
+		req.depth = depth
+	if verbose: req.verbose = verbose
+	return req.SerializeToString()
+
+
+def _rebaseReq(handle, parent):
+	req = pb.RebaseReq()
+	req.handle = handle
+	req.rev = _checkUuid(parent)
+	return req.SerializeToString()
+
+
+# Receive buffer for the length prefixed packets from the server. Consumed
+# packets only advance the read offset instead of copying the remaining
+# buffer. The buffer is compacted when it was drained completely or when more
+# than half of it has been consumed. pop() does not keep a view on the buffer
+# so it may be fed again while a packet is processed.
+class _PacketBuffer(object):
+	__slots__ = ['__buf', '__pos']
+
+	COMPACT_THRESHOLD = 0x10000
+
+	def __init__(self):
+		self.__buf = bytearray()
+		self.__pos = 0
+
+	def __len__(self):
+		return len(self.__buf) - self.__pos
+
+	def feed(self, data):
+		self.__buf.extend(data)
+
+	# returns (ref, msg, payload) of the next complete packet or None
+	def pop(self):
+		buf = self.__buf
+		pos = self.__pos
+		if len(buf) - pos < 8:
+			return None
+		end = pos + 2 + struct.unpack_from('>H', buf, pos)[0]
+		if end > len(buf):
+			return None
+
+		(ref, msg) = struct.unpack_from('>LH', buf, pos+2)
+		payload = memoryview(buf)[pos+8:end].tobytes()
+		if end == len(buf):
+			del buf[:]
+			end = 0
+		elif end >= _PacketBuffer.COMPACT_THRESHOLD and end*2 >= len(buf):
+			del buf[:end]
+			end = 0
+		self.__pos = end
+		return (ref, msg, payload)
+
+
+# LRU cache of information about committed revisions: Stat objects, links and
+# the PDSD encoded data of (rev, selector) pairs. Revisions are immutable so
+# the entries are never invalidated, they are only evicted when the cached
+# server replies exceed the byte budget. A hit only replays a reply that the
+# server has given for the very same request, i.e. the store list is part of
+# the key. Data is kept encoded and is decoded on every hit because callers
+# are free to modify the returned structures. Note that a cached entry may
+# outlive the revision itself, e.g. after a garbage collection of the store.
+# Use clear() where this matters or a budget of zero to disable the cache.
+#
+# Optionally the raw replies are also kept in a persistent store that is
+# shared across processes, see _Connector.enableDiskCache(). It is consulted
+# on misses before going to the server.
+#
+# The cache may be shared by the connections of a ConnectionPool and is
+# therefore thread safe.
+class RevCache(object):
+	BUDGET = 0x800000
+
+	def __init__(self, budget=None):
+		self.__lock = threading.RLock()
+		self.__entries = collections.OrderedDict()
+		self.__budget = RevCache.BUDGET if budget is None else budget
+		self.persistent = None
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.diskHits = 0
+		self.evictions = 0
+
+	def __len__(self):
+		return len(self.__entries)
+
+	def __contains__(self, key):
+		return key in self.__entries
+
+	# returns None on a cache miss
+	def get(self, key):
+		with self.__lock:
+			return self.__get(key)
+
+	# The raw server reply is needed to store the entry persistently.
+	def put(self, key, value, size, raw=None):
+		with self.__lock:
+			if raw is not None and self.persistent is not None:
+				self.persistent.put(key, raw)
+			return self.__put(key, value, size)
+
+	def __get(self, key):
+		entry = self.__entries.pop(key, None)
+		if entry is None:
+			self.misses += 1
+			if self.persistent is not None:
+				raw = self.persistent.get(key)
+				if raw is not None:
+					self.diskHits += 1
+					return self.__put(key, _REV_CACHE_LOADERS[key[0]](raw),
+						len(raw))
+			return None
+		self.__entries[key] = entry
+		self.hits += 1
+		return entry[0]
+
+	def __put(self, key, value, size):
+		old = self.__entries.pop(key, None)
+		if old is not None:
+			self.size -= old[1]
+		if size <= self.__budget:
+			self.__entries[key] = (value, size)
+			self.size += size
+			self.__evict()
+		return value
+
+	def getBudget(self):
+		return self.__budget
+
+	def setBudget(self, budget):
+		with self.__lock:
+			self.__budget = budget
+			self.__evict()
+
+	def clear(self):
+		with self.__lock:
+			self.__entries.clear()
+			self.size = 0
+
+	def resetStats(self):
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __evict(self):
+		entries = self.__entries
+		while self.size > self.__budget:
+			(key, (value, size)) = entries.popitem(last=False)
+			self.size -= size
+			self.evictions += 1
+
+
+# Opt-in cache of lookupDoc() results, see _Connector.enableDocCache(). Every
+# cached document is watched and its entry is dropped on any indication for
+# it. This happens as soon as the indication is received and not only when
+# it is dispatched so that watch handlers never see stale lookups. Lookups
+# that were issued before an invalidation are not cached when they complete.
+# The least recently used documents are evicted when there are more than
+# 'size' of them. Their watches are removed at the same time.
+class DocCache(object):
+	SIZE = 1024
+
+	def __init__(self, connector, size=None):
+		self.__connector = connector
+		self.__size = DocCache.SIZE if size is None else size
+		# doc -> [watch, { stores : Lookup }, generation]
+		self.__entries = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __len__(self):
+		return len(self.__entries)
+
+	def __contains__(self, doc):
+		return doc in self.__entries
+
+	def lookupDoc(self, doc, stores):
+		key = tuple(sorted(stores))
+		lookup = self.__get(doc, key)
+		if lookup is None:
+			[entry] = self.__watch([doc])
+			generation = entry and entry[2]
+			lookup = self.__connector._rpc(_Connector.LOOKUP_DOC_MSG,
+				_lookupDocReq(doc, stores), done=_lookupDocCnf)
+			self.__put(doc, key, lookup, entry, generation)
+		return lookup
+
+	def lookupDocMany(self, docs, stores):
+		key = tuple(sorted(stores))
+		result = {}
+		missing = []
+		for doc in set(docs):
+			lookup = self.__get(doc, key)
+			if lookup is None:
+				missing.append(doc)
+			else:
+				result[doc] = lookup
+		if missing:
+			entries = self.__watch(missing)
+			generations = [ entry and entry[2] for entry in entries ]
+			with self.__connector.pipeline() as p:
+				pending = [ (doc, _tryQueue(p.lookupDoc, doc, stores))
+					for doc in missing ]
+			fetched = _gather(pending)
+			for (doc, entry, generation) in zip(missing, entries, generations):
+				lookup = fetched[doc]
+				if not isinstance(lookup, IOError):
+					self.__put(doc, key, lookup, entry, generation)
+			result.update(fetched)
+		return result
+
+	def invalidate(self, doc):
+		entry = self.__entries.get(doc)
+		if entry is not None:
+			entry[1] = {}
+			entry[2] += 1
+
+	def clear(self):
+		for entry in self.__entries.values():
+			entry[1] = {}
+			entry[2] += 1
+
+	def resize(self, size):
+		self.__size = size
+		self.__evict(set())
+
+	# removes all entries and their watches
+	def close(self):
+		self.__size = 0
+		self.__evict(set())
+
+	def _indication(self, packet):
+		ind = pb.WatchInd.FromString(packet)
+		if ind.type == Watch.TYPE_DOC:
+			self.invalidate(ind.element)
+
+	def __get(self, doc, key):
+		entry = self.__entries.pop(doc, None)
+		if entry is not None:
+			self.__entries[doc] = entry
+			lookup = entry[1].get(key)
+			if lookup is not None:
+				self.hits += 1
+				return lookup
+		self.misses += 1
+		return None
+
+	def __put(self, doc, key, lookup, entry, generation):
+		# the entry might have been evicted or invalidated in the meantime
+		if entry is not None and self.__entries.get(doc) is entry and \
+				entry[2] == generation:
+			entry[1][key] = lookup
+
+	# Makes sure that the docs have an entry and are watched. Returns None
+	# instead of the entry for docs that do not fit into the cache anymore.
+	# The docs have just been looked up by __get() and are thus at the end
+	# of the LRU order.
+	def __watch(self, docs):
+		entries = self.__entries
+		new = [ doc for doc in docs if doc not in entries ]
+		room = self.__size - (len(docs) - len(new))
+		new = new[:max(room, 0)]
+		self.__evict(set(docs), len(new))
+		watches = [ Watch(Watch.TYPE_DOC, doc) for doc in new ]
+		self.__connector._watchMany(watches)
+		for (doc, watch) in zip(new, watches):
+			entries[doc] = [watch, {}, 0]
+		return [ entries.get(doc) for doc in docs ]
+
+	def __evict(self, keep, reserve=0):
+		entries = self.__entries
+		evicted = []
+		while entries and len(entries) + reserve > self.__size:
+			doc = next(iter(entries))
+			if doc in keep:
+				break
+			evicted.append(entries.pop(doc)[0])
+		self.evictions += len(evicted)
+		for watch in evicted:
+			self.__connector.unwatch(watch)
+
+
+_REV_CACHE_LOADERS = {
+	'stat'  : _statCnf,
+	'links' : _getLinksCnf,
+	'data'  : lambda raw: raw,
+}
+
+
+def _revCacheKey(kind, rev, stores):
+	return (kind, rev, tuple(sorted(stores)))
+
+
+def _cacheReply(cache, key, done):
+	return lambda reply: cache.put(key, done(reply), len(reply), reply)
+
+
+def _cacheRawData(cache, key):
+	def done(reply):
+		raw = _getRawDataCnf(reply)
+		if key is not None:
+			cache.put(key, raw, len(raw), raw)
+		return raw
+	return done
+
+
+# Returns (host, port, cookie) of the server. Without an explicit address the
+# PEERDRIVE environment variable and the server.info files of the per-user
+# and the system daemon are tried in that order.
+def _serverAddress(address=None):
+	if not address:
+		# look into environment
+		address = os.getenv('PEERDRIVE')
+	if not address:
+		# look for per-user daemon
+		try:
+			if sys.platform == "win32":
+				with _winreg.OpenKey(_winreg.HKEY_CURRENT_USER, "Software\\Microsoft\\Windows\\CurrentVersion\\Explorer\\Shell Folders") as key:
+					path = _winreg.QueryValueEx(key, "Local AppData")[0]
+				path = os.path.join(path, "PeerDrive", "server.info")
+			else:
+				path = "/tmp/peerdrive-" + os.getenv('USER') + "/server.info"
+			with open(path, 'r') as f:
+				address = f.readline()
+		except IOError:
+			pass
+	if not address:
+		# look for system daemon
+		try:
+			if sys.platform == "win32":
+				with _winreg.OpenKey(_winreg.HKEY_LOCAL_MACHINE, "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Explorer\\Shell Folders") as key:
+					path = _winreg.QueryValueEx(key, "Common AppData")[0]
+				path = os.path.join(path, "PeerDrive", "server.info")
+			else:
+				path = "/var/run/peerdrive/server.info"
+			with open(path, 'r') as f:
+				address = f.readline()
+		except IOError:
+			pass
+
+	if not address:
+		raise IOError("Cannot find server!")
+	if not address.startswith("tcp://"):
+		raise IOError("Unknown address scheme: " + address)
+
+	(address, cookie) = address[6:].split("/")
+	(host, port) = address.split(':')
+	port = int(port)
+	cookie = cookie.strip().decode('hex')
+	return (host, port, cookie)
+
+
+# Connection to the server on top of the plain socket module. There is no
+# event loop that could notify about incoming data, so indications are only
+# dispatched when the client calls _Connector.process(). Qt applications use
+# the QtTransport instead, see _openTransport().
+class _SocketTransport(object):
+	RECV_SIZE = 0x10000
+
+	def __init__(self, host, port, readReady, dispatch):
+		try:
+			self.__socket = socket.create_connection((host, port), 1.0)
+			self.__socket.settimeout(None)
+			self.__socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		except socket.error:
+			raise IOError("Could not connect to server!")
+		self.__received = []
+		self.__error = ''
+
+	def write(self, data):
+		try:
+			self.__socket.sendall(data)
+		except socket.error as e:
+			raise IOError("Could not send request to server: " + str(e))
+
+	def flush(self):
+		pass
+
+	# timeout in milliseconds, -1 waits forever
+	def waitForReadyRead(self, timeout):
+		while True:
+			try:
+				if timeout >= 0:
+					(readable, w, x) = select.select([self.__socket], [], [],
+						timeout / 1000.0)
+					if not readable:
+						return False
+				data = self.__socket.recv(_SocketTransport.RECV_SIZE)
+				break
+			except (socket.error, select.error) as e:
+				if e.args[0] != errno.EINTR:
+					self.__error = str(e)
+					return False
+		if not data:
+			self.__error = "Connection closed by server"
+			return False
+		self.__received.append(data)
+		return True
+
+	def readAll(self):
+		data = ''.join(self.__received)
+		self.__received = []
+		return data
+
+	def errorString(self):
+		return self.__error
+
+	def deferDispatch(self):
+		pass
+
+	def close(self):
+		self.__socket.close()
+
+
+# Applications that use Qt get their indications delivered through the Qt
+# event loop. All others, e.g. command line tools, do not even load Qt.
+# Connections that are used by other threads than the Qt main thread must
+# not use Qt, see ConnectionPool.
+def _openTransport(host, port, readReady, dispatch, qt=True):
+	if qt and 'PyQt4.QtCore' in sys.modules:
+		from .qttransport import QtTransport
+		return QtTransport(host, port, readReady, dispatch)
+	else:
+		return _SocketTransport(host, port, readReady, dispatch)
+
+
+# The wire protocol of the client interface without any I/O: the framing of
+# the packets, the references of the requests, the confirmations of the
+# outstanding requests and the dispatching of indications to the watch and
+# progress handlers. It is shared by the blocking _Connector and the event
+# loop based aio.AsyncConnector. Subclasses send the framed packets in
+# _write() and pass all received data to _feed().
+class _Protocol(object):
 	ERROR_MSG           = 0x0000
 	INIT_MSG            = 0x0001
 	ENUM_MSG            = 0x0002
@@ -291,178 +1131,362 @@ class _Connector(QtCore.QObject):
 	PROGRESS_REP_DOC = pb.ProgressStartInd.rep_doc
 	PROGRESS_REP_REV = pb.ProgressStartInd.rep_rev
 
-	watchReady = QtCore.pyqtSignal()
-
-	def __init__(self, address=None):
-		super(_Connector, self).__init__()
-
-		if not address:
-			# look into environment
-			address = os.getenv('PEERDRIVE')
-		if not address:
-			# look for per-user daemon
-			try:
-				if sys.platform == "win32":
-					with _winreg.OpenKey(_winreg.HKEY_CURRENT_USER, "Software\\Microsoft\\Windows\\CurrentVersion\\Explorer\\Shell Folders") as key:
-						path = _winreg.QueryValueEx(key, "Local AppData")[0]
-					path = os.path.join(path, "PeerDrive", "server.info")
-				else:
-					path = "/tmp/peerdrive-" + os.getenv('USER') + "/server.info"
-				with open(path, 'r') as f:
-					address = f.readline()
-			except IOError:
-				pass
-		if not address:
-			# look for system daemon
-			try:
-				if sys.platform == "win32":
-					with _winreg.OpenKey(_winreg.HKEY_LOCAL_MACHINE, "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Explorer\\Shell Folders") as key:
-						path = _winreg.QueryValueEx(key, "Common AppData")[0]
-					path = os.path.join(path, "PeerDrive", "server.info")
-				else:
-					path = "/var/run/peerdrive/server.info"
-				with open(path, 'r') as f:
-					address = f.readline()
-			except IOError:
-				pass
-
-		if not address:
-			raise IOError("Cannot find server!")
-		if not address.startswith("tcp://"):
-			raise IOError("Unknown address scheme: " + address)
-
-		(address, cookie) = address[6:].split("/")
-		(host, port) = address.split(':')
-		port = int(port)
-		cookie = cookie.strip().decode('hex')
-
-		self.socket = QtNetwork.QTcpSocket()
-		self.socket.readyRead.connect(self.__readReady)
-		self.socket.connectToHost(host, port)
-		if not self.socket.waitForConnected(1000):
-			raise IOError("Could not connect to server!")
-		self.socket.setSocketOption(QtNetwork.QAbstractSocket.LowDelayOption, 1)
+	def __init__(self):
 		self.next = 0
-		self.buf = ''
+		self.buf = _PacketBuffer()
 		self.confirmations = {}
 		self.indications = []
 		self.watchHandlers = {}
 		self.progressHandlers = []
-		self.recursion = 0
+		self.docCache = None
+
+	def _write(self, data):
+		raise NotImplementedError()
+
+	# Sends the request. The completion is notified by setResult(cnf, reply)
+	# when the confirmation arrives.
+	def _request(self, msg, request, completion):
+		ref = self.next
+		self.next += 1
+		self.confirmations[ref] = completion
+		packet = struct.pack('>LH', ref, (msg << 4) | _Protocol.FLAG_REQ) + request
+		self._write(struct.pack('>H', len(packet)) + packet)
+
+	# Unpacks the received data and completes the confirmed requests.
+	# Indications are queued until _dispatchIndications() is called. Returns
+	# True if new indications were queued.
+	def _feed(self, data):
+		indications = False
+		self.buf.feed(data)
+		while True:
+			packet = self.buf.pop()
+			if packet is None:
+				break
+
+			# immediately remove indications
+			(ref, msg, payload) = packet
+			typ = msg & 3
+			msg = msg >> 4
+			if typ == _Protocol.FLAG_IND:
+				indications = True
+				self.indications.append((msg, payload))
+				if msg == _Protocol.WATCH_MSG and self.docCache is not None:
+					self.docCache._indication(payload)
+			elif typ == _Protocol.FLAG_CNF:
+				self.confirmations.pop(ref).setResult(msg, payload)
+		return indications
+
+	# Fails all outstanding requests, e.g. when the connection was lost.
+	def _abort(self, error):
+		confirmations = self.confirmations
+		self.confirmations = {}
+		for completion in confirmations.values():
+			completion.setError(error)
+
+	def _dispatchIndications(self):
+		dispatched = True
+		while dispatched:
+			dispatched = False
+			indications = self.indications[:]
+			self.indications = []
+			for (msg, packet) in indications:
+				dispatched = True
+				if msg == _Protocol.WATCH_MSG:
+					ind = pb.WatchInd.FromString(packet)
+					# make explicit copy as watches may get modified by callouts!
+					matches = self.watchHandlers.get((ind.type, ind.element), [])[:]
+					for i in matches:
+						i = i() # dereference weakref
+						if i is not None:
+							i.triggered(ind.event, ind.store)
+				elif msg == _Protocol.PROGRESS_START_MSG:
+					ind = pb.ProgressStartInd.FromString(packet)
+					handlers = [h for (e,h) in self.progressHandlers if e == msg]
+					self._dispatchProgressStart(ind, handlers)
+				elif msg == _Protocol.PROGRESS_MSG:
+					ind = pb.ProgressInd.FromString(packet)
+					handlers = [h for (e,h) in self.progressHandlers if e == msg]
+					self._dispatchProgress(ind, handlers)
+				elif msg == _Protocol.PROGRESS_END_MSG:
+					ind = pb.ProgressEndInd.FromString(packet)
+					handlers = self.progressHandlers[:]
+					for (event, handler) in handlers:
+						if event == msg:
+							handler(ind.tag)
+
+	def _dispatchProgressStart(self, ind, handlers):
+		for handler in handlers:
+			if ind.HasField('item'):
+				handler(ind.tag, ind.type, ind.source, ind.dest, ind.item)
+			else:
+				handler(ind.tag, ind.type, ind.source, ind.dest)
+
+	def _dispatchProgress(self, ind, handlers):
+		kwargs = {}
+		if ind.HasField('err_code'): kwargs['err_code'] = (ind.err_code, _errorCodes.get(ind.err_code, 'unknown'))
+		if ind.HasField('err_doc'): kwargs['err_doc'] = ind.err_doc
+		if ind.HasField('err_rev'): kwargs['err_rev'] = ind.err_rev
+		for handler in handlers:
+			handler(ind.tag, ind.state, ind.progress, **kwargs)
+
 
-		self.watchReady.connect(self.__dispatchIndications, QtCore.Qt.QueuedConnection)
+class _Connector(_Protocol):
+
+	def __init__(self, address=None, qt=True):
+		(host, port, cookie) = _serverAddress(address)
+		_Protocol.__init__(self)
+		self.transport = _openTransport(host, port, self.__readReady,
+			self.__dispatchIndications, qt)
+		self.recursion = 0
+		self.revCache = RevCache()
 
 		try:
-			req = pb.InitReq()
-			req.major = 2
-			req.minor = 0
-			req.cookie = cookie
-			reply = self._rpc(_Connector.INIT_MSG, req.SerializeToString())
-			cnf = pb.InitCnf.FromString(reply)
-			if cnf.major != 2 or cnf.minor != 0:
-				raise IOError("Unsupported protocol version!")
-			self.maxPacketSize = cnf.max_packet_size
+			self.maxPacketSize = self._rpc(_Connector.INIT_MSG,
+				_initReq(cookie), done=_initCnf)
 		except:
-			self.socket.disconnectFromHost()
+			self.transport.close()
 			raise
 
 	def enum(self):
-		reply = pb.EnumCnf.FromString(self._rpc(_Connector.ENUM_MSG))
-		return Enum(reply)
+		return self._rpc(_Connector.ENUM_MSG, done=_enumCnf)
 
 	def lookupDoc(self, doc, stores=[]):
-		req = pb.LookupDocReq()
-		req.doc = _checkUuid(doc)
-		for store in stores:
-			req.stores.append(_checkUuid(store))
-		reply = self._rpc(_Connector.LOOKUP_DOC_MSG, req.SerializeToString())
-		return Lookup(pb.LookupDocCnf.FromString(reply))
+		if self.docCache is not None:
+			return self.docCache.lookupDoc(doc, stores)
+		return self._rpc(_Connector.LOOKUP_DOC_MSG, _lookupDocReq(doc, stores),
+			done=_lookupDocCnf)
 
 	def lookupRev(self, rev, stores=[]):
-		req = pb.LookupRevReq()
-		req.rev = _checkUuid(rev)
-		for store in stores:
-			req.stores.append(_checkUuid(store))
-		reply = self._rpc(_Connector.LOOKUP_REV_MSG, req.SerializeToString())
-		return pb.LookupRevCnf.FromString(reply).stores
+		return self._rpc(_Connector.LOOKUP_REV_MSG, _lookupRevReq(rev, stores),
+			done=_lookupRevCnf)
 
 	def stat(self, rev, stores=[]):
-		req = pb.StatReq()
-		req.rev = _checkUuid(rev)
-		for store in stores:
-			req.stores.append(_checkUuid(store))
-		reply = self._rpc(_Connector.STAT_MSG, req.SerializeToString())
-		return Stat(pb.StatCnf.FromString(reply))
+		key = _revCacheKey('stat', rev, stores)
+		return self.revCache.get(key) or self._rpc(_Connector.STAT_MSG,
+			_statReq(rev, stores),
+			done=_cacheReply(self.revCache, key, _statCnf))
 
 	def getLinks(self, rev, stores=[]):
-		req = pb.GetLinksReq()
-		req.rev = _checkUuid(rev)
-		for store in stores:
-			req.stores.append(_checkUuid(store))
-		reply = self._rpc(_Connector.GET_LINKS_MSG, req.SerializeToString())
-		cnf = pb.GetLinksCnf.FromString(reply)
-		return (cnf.doc_links, cnf.rev_links)
+		key = _revCacheKey('links', rev, stores)
+		return self.revCache.get(key) or self._rpc(_Connector.GET_LINKS_MSG,
+			_getLinksReq(rev, stores),
+			done=_cacheReply(self.revCache, key, _getLinksCnf))
 
 	def peek(self, store, rev):
-		req = pb.PeekReq()
-		req.store = _checkUuid(store)
-		req.rev = _checkUuid(rev)
-		reply = self._rpc(_Connector.PEEK_MSG, req.SerializeToString())
-		cnf = pb.PeekCnf.FromString(reply)
-		return Handle(self, store, cnf.handle, None, rev)
+		return self._rpc(_Connector.PEEK_MSG, _peekReq(store, rev),
+			done=lambda reply: _peekCnf(self, store, rev, reply))
+
+	def pipeline(self):
+		return Pipeline(self)
+
+	# Bulk queries. The result is a dict keyed by the requested item. Failed
+	# items map to the IOError that was raised for them instead of aborting
+	# the whole batch.
+
+	def lookupDocMany(self, docs, stores=[]):
+		if self.docCache is not None:
+			return self.docCache.lookupDocMany(docs, stores)
+		with self.pipeline() as p:
+			pending = [ (doc, _tryQueue(p.lookupDoc, doc, stores))
+				for doc in set(docs) ]
+		return _gather(pending)
+
+	def statMany(self, revs, stores=[]):
+		result = {}
+		pending = []
+		with self.pipeline() as p:
+			for rev in set(revs):
+				stat = self.revCache.get(_revCacheKey('stat', rev, stores))
+				if stat is None:
+					pending.append((rev, _tryQueue(p.stat, rev, stores)))
+				else:
+					result[rev] = stat
+		result.update(_gather(pending))
+		return result
+
+	# With raw=True the undecoded PDSD strings are returned, see
+	# loadLazyPDSD() and selectPDSD().
+	def getDataMany(self, items, raw=False):
+		result = {}
+		missing = set()
+		for item in set(items):
+			data = self.revCache.get(('data',) + item)
+			if data is None:
+				missing.add(item)
+			elif raw:
+				result[item] = data
+			else:
+				result[item] = loadPDSD(item[0], data)
+		items = missing
+		with self.pipeline() as p:
+			peeks = [ ((store, rev), _tryQueue(p.peek, store, rev))
+				for (store, rev) in set([ (s, r) for (s, r, sel) in items ]) ]
+		handles = _gather(peeks)
+		try:
+			with self.pipeline() as p:
+				pending = []
+				for (store, rev, selector) in items:
+					handle = handles[(store, rev)]
+					if isinstance(handle, IOError):
+						pending.append(((store, rev, selector), handle))
+					else:
+						if raw:
+							future = p.getRawData(handle, selector)
+						else:
+							future = p.getData(handle, selector)
+						pending.append(((store, rev, selector), future))
+				for handle in handles.values():
+					if not isinstance(handle, IOError):
+						p.close(handle)
+		finally:
+			for handle in handles.values():
+				if not isinstance(handle, IOError) and handle.active:
+					handle.close()
+		result.update(_gather(pending))
+		return result
 
 	def create(self, store, typ, creator):
-		req = pb.CreateReq()
-		req.store = _checkUuid(store)
-		req.type_code = typ
-		req.creator_code = creator
-		reply = self._rpc(_Connector.CREATE_MSG, req.SerializeToString())
-		cnf = pb.CreateCnf.FromString(reply)
-		return Handle(self, store, cnf.handle, cnf.doc, None)
+		(handle, doc) = self._rpc(_Connector.CREATE_MSG,
+			_createReq(store, typ, creator), done=_createCnf)
+		return Handle(self, store, handle, doc, None)
 
 	def fork(self, store, rev, creator):
-		req = pb.ForkReq()
-		req.store = _checkUuid(store)
-		req.rev = _checkUuid(rev)
-		req.creator_code = creator
-		reply = self._rpc(_Connector.FORK_MSG, req.SerializeToString())
-		cnf = pb.ForkCnf.FromString(reply)
-		return Handle(self, store, cnf.handle, cnf.doc, rev)
+		(handle, doc) = self._rpc(_Connector.FORK_MSG,
+			_forkReq(store, rev, creator), done=_forkCnf)
+		return Handle(self, store, handle, doc, rev)
 
 	def update(self, store, doc, rev, creator=None):
-		req = pb.UpdateReq()
-		req.store = _checkUuid(store)
-		req.doc = _checkUuid(doc)
-		req.rev = _checkUuid(rev)
-		if creator is not None:
-			req.creator_code = creator
-		reply = self._rpc(_Connector.UPDATE_MSG, req.SerializeToString())
-		cnf = pb.UpdateCnf.FromString(reply)
-		return Handle(self, store, cnf.handle, doc, rev)
+		handle = self._rpc(_Connector.UPDATE_MSG,
+			_updateReq(store, doc, rev, creator), done=_updateCnf)
+		return Handle(self, store, handle, doc, rev)
 
 	def resume(self, store, doc, rev, creator=None):
-		req = pb.ResumeReq()
-		req.store = _checkUuid(store)
-		req.doc = _checkUuid(doc)
-		req.rev = _checkUuid(rev)
-		if creator is not None:
-			req.creator_code = creator
-		reply = self._rpc(_Connector.RESUME_MSG, req.SerializeToString())
-		cnf = pb.ResumeCnf.FromString(reply)
-		return Handle(self, store, cnf.handle, doc, rev)
+		handle = self._rpc(_Connector.RESUME_MSG,
+			_resumeReq(store, doc, rev, creator), done=_resumeCnf)
+		return Handle(self, store, handle, doc, rev)
+
+	# Caches the results of lookupDoc() and lookupDocMany() for up to 'size'
+	# documents. The cached documents are watched to keep the cache
+	# coherent, see DocCache.
+	def enableDocCache(self, size=None):
+		if self.docCache is None:
+			self.docCache = DocCache(self, size)
+		elif size is not None:
+			self.docCache.resize(size)
+		return self.docCache
+
+	def disableDocCache(self):
+		if self.docCache is not None:
+			self.docCache.close()
+			self.docCache = None
+
+	# Keeps the revision cache also in a database under settingsPath() that
+	# is shared by all client processes, see DiskCache.
+	def enableDiskCache(self, path=None, budget=None):
+		if self.revCache.persistent is None:
+			from .diskcache import DiskCache
+			self.revCache.persistent = DiskCache(path, budget)
+			atexit.register(self.disableDiskCache)
+		return self.revCache.persistent
+
+	def disableDiskCache(self):
+		if self.revCache.persistent is not None:
+			self.revCache.persistent.close()
+			self.revCache.persistent = None
+
+	# Compares all entries of the persistent cache with the server. Returns
+	# the keys of the entries that differ or could not be fetched anymore.
+	# These are removed from the cache if 'repair' is set.
+	def verifyDiskCache(self, repair=True, batch=256):
+		cache = self.revCache.persistent
+		entries = list(cache.entries())
+		invalid = []
+		for i in xrange(0, len(entries), batch):
+			chunk = entries[i:i+batch]
+			fresh = self.__fetchRevCacheEntries([ key for (key, value) in chunk ])
+			invalid.extend([ key for (key, value) in chunk if fresh[key] != value ])
+		if repair and invalid:
+			cache.delete(invalid)
+			self.revCache.clear()
+		return invalid
+
+	# Fetches the raw replies for the given RevCache keys bypassing the
+	# cache. Keys that cannot be fetched map to None.
+	def __fetchRevCacheEntries(self, keys):
+		requests = []
+		peeks = set()
+		for key in keys:
+			if key[0] == 'stat':
+				requests.append((key, _Connector.STAT_MSG, _statReq(key[1], key[2])))
+			elif key[0] == 'links':
+				requests.append((key, _Connector.GET_LINKS_MSG,
+					_getLinksReq(key[1], key[2])))
+			else:
+				peeks.add(key[1:3])
+		requests.extend([ (peek, _Connector.PEEK_MSG, _peekReq(*peek))
+			for peek in peeks ])
+		result = self.__fetchRaw(requests)
+
+		handles = {}
+		for peek in peeks:
+			reply = result.pop(peek)
+			if reply is not None:
+				handles[peek] = pb.PeekCnf.FromString(reply).handle
+		requests = [ (key, _Connector.GET_DATA_MSG,
+			_getDataReq(handles[key[1:3]], key[3])) for key in keys
+			if key[0] == 'data' and key[1:3] in handles ]
+		requests.extend([ (('close', handle), _Connector.CLOSE_MSG,
+			_closeReq(handle)) for handle in handles.values() ])
+		data = self.__fetchRaw(requests)
+		for key in keys:
+			if key[0] == 'data':
+				reply = data.get(key)
+				result[key] = reply and _getRawDataCnf(reply)
+		return result
+
+	def __fetchRaw(self, requests):
+		pending = [ (key, msg, self._queue(msg, req)) for (key, msg, req)
+			in requests ]
+		self._wait([ completion for (key, msg, completion) in pending ])
+		result = {}
+		for (key, msg, completion) in pending:
+			try:
+				result[key] = _Connector._result(msg, completion, lambda x: x)
+			except IOError:
+				result[key] = None
+		return result
 
 	def watch(self, w):
-		if w._incWatchRef() == 1:
-			(typ, h) = ref = w._getRef()
-			if ref not in self.watchHandlers:
-				req = pb.WatchAddReq()
-				req.type = typ
-				req.element = _checkUuid(h)
-				self._rpc(_Connector.WATCH_ADD_MSG, req.SerializeToString())
-				self.watchHandlers[ref] = []
-			tb = None #traceback.extract_stack()
-			self.watchHandlers[ref].append(weakref.ref(w,
-				lambda r, ref=ref, tb=tb: self.__delWatch(r, ref, tb)))
+		self._watchMany([w])
+
+	# registers many watches with a single round trip to the server
+	def _watchMany(self, watches):
+		pending = []
+		for w in watches:
+			if w._incWatchRef() == 1:
+				(typ, h) = ref = w._getRef()
+				if ref not in self.watchHandlers:
+					pending.append((w, ref, self._queue(_Connector.WATCH_ADD_MSG,
+						_watchAddReq(typ, h))))
+					self.watchHandlers[ref] = []
+				tb = None #traceback.extract_stack()
+				self.watchHandlers[ref].append(weakref.ref(w,
+					lambda r, ref=ref, tb=tb: self.__delWatch(r, ref, tb)))
+		error = None
+		for (w, ref, completion) in pending:
+			try:
+				self.__poll(completion)
+				_Connector._result(_Connector.WATCH_ADD_MSG, completion,
+					lambda x: x)
+			except IOError as e:
+				# the watch was not added, drop the references of all its users
+				for r in self.watchHandlers.pop(ref, []):
+					r = r()
+					if r is not None:
+						r._decWatchRef()
+				error = error or e
+		if error:
+			raise error
 
 	def __delWatch(self, watchObjRef, watchSpec, tb):
 		if tb:
@@ -472,10 +1496,7 @@ class _Connector(QtCore.QObject):
 		self.watchHandlers[watchSpec].remove(watchObjRef)
 		if self.watchHandlers[watchSpec] == []:
 			(typ, h) = watchSpec
-			req = pb.WatchRemReq()
-			req.type = typ
-			req.element = h
-			self._rpc(_Connector.WATCH_REM_MSG, req.SerializeToString())
+			self._rpc(_Connector.WATCH_REM_MSG, _watchRemReq(typ, h))
 			del self.watchHandlers[watchSpec]
 
 	def unwatch(self, w):
@@ -484,70 +1505,40 @@ class _Connector(QtCore.QObject):
 			oldHandlers = self.watchHandlers[ref]
 			newHandlers = [x for x in oldHandlers if x() != w]
 			if newHandlers == []:
-				req = pb.WatchRemReq()
-				req.type = typ
-				req.element = h
-				self._rpc(_Connector.WATCH_REM_MSG, req.SerializeToString())
+				self._rpc(_Connector.WATCH_REM_MSG, _watchRemReq(typ, h))
 				del self.watchHandlers[ref]
 			else:
 				self.watchHandlers[ref] = newHandlers
 
 	def forget(self, store, doc, rev):
-		req = pb.ForgetReq()
-		req.store = _checkUuid(store)
-		req.doc = _checkUuid(doc)
-		req.rev = _checkUuid(rev)
-		self._rpc(_Connector.FORGET_MSG, req.SerializeToString())
+		self._rpc(_Connector.FORGET_MSG, _forgetReq(store, doc, rev))
+		self._docChanged(doc)
 
 	def deleteDoc(self, store, doc, rev):
-		req = pb.DeleteDocReq()
-		req.store = _checkUuid(store)
-		req.doc = _checkUuid(doc)
-		req.rev = _checkUuid(rev)
-		self._rpc(_Connector.DELETE_DOC_MSG, req.SerializeToString())
+		self._rpc(_Connector.DELETE_DOC_MSG, _deleteDocReq(store, doc, rev))
+		self._docChanged(doc)
 
 	def deleteRev(self, store, rev):
-		req = pb.DeleteRevReq()
-		req.store = _checkUuid(store)
-		req.rev = _checkUuid(rev)
-		self._rpc(_Connector.DELETE_REV_MSG, req.SerializeToString())
+		self._rpc(_Connector.DELETE_REV_MSG, _deleteRevReq(store, rev))
 
 	def forwardDoc(self, store, doc, fromRev, toRev, srcStore, depth=None, verbose=False):
-		req = pb.ForwardDocReq()
-		req.store = _checkUuid(store)
-		req.doc = _checkUuid(doc)
-		req.from_rev = _checkUuid(fromRev)
-		req.to_rev = _checkUuid(toRev)
-		req.src_store = _checkUuid(srcStore)
-		if depth is not None:
-			req.depth = depth
-		if verbose: req.verbose = verbose
-		self._rpc(_Connector.FORWARD_DOC_MSG, req.SerializeToString())
+		self._rpc(_Connector.FORWARD_DOC_MSG, _forwardDocReq(store, doc,
+			fromRev, toRev, srcStore, depth, verbose))
+		self._docChanged(doc)
 
 	def replicateDoc(self, srcStore, doc, dstStore, depth=None, verbose=False, async=None):
-		req = pb.ReplicateDocReq()
-		req.src_store = _checkUuid(srcStore)
-		req.doc = _checkUuid(doc)
-		req.dst_store = _checkUuid(dstStore)
-		if depth is not None:
-			req.depth = depth
-		if verbose: req.verbose = verbose
-		return self._rpc(_Connector.REPLICATE_DOC_MSG, req.SerializeToString(),
-			async, self.__replicateDocDone)
-
-	def __replicateDocDone(self, reply):
+		return self._rpc(_Connector.REPLICATE_DOC_MSG,
+			_replicateDocReq(srcStore, doc, dstStore, depth, verbose),
+			async, lambda reply: self.__replicateDocDone(doc, reply))
+
+	def __replicateDocDone(self, doc, reply):
 		cnf = pb.ReplicateDocCnf.FromString(reply)
+		self._docChanged(doc)
 		return ReplicateHandle(self, cnf.handle)
 
 	def replicateRev(self, srcStore, rev, dstStore, depth=None, verbose=False, async=None):
-		req = pb.ReplicateRevReq()
-		req.src_store = _checkUuid(srcStore)
-		req.rev = _checkUuid(rev)
-		req.dst_store = _checkUuid(dstStore)
-		if depth is not None:
-			req.depth = depth
-		if verbose: req.verbose = verbose
-		return self._rpc(_Connector.REPLICATE_REV_MSG, req.SerializeToString(),
+		return self._rpc(_Connector.REPLICATE_REV_MSG,
+			_replicateRevReq(srcStore, rev, dstStore, depth, verbose),
 			async, self.__replicateRevDone)
 
 	def __replicateRevDone(self, reply):
@@ -555,52 +1546,35 @@ class _Connector(QtCore.QObject):
 		return ReplicateHandle(self, cnf.handle)
 
 	def mount(self, src, label, type, options=None, credentials=None):
-		req = pb.MountReq()
-		req.src = src
-		req.label = label
-		req.type = type
-		if options is not None: req.options = options
-		if credentials is not None: req.credentials = credentials
-		reply = self._rpc(_Connector.MOUNT_MSG, req.SerializeToString())
-		cnf = pb.MountCnf.FromString(reply)
-		return cnf.sid
+		return self._rpc(_Connector.MOUNT_MSG,
+			_mountReq(src, label, type, options, credentials),
+			done=lambda reply: pb.MountCnf.FromString(reply).sid)
 
 	def unmount(self, sid):
-		req = pb.UnmountReq()
-		req.sid = sid
-		self._rpc(_Connector.UNMOUNT_MSG, req.SerializeToString())
+		self._rpc(_Connector.UNMOUNT_MSG, _unmountReq(sid))
 
 	def getDocPath(self, store, doc):
-		req = pb.GetPathReq()
-		req.store = _checkUuid(store)
-		req.object = _checkUuid(doc)
-		req.is_rev = False
-		reply = self._rpc(_Connector.GET_PATH_MSG, req.SerializeToString())
-		cnf = pb.GetPathCnf.FromString(reply)
-		return cnf.path
+		return self._rpc(_Connector.GET_PATH_MSG,
+			_getPathReq(store, doc, False), done=_getPathCnf)
 
 	def getRevPath(self, store, rev):
-		req = pb.GetPathReq()
-		req.store = _checkUuid(store)
-		req.object = _checkUuid(rev)
-		req.is_rev = True
-		reply = self._rpc(_Connector.GET_PATH_MSG, req.SerializeToString())
-		cnf = pb.GetPathCnf.FromString(reply)
-		return cnf.path
+		return self._rpc(_Connector.GET_PATH_MSG,
+			_getPathReq(store, rev, True), done=_getPathCnf)
 
 	def walkPath(self, path):
-		req = pb.WalkPathReq()
-		req.path = path
-		reply = self._rpc(_Connector.WALK_PATH_MSG, req.SerializeToString())
-		cnf = pb.WalkPathCnf.FromString(reply)
-		return [ (item.store, item.doc) for item in cnf.items ]
+		return self._rpc(_Connector.WALK_PATH_MSG, _walkPathReq(path),
+			done=_walkPathCnf)
 
 	def flush(self):
-		while self.socket.flush():
-			self.socket.waitForBytesWritten(10000)
+		self.transport.flush()
+
+	def close(self):
+		self.transport.close()
 
+	# Waits up to 'timeout' milliseconds for incoming data and dispatches all
+	# pending indications.
 	def process(self, timeout=1):
-		if self.socket.waitForReadyRead(timeout):
+		if self.transport.waitForReadyRead(timeout):
 			self.__readReady()
 		self.__dispatchIndications()
 
@@ -610,19 +1584,17 @@ class _Connector(QtCore.QObject):
 		if start:
 			self.__regProgressHandler(_Connector.PROGRESS_START_MSG, start)
 			for item in cnf.items:
-				self.__dispatchProgressStart(item.item, [start])
+				self._dispatchProgressStart(item.item, [start])
 		if progress:
 			self.__regProgressHandler(_Connector.PROGRESS_MSG, progress)
 			for item in cnf.items:
-				self.__dispatchProgress(item.state, [progress])
+				self._dispatchProgress(item.state, [progress])
 		if stop:
 			self.__regProgressHandler(_Connector.PROGRESS_END_MSG, stop)
 
 	def __regProgressHandler(self, event, handler):
 		if len(self.progressHandlers) == 0:
-			req = pb.WatchProgressReq()
-			req.enable = True
-			self._rpc(_Connector.WATCH_PROGRESS_MSG, req.SerializeToString())
+			self._rpc(_Connector.WATCH_PROGRESS_MSG, _watchProgressReq(True))
 		self.progressHandlers.append((event, handler))
 
 	def unregProgressHandler(self, start=None, progress=None, stop=None):
@@ -636,28 +1608,16 @@ class _Connector(QtCore.QObject):
 	def __unregProgressHandler(self, event, handler):
 		self.progressHandlers.remove((event, handler))
 		if len(self.progressHandlers) == 0:
-			req = pb.WatchProgressReq()
-			req.enable = False
-			self._rpc(_Connector.WATCH_PROGRESS_MSG, req.SerializeToString())
+			self._rpc(_Connector.WATCH_PROGRESS_MSG, _watchProgressReq(False))
 
 	def progressPause(self, tag):
-		req = pb.ProgressEndReq()
-		req.tag = tag
-		req.pause = True
-		self._rpc(_Connector.PROGRESS_END_MSG, req.SerializeToString())
+		self._rpc(_Connector.PROGRESS_END_MSG, _progressEndReq(tag, True))
 
 	def progressStop(self, tag):
-		req = pb.ProgressEndReq()
-		req.tag = tag
-		req.pause = False
-		self._rpc(_Connector.PROGRESS_END_MSG, req.SerializeToString())
+		self._rpc(_Connector.PROGRESS_END_MSG, _progressEndReq(tag, False))
 
 	def progressResume(self, tag, skip=None):
-		req = pb.ProgressStartReq()
-		req.tag = tag
-		if skip is not None:
-			req.skip = skip
-		self._rpc(_Connector.PROGRESS_START_MSG, req.SerializeToString())
+		self._rpc(_Connector.PROGRESS_START_MSG, _progressStartReq(tag, skip))
 
 	# protected functions
 
@@ -673,6 +1633,9 @@ class _Connector(QtCore.QObject):
 			self.reply = reply
 			self.pending = False
 
+		def setError(self, error):
+			self.setResult(_Connector.ERROR_MSG, error)
+
 	class _AsyncCompletion(object):
 		__slots__ = ['__callback', '__msg', '__done']
 		def __init__(self, msg, callback, done):
@@ -687,129 +1650,79 @@ class _Connector(QtCore.QObject):
 				error_cnf = pb.ErrorCnf.FromString(reply)
 				self.__callback(IOError(_errorCodes[error_cnf.error]))
 
+		def setError(self, error):
+			self.__callback(error)
+
+	# The watch indications of changes that were made through this
+	# connection might arrive after the confirmation. Drop the cached lookup
+	# right away so that the change is visible immediately.
+	def _docChanged(self, doc):
+		if self.docCache is not None:
+			self.docCache.invalidate(doc)
+
 	def _rpc(self, msg, request = '', async=None, done=lambda x: x):
-		ref = self.__make_ref()
-		req_msg = (msg << 4) | _Connector.FLAG_REQ
 		if async:
 			completion = _Connector._AsyncCompletion(msg, async, done)
 		else:
 			completion = _Connector._PollCompletion()
-		self.confirmations[ref] = completion
-		self.__send(struct.pack('>LH', ref, req_msg) + request)
+		self._request(msg, request, completion)
 		if not async:
 			start = time.time()
 			self.__poll(completion)
 			end = time.time()
 			#print "RPC sync:", _requestNames[msg], int((end-start)*1000000)
-			if completion.cnf == msg:
-				return done(completion.reply)
-			elif completion.cnf == _Connector.ERROR_MSG:
-				error_cnf = pb.ErrorCnf.FromString(completion.reply)
-				_raiseError(error_cnf.error)
-			else:
-				raise IOError("Invalid server reply!")
+			return _Connector._result(msg, completion, done)
+
+	def _queue(self, msg, request = ''):
+		# send the request but do not wait for the confirmation
+		completion = _Connector._PollCompletion()
+		self._request(msg, request, completion)
+		return completion
+
+	def _wait(self, completions):
+		for completion in completions:
+			self.__poll(completion)
+
+	@staticmethod
+	def _result(msg, completion, done):
+		if completion.cnf == msg:
+			return done(completion.reply)
+		elif isinstance(completion.reply, IOError):
+			raise completion.reply
+		elif completion.cnf == _Connector.ERROR_MSG:
+			error_cnf = pb.ErrorCnf.FromString(completion.reply)
+			_raiseError(error_cnf.error)
+		else:
+			raise IOError("Invalid server reply!")
 
 	# private functions
 
-	def __send(self, packet):
-		raw = struct.pack('>H', len(packet)) + packet
-		if self.socket.write(raw) == -1:
-			raise IOError("Could not send request to server: "
-				+ str(self.socket.errorString()))
+	def _write(self, data):
+		self.transport.write(data)
 
 	def __readReady(self):
-		# unpack incoming packets
-		indications = False
-		self.buf = self.buf + str(self.socket.readAll())
-		while len(self.buf) > 2:
-			expect = struct.unpack_from('>H', self.buf, 0)[0] + 2
-			if expect <= len(self.buf):
-				packet = self.buf[2:expect]
-				self.buf = self.buf[expect:]
-
-				# immediately remove indications
-				(ref, msg) = struct.unpack_from('>LH', packet, 0)
-				typ = msg & 3
-				msg = msg >> 4
-				if typ == _Connector.FLAG_IND:
-					indications = True
-					self.indications.append((msg, packet[6:]))
-				elif typ == _Connector.FLAG_CNF:
-					self.confirmations[ref].setResult(msg, packet[6:])
-					del self.confirmations[ref]
-			else:
-				break
-
-		if indications:
+		if self._feed(self.transport.readAll()):
 			self.__dispatchIndications()
 
 	def __dispatchIndications(self):
 		# dispatch received indications if not in recursion
 		if self.recursion == 0:
-			dispatched = True
-			while dispatched:
-				dispatched = False
-				indications = self.indications[:]
-				self.indications = []
-				for (msg, packet) in indications:
-					dispatched = True
-					if msg == _Connector.WATCH_MSG:
-						ind = pb.WatchInd.FromString(packet)
-						# make explicit copy as watches may get modified by callouts!
-						matches = self.watchHandlers.get((ind.type, ind.element), [])[:]
-						for i in matches:
-							i = i() # dereference weakref
-							if i is not None:
-								i.triggered(ind.event, ind.store)
-					elif msg == _Connector.PROGRESS_START_MSG:
-						ind = pb.ProgressStartInd.FromString(packet)
-						handlers = [h for (e,h) in self.progressHandlers if e == msg]
-						self.__dispatchProgressStart(ind, handlers)
-					elif msg == _Connector.PROGRESS_MSG:
-						ind = pb.ProgressInd.FromString(packet)
-						handlers = [h for (e,h) in self.progressHandlers if e == msg]
-						self.__dispatchProgress(ind, handlers)
-					elif msg == _Connector.PROGRESS_END_MSG:
-						ind = pb.ProgressEndInd.FromString(packet)
-						handlers = self.progressHandlers[:]
-						for (event, handler) in handlers:
-							if event == msg:
-								handler(ind.tag)
+			self._dispatchIndications()
 		else:
-			self.watchReady.emit()
-
-	def __dispatchProgressStart(self, ind, handlers):
-		for handler in handlers:
-			if ind.HasField('item'):
-				handler(ind.tag, ind.type, ind.source, ind.dest, ind.item)
-			else:
-				handler(ind.tag, ind.type, ind.source, ind.dest)
-
-	def __dispatchProgress(self, ind, handlers):
-		kwargs = {}
-		if ind.HasField('err_code'): kwargs['err_code'] = (ind.err_code, _errorCodes.get(ind.err_code, 'unknown'))
-		if ind.HasField('err_doc'): kwargs['err_doc'] = ind.err_doc
-		if ind.HasField('err_rev'): kwargs['err_rev'] = ind.err_rev
-		for handler in handlers:
-			handler(ind.tag, ind.state, ind.progress, **kwargs)
+			self.transport.deferDispatch()
 
 	def __poll(self, completion):
 		self.recursion += 1
 		try:
 			# loop until we've received the answer
 			while completion.pending:
-				if not self.socket.waitForReadyRead(-1):
+				if not self.transport.waitForReadyRead(-1):
 					raise IOError("Error while waiting for data from server: "
-						+ str(self.socket.errorString()))
+						+ self.transport.errorString())
 				self.__readReady()
 		finally:
 			self.recursion -= 1
 
-	def __make_ref(self):
-		ref = self.next
-		self.next += 1
-		return ref
-
 
 class Watch(object):
 	EVENT_MODIFIED    = pb.WatchInd.modified
@@ -1011,6 +1924,17 @@ class Stat(object):
 
 
 class Handle(object):
+	# Number of READ_MSG requests that are kept in flight by iterRead(). The
+	# window starts at READ_AHEAD and is doubled up to READ_AHEAD_MAX as long
+	# as the throughput keeps improving.
+	READ_AHEAD = 2
+	READ_AHEAD_MAX = 64
+
+	# Maximum number of unconfirmed write requests and the amount of data
+	# that is buffered by the server before it is committed to the part.
+	WRITE_WINDOW = 64
+	WRITE_SEGMENT = 0x100000
+
 	def __init__(self, connector, store, handle, doc, rev):
 		self.__pos = { }
 		self.connector = connector
@@ -1019,6 +1943,8 @@ class Handle(object):
 		self.doc = doc
 		self.rev = rev
 		self.active = True
+		self.__readAhead = (Handle.READ_AHEAD, Handle.READ_AHEAD_MAX)
+		self.__writeWindow = Handle.WRITE_WINDOW
 
 	def __enter__(self):
 		return self
@@ -1042,19 +1968,30 @@ class Handle(object):
 		self.__pos[part] = pos
 
 	def getData(self, selector):
-		req = pb.GetDataReq()
-		req.handle = self.handle
-		req.selector = selector
-		reply = self.connector._rpc(_Connector.GET_DATA_MSG, req.SerializeToString())
-		data = pb.GetDataCnf.FromString(reply).data
-		return loadPDSD(self.__store, data)
+		return loadPDSD(self.__store, self.getRawData(selector))
+
+	# returns the PDSD encoded data without decoding it
+	def getRawData(self, selector):
+		key = self._dataCacheKey(selector)
+		cache = self.connector.revCache
+		raw = None if key is None else cache.get(key)
+		if raw is None:
+			raw = self.connector._rpc(_Connector.GET_DATA_MSG,
+				_getDataReq(self.handle, selector),
+				done=_cacheRawData(cache, key))
+		return raw
+
+	# Only handles from peek() are bound to an immutable revision. The data
+	# of all other handles may change until they are committed.
+	def _dataCacheKey(self, selector):
+		if self.doc is None and self.rev is not None:
+			return ('data', self.__store, self.rev, selector)
+		else:
+			return None
 
 	def setData(self, selector, data):
-		req = pb.SetDataReq()
-		req.handle = self.handle
-		req.selector = selector
-		req.data = dumpPDSD(data)
-		reply = self.connector._rpc(_Connector.SET_DATA_MSG, req.SerializeToString())
+		self.connector._rpc(_Connector.SET_DATA_MSG,
+			_setDataReq(self.handle, selector, data))
 
 	def seek(self, part, offset, whence = 0):
 		if whence == 0:
@@ -1071,40 +2008,94 @@ class Handle(object):
 	def read(self, part, length):
 		if not self.active:
 			raise IOError('Handle expired')
-		result = ''
+		return ''.join(self.iterRead(part, length))
+
+	# Configure the read-ahead window of this handle. A window of 1 disables
+	# read-ahead. If maxWindow is greater than window the window grows while
+	# the throughput improves.
+	def setReadAhead(self, window, maxWindow=None):
+		if window < 1:
+			raise ValueError('Invalid read-ahead window')
+		if maxWindow is None or maxWindow < window:
+			maxWindow = window
+		self.__readAhead = (window, maxWindow)
+
+	# Generator that reads the part from the current position in chunks of at
+	# most maxPacketSize bytes until 'length' bytes were read or the end of
+	# the part is reached. The position is advanced with every chunk. Up to
+	# the read-ahead window chunks are requested before waiting for the
+	# first reply.
+	def iterRead(self, part, length=None):
+		if not self.active:
+			raise IOError('Handle expired')
 		pos = self._getPos(part)
 		packetSize = self.connector.maxPacketSize
-		while length > 0:
-			if length > packetSize:
-				chunk = packetSize
-			else:
-				chunk = length
-			req = pb.ReadReq()
-			req.handle = self.handle
-			req.part = part
-			req.offset = pos
-			req.length = chunk
-			reply = self.connector._rpc(_Connector.READ_MSG, req.SerializeToString())
-			data = pb.ReadCnf.FromString(reply).data
+		(window, maxWindow) = self.__readAhead
+		pending = collections.deque()
+		reqPos = pos
+		remaining = length
+		epochStart = time.time()
+		epochSize = 0
+		epochCount = 0
+		lastRate = 0.0
+		while True:
+			# keep the window filled
+			while len(pending) < window and (remaining is None or remaining > 0):
+				if (remaining is None) or (remaining > packetSize):
+					chunk = packetSize
+				else:
+					chunk = remaining
+				completion = self.connector._queue(_Connector.READ_MSG,
+					_readReq(self.handle, part, reqPos, chunk))
+				pending.append((chunk, completion))
+				reqPos += chunk
+				if remaining is not None:
+					remaining -= chunk
+			if not pending:
+				break
+
+			# Replies of requests beyond the end of the part are dropped
+			# when they arrive.
+			(chunk, completion) = pending.popleft()
+			self.connector._wait([completion])
+			data = _Connector._result(_Connector.READ_MSG, completion, _readCnf)
 			size = len(data)
-			result = result + data
 			pos = pos + size
+			self._setPos(part, pos)
+			if size > 0:
+				yield data
 			if size < chunk:
 				break
-		self._setPos(part, pos)
-		return result
+
+			# grow the window while it pays off
+			epochSize += size
+			epochCount += 1
+			if epochCount >= window and window < maxWindow:
+				now = time.time()
+				rate = epochSize / max(now - epochStart, 1e-6)
+				if rate > lastRate * 1.1:
+					window = min(window * 2, maxWindow)
+				lastRate = rate
+				epochStart = now
+				epochSize = 0
+				epochCount = 0
+
+	# Read into a preallocated writable buffer (e.g. a bytearray) from the
+	# current position. Returns the number of bytes read.
+	def readinto(self, part, buf):
+		view = memoryview(buf)
+		done = 0
+		for data in self.iterRead(part, len(view)):
+			size = len(data)
+			view[done:done+size] = data
+			done += size
+		return done
 
 	def readAll(self, part):
-		result = ''
 		oldPos = self._getPos(part)
 		try:
 			self._setPos(part, 0)
-			while True:
-				chunk = self.read(part, 0x20000)
-				result = result + chunk
-				if len(chunk) < 0x20000:
-					break
-			return result
+			return ''.join(self.iterRead(part))
 		finally:
 			self._setPos(part, oldPos)
 
@@ -1112,26 +2103,94 @@ class Handle(object):
 		if not self.active:
 			raise IOError('Handle expired')
 
-		pos = self._getPos(part)
-		i = 0
-		length = len(data)
 		packetSize = self.connector.maxPacketSize
-		while length > i+packetSize:
-			req = pb.WriteBufferReq()
-			req.handle = self.handle
-			req.part = part
-			req.data = data[i:i+packetSize]
-			self.connector._rpc(_Connector.WRITE_BUFFER_MSG, req.SerializeToString())
-			i += packetSize
-
-		req = pb.WriteCommitReq()
-		req.handle = self.handle
-		req.part = part
-		req.offset = pos
-		req.data = data[i:i+packetSize]
-		self.connector._rpc(_Connector.WRITE_COMMIT_MSG, req.SerializeToString())
-
-		self._setPos(part, pos+length)
+		chunks = (data[i:i+packetSize] for i in xrange(0, len(data), packetSize))
+		self.__writeChunks(part, chunks)
+
+	# Stream the content of a file object into the part, starting at the
+	# current position. Only a few packets are held in memory at any time.
+	# Returns the number of bytes written.
+	def writeFrom(self, part, fileobj):
+		if not self.active:
+			raise IOError('Handle expired')
+
+		packetSize = self.connector.maxPacketSize
+		chunks = iter(lambda: fileobj.read(packetSize), '')
+		return self.__writeChunks(part, chunks)
+
+	# Encode a structure as PDSD and stream it into the part, starting at the
+	# current position. The structure is encoded incrementally, hence only a
+	# few packets are held in memory. Returns the number of bytes written.
+	def writePDSD(self, part, data):
+		if not self.active:
+			raise IOError('Handle expired')
+
+		chunks = iterDumpPDSD(data, self.connector.maxPacketSize)
+		return self.__writeChunks(part, chunks)
+
+	# Limit the number of unconfirmed write requests of this handle.
+	def setWriteWindow(self, window):
+		if window < 1:
+			raise ValueError('Invalid write window')
+		self.__writeWindow = window
+
+	# The chunks are sent as WRITE_BUFFER_MSG without waiting for the
+	# confirmations. Every WRITE_SEGMENT bytes and at the end a
+	# WRITE_COMMIT_MSG writes the buffered data to the part. At most
+	# __writeWindow requests are unconfirmed and errors are raised when the
+	# confirmations are collected, at the latest after the final commit.
+	def __writeChunks(self, part, chunks):
+		start = pos = segment = self._getPos(part)
+		pending = collections.deque()
+		try:
+			cur = next(chunks, '')
+			while cur is not None:
+				try:
+					nxt = next(chunks, None)
+				except:
+					# don't leave a half filled write buffer behind
+					self.__queueWrite(pending, _Connector.WRITE_COMMIT_MSG,
+						_writeCommitReq(self.handle, part, segment, cur))
+					pos += len(cur)
+					raise
+				size = len(cur)
+				if (nxt is None) or (pos + size - segment >= Handle.WRITE_SEGMENT):
+					self.__queueWrite(pending, _Connector.WRITE_COMMIT_MSG,
+						_writeCommitReq(self.handle, part, segment, cur))
+					segment = pos + size
+				else:
+					self.__queueWrite(pending, _Connector.WRITE_BUFFER_MSG,
+						_writeBufferReq(self.handle, part, cur))
+				pos += size
+				cur = nxt
+		except:
+			# the original error takes precedence over errors of the server
+			info = sys.exc_info()
+			self._setPos(part, pos)
+			try:
+				self.__waitWrites(pending, 0)
+			except IOError:
+				pass
+			raise info[0], info[1], info[2]
+		self._setPos(part, pos)
+		self.__waitWrites(pending, 0)
+		return pos - start
+
+	def __queueWrite(self, pending, msg, request):
+		self.__waitWrites(pending, self.__writeWindow - 1)
+		pending.append((msg, self.connector._queue(msg, request)))
+
+	def __waitWrites(self, pending, maxPending):
+		error = None
+		while len(pending) > maxPending:
+			(msg, completion) = pending.popleft()
+			self.connector._wait([completion])
+			try:
+				_Connector._result(msg, completion, lambda x: x)
+			except IOError as e:
+				error = error or e
+		if error:
+			raise error
 
 	def writeAll(self, part, data):
 		self._setPos(part, 0)
@@ -1141,94 +2200,73 @@ class Handle(object):
 	def truncate(self, part):
 		if not self.active:
 			raise IOError('Handle expired')
-		req = pb.TruncReq()
-		req.handle = self.handle
-		req.part = part
-		req.offset = self._getPos(part)
-		self.connector._rpc(_Connector.TRUNC_MSG, req.SerializeToString())
+		self.connector._rpc(_Connector.TRUNC_MSG,
+			_truncReq(self.handle, part, self._getPos(part)))
 
 	def commit(self, comment=None):
 		if not self.active:
 			raise IOError('Handle expired')
-		req = pb.CommitReq()
-		req.handle = self.handle
-		if comment is not None: req.comment = comment
-		reply = self.connector._rpc(_Connector.COMMIT_MSG, req.SerializeToString())
-		cnf = pb.CommitCnf.FromString(reply)
-		self.rev = cnf.rev
+		self.rev = self.connector._rpc(_Connector.COMMIT_MSG,
+			_commitReq(self.handle, comment), done=_commitCnf)
+		self.connector._docChanged(self.doc)
 
 	def suspend(self, comment=None):
 		if not self.active:
 			raise IOError('Handle expired')
-		req = pb.SuspendReq()
-		req.handle = self.handle
-		if comment is not None: req.comment = comment
-		reply = self.connector._rpc(_Connector.SUSPEND_MSG, req.SerializeToString())
-		cnf = pb.SuspendCnf.FromString(reply)
-		self.rev = cnf.rev
+		self.rev = self.connector._rpc(_Connector.SUSPEND_MSG,
+			_suspendReq(self.handle, comment), done=_suspendCnf)
+		self.connector._docChanged(self.doc)
 
 	def close(self):
 		if self.active:
 			self.active = False
-			req = pb.CloseReq()
-			req.handle = self.handle
-			self.connector._rpc(_Connector.CLOSE_MSG, req.SerializeToString())
+			self.connector._rpc(_Connector.CLOSE_MSG, _closeReq(self.handle))
 		else:
 			raise IOError('Handle expired')
 
 	def stat(self):
 		if not self.active:
 			raise IOError('Handle expired')
-		req = pb.FStatReq()
-		req.handle = self.handle
-		reply = self.connector._rpc(_Connector.FSTAT_MSG, req.SerializeToString())
-		return Stat(pb.StatCnf.FromString(reply))
+		if self.doc is None:
+			key = _revCacheKey('stat', self.rev, [self.__store])
+			stat = self.connector.revCache.get(key)
+			if stat is not None:
+				return stat
+		reply = self.connector._rpc(_Connector.FSTAT_MSG, _fstatReq(self.handle))
+		stat = Stat(pb.StatCnf.FromString(reply))
+		if self.doc is None:
+			self.connector.revCache.put(key, stat, len(reply), reply)
+		return stat
 
 	def setFlags(self, flags):
 		if not self.active:
 			raise IOError('Handle expired')
-		flags = reduce(lambda x,y: x|y, [ 1 << f for f in flags ], 0)
-		req = pb.SetFlagsReq()
-		req.handle = self.handle
-		req.flags = flags
-		self.connector._rpc(_Connector.SET_FLAGS_MSG, req.SerializeToString())
+		self.connector._rpc(_Connector.SET_FLAGS_MSG,
+			_setFlagsReq(self.handle, flags))
 
 	def setType(self, uti):
 		if not self.active:
 			raise IOError('Handle expired')
-		req = pb.SetTypeReq()
-		req.handle = self.handle
-		req.type_code = uti
-		self.connector._rpc(_Connector.SET_TYPE_MSG, req.SerializeToString())
+		self.connector._rpc(_Connector.SET_TYPE_MSG,
+			_setTypeReq(self.handle, uti))
 
 	def setMTime(self, attachment, mtime):
 		if not self.active:
 			raise IOError('Handle expired')
-		req = pb.SetMTimeReq()
-		req.handle = self.handle
-		req.attachment = attachment
-		req.mtime = mtime
-		self.connector._rpc(_Connector.SET_MTIME_MSG, req.SerializeToString())
+		self.connector._rpc(_Connector.SET_MTIME_MSG,
+			_setMTimeReq(self.handle, attachment, mtime))
 
 	def merge(self, store, rev, depth=None, verbose=False):
 		if not self.active:
 			raise IOError('Handle expired')
-		req = pb.MergeReq()
-		req.handle = self.handle
-		req.store = _checkUuid(store)
-		req.rev = _checkUuid(rev)
-		if depth is not None:
-			req.depth = depth
-		if verbose: req.verbose = verbose
-		self.connector._rpc(_Connector.MERGE_MSG, req.SerializeToString())
+		self.connector._rpc(_Connector.MERGE_MSG,
+			_mergeReq(self.handle, store, rev, depth, verbose))
 
 	def rebase(self, parent):
 		if not self.active:
 			raise IOError('Handle expired')
-		req = pb.RebaseReq()
-		req.handle = self.handle
-		req.rev = _checkUuid(parent)
-		self.connector._rpc(_Connector.REBASE_MSG, req.SerializeToString())
+		self.connector._rpc(_Connector.REBASE_MSG,
+			_rebaseReq(self.handle, parent))
 
 	def getDoc(self):
 		return self.doc
@@ -1239,6 +2277,56 @@ class Handle(object):
 	def getStore(self):
 		return self.__store
 
+# Read-only file object for one part of a Handle. It keeps its own position
+# so it does not interfere with other users of the handle. Closing the reader
+# does not close the handle.
+#
+#	with Connector().peek(store, rev) as r:
+#		shutil.copyfileobj(PartReader(r, '_'), f)
+class PartReader(io.RawIOBase):
+	def __init__(self, handle, part):
+		super(PartReader, self).__init__()
+		self.__handle = handle
+		self.__part = part
+		self.__pos = 0
+
+	def readable(self):
+		return True
+
+	def seekable(self):
+		return True
+
+	def tell(self):
+		return self.__pos
+
+	def seek(self, offset, whence=io.SEEK_SET):
+		if whence == io.SEEK_SET:
+			pos = offset
+		elif whence == io.SEEK_CUR:
+			pos = self.__pos + offset
+		elif whence == io.SEEK_END:
+			pos = self.__handle.stat().size(self.__part) + offset
+		else:
+			raise IOError('Invalid whence')
+		if pos < 0:
+			raise IOError('Negative seek position')
+		self.__pos = pos
+		return pos
+
+	def readinto(self, b):
+		if self.closed:
+			raise ValueError('I/O operation on closed file')
+		handle = self.__handle
+		oldPos = handle.tell(self.__part)
+		try:
+			handle.seek(self.__part, self.__pos)
+			size = handle.readinto(self.__part, b)
+		finally:
+			handle.seek(self.__part, oldPos)
+		self.__pos += size
+		return size
+
+
 class ReplicateHandle(object):
 	def __init__(self, connector, handle):
 		self.connector = connector
@@ -1260,12 +2348,269 @@ class ReplicateHandle(object):
 	def close(self):
 		if self.active:
 			self.active = False
-			req = pb.CloseReq()
-			req.handle = self.handle
-			self.connector._rpc(_Connector.CLOSE_MSG, req.SerializeToString())
+			self.connector._rpc(_Connector.CLOSE_MSG, _closeReq(self.handle))
 		else:
 			raise IOError('Handle expired')
 
+
+# Pending result of a request that was issued through a Pipeline. Calling
+# result() waits for the confirmation and raises IOError on server errors.
+class Future(object):
+	__slots__ = ['__connector', '__msg', '__completion', '__done']
+
+	def __init__(self, connector, msg, completion, done):
+		self.__connector = connector
+		self.__msg = msg
+		self.__completion = completion
+		self.__done = done
+
+	def _completion(self):
+		return self.__completion
+
+	def ready(self):
+		return not self.__completion.pending
+
+	def result(self):
+		if self.__completion.pending:
+			self.__connector._wait([self.__completion])
+		return _Connector._result(self.__msg, self.__completion, self.__done)
+
+
+# Sends many requests back-to-back without waiting for the individual
+# replies. Each request method returns a Future immediately. All outstanding
+# confirmations are gathered in one read loop by wait() or when leaving the
+# 'with' block:
+#
+#	with Connector().pipeline() as p:
+#		stats = [ (rev, p.stat(rev)) for rev in revs ]
+#	for (rev, stat) in stats:
+#		print stat.result().type()
+#
+# Handles returned by peek() must be fetched through result() and closed.
+class Pipeline(object):
+
+	def __init__(self, connector):
+		self.__connector = connector
+		self.__futures = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.wait()
+		return False
+
+	def __queue(self, msg, request, done=lambda x: x):
+		completion = self.__connector._queue(msg, request)
+		future = Future(self.__connector, msg, completion, done)
+		self.__futures.append(future)
+		return future
+
+	def wait(self):
+		futures = self.__futures
+		self.__futures = []
+		self.__connector._wait([f._completion() for f in futures])
+
+	def lookupDoc(self, doc, stores=[]):
+		return self.__queue(_Connector.LOOKUP_DOC_MSG,
+			_lookupDocReq(doc, stores), _lookupDocCnf)
+
+	def lookupRev(self, rev, stores=[]):
+		return self.__queue(_Connector.LOOKUP_REV_MSG,
+			_lookupRevReq(rev, stores), _lookupRevCnf)
+
+	def stat(self, rev, stores=[]):
+		return self.__queue(_Connector.STAT_MSG, _statReq(rev, stores),
+			_cacheReply(self.__connector.revCache,
+				_revCacheKey('stat', rev, stores), _statCnf))
+
+	def getLinks(self, rev, stores=[]):
+		return self.__queue(_Connector.GET_LINKS_MSG,
+			_getLinksReq(rev, stores),
+			_cacheReply(self.__connector.revCache,
+				_revCacheKey('links', rev, stores), _getLinksCnf))
+
+	def peek(self, store, rev):
+		connector = self.__connector
+		return self.__queue(_Connector.PEEK_MSG, _peekReq(store, rev),
+			lambda reply: _peekCnf(connector, store, rev, reply))
+
+	def getData(self, handle, selector):
+		store = handle.getStore()
+		done = _cacheRawData(self.__connector.revCache,
+			handle._dataCacheKey(selector))
+		return self.__queue(_Connector.GET_DATA_MSG,
+			_getDataReq(handle.handle, selector),
+			lambda reply: loadPDSD(store, done(reply)))
+
+	def getRawData(self, handle, selector):
+		return self.__queue(_Connector.GET_DATA_MSG,
+			_getDataReq(handle.handle, selector),
+			_cacheRawData(self.__connector.revCache,
+				handle._dataCacheKey(selector)))
+
+	def close(self, handle):
+		if not handle.active:
+			raise IOError('Handle expired')
+		handle.active = False
+		return self.__queue(_Connector.CLOSE_MSG, _closeReq(handle.handle))
+
+
+# Connection of a ConnectionPool. All access to the socket and the protocol
+# state is serialized by 'lock'. The confirmations are matched by their
+# reference, hence threads may still interleave their requests: whoever
+# holds the lock reads all replies and completes the requests of the others.
+class _PooledConnector(_Connector):
+
+	def __init__(self, address=None):
+		self.lock = threading.RLock()
+		self.users = 0
+		self.requests = 0
+		self.peakInFlight = 0
+		_Connector.__init__(self, address, False)
+
+	def _request(self, msg, request, completion):
+		_Connector._request(self, msg, request, completion)
+		self.requests += 1
+		self.peakInFlight = max(self.peakInFlight, len(self.confirmations))
+
+	def _rpc(self, msg, request = '', async=None, done=lambda x: x):
+		with self.lock:
+			return _Connector._rpc(self, msg, request, async, done)
+
+	def _queue(self, msg, request = ''):
+		with self.lock:
+			return _Connector._queue(self, msg, request)
+
+	def _wait(self, completions):
+		with self.lock:
+			_Connector._wait(self, completions)
+
+	def _watchMany(self, watches):
+		with self.lock:
+			_Connector._watchMany(self, watches)
+
+	def unwatch(self, w):
+		with self.lock:
+			_Connector.unwatch(self, w)
+
+	def process(self, timeout=1):
+		with self.lock:
+			_Connector.process(self, timeout)
+
+
+# A fixed number of connections that may be used concurrently by many
+# threads. Each request is routed to the connection with the fewest users,
+# preferably an idle one. Handles stay on the connection that opened them.
+# Watches and progress handlers are registered on a single designated
+# connection which is opened on first use. Its indications are dispatched
+# by process(), in the calling thread.
+#
+#	pool = ConnectionPool(4)
+#	with pool.create(store, 'public.data', '') as w: # in any thread
+#		w.writeAll('_', data)
+#		w.commit()
+#
+# Use connection() to keep one connection for a sequence of calls, e.g. for
+# a Pipeline. All connections share one RevCache.
+class ConnectionPool(object):
+
+	def __init__(self, size=4, address=None):
+		if size < 1:
+			raise ValueError('Invalid pool size')
+		self.__address = address
+		self.__lock = threading.Lock()
+		self.__watcher = None
+		self.__connections = []
+		self.revCache = RevCache()
+		try:
+			for i in xrange(size):
+				c = _PooledConnector(address)
+				c.revCache = self.revCache
+				self.__connections.append(c)
+		except:
+			self.close()
+			raise
+
+	def __len__(self):
+		return len(self.__connections)
+
+	@contextlib.contextmanager
+	def connection(self):
+		with self.__lock:
+			c = min(self.__connections,
+				key=lambda c: (c.users, len(c.confirmations)))
+			c.users += 1
+		try:
+			yield c
+		finally:
+			with self.__lock:
+				c.users -= 1
+
+	def watcher(self):
+		with self.__lock:
+			if self.__watcher is None:
+				self.__watcher = _PooledConnector(self.__address)
+			return self.__watcher
+
+	def watch(self, w):
+		self.watcher().watch(w)
+
+	def unwatch(self, w):
+		self.watcher().unwatch(w)
+
+	def process(self, timeout=1):
+		self.watcher().process(timeout)
+
+	def regProgressHandler(self, start=None, progress=None, stop=None):
+		self.watcher().regProgressHandler(start, progress, stop)
+
+	def unregProgressHandler(self, start=None, progress=None, stop=None):
+		self.watcher().unregProgressHandler(start, progress, stop)
+
+	# One dict per connection: the number of threads that were routed to it
+	# ('users'), the requests that wait for their confirmation ('inFlight'),
+	# the highest number of such requests ('peakInFlight') and the total
+	# number of requests ('requests').
+	def metrics(self):
+		with self.__lock:
+			return [ {
+				'users' : c.users,
+				'inFlight' : len(c.confirmations),
+				'peakInFlight' : c.peakInFlight,
+				'requests' : c.requests
+			} for c in self.__connections ]
+
+	def flush(self):
+		for c in self.__connections:
+			c.flush()
+
+	def close(self):
+		for c in self.__connections:
+			c.close()
+		self.__connections = []
+		if self.__watcher is not None:
+			self.__watcher.close()
+			self.__watcher = None
+
+
+def _routed(name):
+	def call(self, *args, **kwargs):
+		with self.connection() as c:
+			return getattr(c, name)(*args, **kwargs)
+	call.__name__ = name
+	return call
+
+for name in ['enum', 'lookupDoc', 'lookupRev', 'stat', 'getLinks', 'peek',
+		'lookupDocMany', 'statMany', 'getDataMany', 'create', 'fork', 'update',
+		'resume', 'forget', 'deleteDoc', 'deleteRev', 'forwardDoc',
+		'replicateDoc', 'replicateRev', 'mount', 'unmount', 'getDocPath',
+		'getRevPath', 'walkPath', 'progressPause', 'progressStop',
+		'progressResume']:
+	setattr(ConnectionPool, name, _routed(name))
+del name
+
+
 _connection = None
 
 def __FlushConnection():
@@ -1333,7 +2678,7 @@ class RevLink(object):
 		self.__rev = decoder._getStr(length)
 
 	def _toStruct(self):
-		return struct.pack('<BB', 0x40, len(self.__rev)) + self.__rev
+		return _PDSD_TAG_BYTE.pack(0x40, len(self.__rev)) + self.__rev
 
 	def _fromDict(self, dct):
 		self.__store = None
@@ -1347,7 +2692,7 @@ class RevLink(object):
 		self.__store = store.decode("hex")
 		self.__rev = rev.decode("hex")
 
-	def update(self, newStore=None):
+	def update(self, newStore=None, lookup=None):
 		if newStore:
 			self.__store = newStore
 		return self
@@ -1398,7 +2743,7 @@ class DocLink(object):
 		self.__rev = None
 
 	def _toStruct(self):
-		return struct.pack('<BB', 0x41, len(self.__doc)) + self.__doc
+		return _PDSD_TAG_BYTE.pack(0x41, len(self.__doc)) + self.__doc
 
 	def _fromDict(self, dct):
 		self.__store = None
@@ -1416,10 +2761,15 @@ class DocLink(object):
 		self.__doc = doc.decode("hex")
 		self.__rev = None
 
-	def update(self, newStore=None):
+	# An already fetched Lookup of the document may be passed to save the
+	# round-trip to the server.
+	def update(self, newStore=None, lookup=None):
 		if newStore:
 			self.__store = newStore
-		l = Connector().lookupDoc(self.__doc, [self.__store])
+		if lookup is None:
+			l = Connector().lookupDoc(self.__doc, [self.__store])
+		else:
+			l = lookup
 		if self.__store in l.stores():
 			self.__rev = l.rev(self.__store)
 		else:
@@ -1439,23 +2789,117 @@ class DocLink(object):
 		return self.__store
 
 
+# Precompiled scalar formats of the PDSD encoding
+_PDSD_FORMATS = dict((code, struct.Struct('<'+code)) for code in "BbHhLlQqfd")
+_PDSD_UINT32 = _PDSD_FORMATS['L']
+_PDSD_TAG_LEN = struct.Struct('<BL')
+_PDSD_TAG_BYTE = struct.Struct('<BB')
+
+
+# The decoding functions take the encoded string, the position after the tag
+# and the store of the document. They return the decoded value and the new
+# position.
+
+# cache of decoded dict keys
+_PDSD_KEY_DECODE_CACHE = {}
+
+def _pdsdDecodeKey(raw):
+	key = unicode(raw, 'utf-8')
+	if len(_PDSD_KEY_DECODE_CACHE) >= 1024:
+		_PDSD_KEY_DECODE_CACHE.clear()
+	_PDSD_KEY_DECODE_CACHE[raw] = key
+	return key
+
+def _pdsdDecodeDict(s, i, store):
+	elements = _PDSD_UINT32.unpack_from(s, i)[0]
+	i += 4
+	d = { }
+	unpack = _PDSD_UINT32.unpack_from
+	decoders = _PDSD_DECODERS
+	keyCache = _PDSD_KEY_DECODE_CACHE
+	for x in xrange(elements):
+		length = unpack(s, i)[0]
+		i += 4
+		raw = s[i:i+length]
+		key = keyCache.get(raw)
+		if key is None:
+			key = _pdsdDecodeKey(raw)
+		i += length
+		(d[key], i) = decoders[ord(s[i])](s, i+1, store)
+	return (d, i)
+
+def _pdsdDecodeList(s, i, store):
+	elements = _PDSD_UINT32.unpack_from(s, i)[0]
+	i += 4
+	l = []
+	append = l.append
+	decoders = _PDSD_DECODERS
+	for x in xrange(elements):
+		(value, i) = decoders[ord(s[i])](s, i+1, store)
+		append(value)
+	return (l, i)
+
+def _pdsdDecodeString(s, i, store):
+	length = _PDSD_UINT32.unpack_from(s, i)[0]
+	i += 4
+	return (unicode(s[i:i+length], 'utf-8'), i+length)
+
+def _pdsdDecodeBool(s, i, store):
+	return (s[i] != '\x00', i+1)
+
+def _pdsdDecodeRevLink(s, i, store):
+	length = ord(s[i])
+	i += 1
+	return (RevLink(store, s[i:i+length]), i+length)
+
+def _pdsdDecodeDocLink(s, i, store):
+	length = ord(s[i])
+	i += 1
+	return (DocLink(store, s[i:i+length], False), i+length)
+
+def _pdsdScalarDecoder(code):
+	unpack = _PDSD_FORMATS[code].unpack_from
+	size = _PDSD_FORMATS[code].size
+	def decode(s, i, store):
+		return (unpack(s, i)[0], i+size)
+	return decode
+
+def _pdsdDecodeInvalid(s, i, store):
+	raise TypeError("Invalid tag")
+
+_PDSD_DECODERS = [_pdsdDecodeInvalid] * 256
+_PDSD_DECODERS[0x00] = _pdsdDecodeDict
+_PDSD_DECODERS[0x10] = _pdsdDecodeList
+_PDSD_DECODERS[0x20] = _pdsdDecodeString
+_PDSD_DECODERS[0x30] = _pdsdDecodeBool
+_PDSD_DECODERS[0x40] = _pdsdDecodeRevLink
+_PDSD_DECODERS[0x41] = _pdsdDecodeDocLink
+for (tag, code) in [(0x50, 'f'), (0x51, 'd'), (0x60, 'B'), (0x61, 'b'),
+                    (0x62, 'H'), (0x63, 'h'), (0x64, 'L'), (0x65, 'l'),
+                    (0x66, 'Q'), (0x67, 'q')]:
+	_PDSD_DECODERS[tag] = _pdsdScalarDecoder(code)
+del tag, code
+
+
 class Decoder(object):
 	def __init__(self, store):
 		self.__store = store
-		pass
 
 	def decode(self, s):
-		self._s = s
-		self._i = 0
-		return self._decodeDoc()
+		self._s = s = str(s)
+		try:
+			(res, self._i) = _PDSD_DECODERS[ord(s[0])](s, 1, self.__store)
+		except IndexError:
+			raise struct.error("Truncated PDSD data")
+		return res
 
 	def _getStore(self):
 		return self.__store
 
 	def _getInt(self, code):
-		length = struct.calcsize('<'+code)
-		value = struct.unpack_from('<'+code, self._s, self._i)[0]
-		self._i += length
+		fmt = _PDSD_FORMATS[code]
+		value = fmt.unpack_from(self._s, self._i)[0]
+		self._i += fmt.size
 		return value
 
 	def _getStr(self, length):
@@ -1463,67 +2907,131 @@ class Decoder(object):
 		self._i += length
 		return res
 
-	def _decodeDoc(self):
-		tag = self._getInt('B')
-		if tag == 0x00:
-			res = self._decodeDict()
-		elif tag == 0x10:
-			res = self._decodeList()
-		elif tag == 0x20:
-			res = self._decodeString()
-		elif tag == 0x30:
-			res = (self._getInt('B') != 0)
-		elif tag == 0x40:
-			res = RevLink()
-			res._fromStruct(self)
-		elif tag == 0x41:
-			res = DocLink()
-			res._fromStruct(self)
-		elif tag == 0x50:
-			res = self._getInt('f')
-		elif tag == 0x51:
-			res = self._getInt('d')
-		elif tag == 0x60:
-			res = self._getInt('B')
-		elif tag ==	0x61:
-			res = self._getInt('b')
-		elif tag ==	0x62:
-			res = self._getInt('H')
-		elif tag ==	0x63:
-			res = self._getInt('h')
-		elif tag ==	0x64:
-			res = self._getInt('L')
-		elif tag ==	0x65:
-			res = self._getInt('l')
-		elif tag ==	0x66:
-			res = self._getInt('Q')
-		elif tag ==	0x67:
-			res = self._getInt('q')
-		else:
-			raise TypeError("Invalid tag")
 
-		return res
+# The encoding functions append the encoded parts of the object to a list
+# which is joined once at the end.
+
+def _pdsdEncode(o, out):
+	encode = _PDSD_ENCODERS.get(type(o))
+	if encode:
+		encode(o, out)
+	elif isinstance(o, dict):
+		_pdsdEncodeDict(o, out)
+	elif isinstance(o, (list, tuple)):
+		_pdsdEncodeList(o, out)
+	elif isinstance(o, str):
+		_pdsdEncodeStr(o, out)
+	elif isinstance(o, unicode):
+		_pdsdEncodeUnicode(o, out)
+	elif isinstance(o, (RevLink, DocLink)):
+		out.append(o._toStruct())
+	elif isinstance(o, float):
+		_pdsdEncodeFloat(o, out)
+	elif isinstance(o, (int, long)):
+		_pdsdEncodeInt(o, out)
+	else:
+		raise TypeError("Invalid object: " + repr(o))
 
-	def _decodeDict(self):
-		elements = self._getInt('L')
-		d = { }
-		for i in range(elements):
-			key = self._decodeString()
-			value = self._decodeDoc()
-			d[key] = value
-		return d
-
-	def _decodeList(self):
-		elements = self._getInt('L')
-		l = []
-		for i in range(elements):
-			l.append(self._decodeDoc())
-		return l
-
-	def _decodeString(self):
-		length = self._getInt('L')
-		value = self._getStr(length).decode('utf-8')
-		return value
+# Dict keys repeat a lot, e.g. in folders. Their encoding is cached.
+_PDSD_KEY_CACHE = {}
+
+def _pdsdEncodeKey(key):
+	if isinstance(key, unicode):
+		encKey = key.encode('utf-8')
+	elif isinstance(key, str):
+		encKey = key
+	else:
+		raise TypeError("Invalid dict key: " + repr(key))
+	header = _PDSD_UINT32.pack(len(encKey)) + encKey
+	if len(_PDSD_KEY_CACHE) >= 1024:
+		_PDSD_KEY_CACHE.clear()
+	_PDSD_KEY_CACHE[key] = header
+	return header
+
+def _pdsdEncodeDict(d, out):
+	append = out.append
+	encoders = _PDSD_ENCODERS
+	keyCache = _PDSD_KEY_CACHE
+	append(_PDSD_TAG_LEN.pack(0x00, len(d)))
+	for key, value in d.iteritems():
+		header = keyCache.get(key)
+		if header is None:
+			header = _pdsdEncodeKey(key)
+		append(header)
+		encode = encoders.get(type(value))
+		if encode:
+			encode(value, out)
+		else:
+			_pdsdEncode(value, out)
+
+def _pdsdEncodeList(l, out):
+	out.append(_PDSD_TAG_LEN.pack(0x10, len(l)))
+	encoders = _PDSD_ENCODERS
+	for i in l:
+		encode = encoders.get(type(i))
+		if encode:
+			encode(i, out)
+		else:
+			_pdsdEncode(i, out)
+
+def _pdsdEncodeStr(o, out):
+	out.append(_PDSD_TAG_LEN.pack(0x20, len(o)))
+	out.append(o)
+
+def _pdsdEncodeUnicode(o, out):
+	_pdsdEncodeStr(o.encode('utf-8'), out)
+
+def _pdsdEncodeBool(o, out):
+	out.append(_PDSD_TAG_BYTE.pack(0x30, 1 if o else 0))
+
+def _pdsdEncodeLink(o, out):
+	out.append(o._toStruct())
+
+def _pdsdEncodeFloat(o, out):
+	out.append(_PDSD_TAG_DOUBLE.pack(0x51, o))
+
+_PDSD_TAG_DOUBLE = struct.Struct('<Bd')
+_PDSD_TAG_INT8 = struct.Struct('<Bb')
+_PDSD_TAG_INT16 = struct.Struct('<Bh')
+_PDSD_TAG_INT32 = struct.Struct('<Bl')
+_PDSD_TAG_INT64 = struct.Struct('<Bq')
+_PDSD_TAG_UINT16 = struct.Struct('<BH')
+_PDSD_TAG_UINT64 = struct.Struct('<BQ')
+
+def _pdsdEncodeInt(i, out):
+	if i < 0:
+		if i >= -128:
+			out.append(_PDSD_TAG_INT8.pack(0x61, i))
+		elif i >= -32768:
+			out.append(_PDSD_TAG_INT16.pack(0x63, i))
+		elif i >= -2147483648:
+			out.append(_PDSD_TAG_INT32.pack(0x65, i))
+		else:
+			out.append(_PDSD_TAG_INT64.pack(0x67, i))
+	else:
+		if i <= 0xff:
+			out.append(_PDSD_TAG_BYTE.pack(0x60, i))
+		elif i <= 0xffff:
+			out.append(_PDSD_TAG_UINT16.pack(0x62, i))
+		elif i <= 0xffffffff:
+			out.append(_PDSD_TAG_LEN.pack(0x64, i))
+		else:
+			out.append(_PDSD_TAG_UINT64.pack(0x66, i))
+
+# handlers for the exact types, subclasses take the slow path in _pdsdEncode
+_PDSD_ENCODERS = {
+	dict : _pdsdEncodeDict,
+	list : _pdsdEncodeList,
+	tuple : _pdsdEncodeList,
+	str : _pdsdEncodeStr,
+	unicode : _pdsdEncodeUnicode,
+	bool : _pdsdEncodeBool,
+	RevLink : _pdsdEncodeLink,
+	DocLink : _pdsdEncodeLink,
+	float : _pdsdEncodeFloat,
+	int : _pdsdEncodeInt,
+	long : _pdsdEncodeInt,
+}
 
 
 class Encoder(object):
@@ -1531,70 +3039,87 @@ class Encoder(object):
 		pass
 
 	def encode(self, o):
-		if isinstance(o, dict):
-			res = self._encodeDict(o)
-		elif isinstance(o, (list, tuple)):
-			res = self._encodeList(o)
-		elif isinstance(o, basestring):
-			if isinstance(o, str):
-				res = struct.pack('<BL', 0x20, len(o)) + o
-			else:
-				encStr = o.encode('utf-8')
-				res = struct.pack('<BL', 0x20, len(encStr)) + encStr
-		elif o is True:
-			res = struct.pack('BB', 0x30, 1)
-		elif o is False:
-			res = struct.pack('BB', 0x30, 0)
-		elif isinstance(o, RevLink):
-			res = o._toStruct()
-		elif isinstance(o, DocLink):
-			res = o._toStruct()
-		elif isinstance(o, float):
-			res = struct.pack('<Bd', 0x51, o)
-		elif isinstance(o, (int, long)):
-			res = self._encodeInt(o)
-		else:
-			raise TypeError("Invalid object: " + repr(o))
-
-		return res
-
-	def _encodeDict(self, d):
-		data = struct.pack('<BL', 0x00, len(d))
-		for key, value in d.iteritems():
-			if isinstance(key, basestring):
-				if isinstance(key, unicode):
-					key = key.encode('utf-8')
-			else:
-				raise TypeError("Invalid dict key: " + repr(key))
-			data += struct.pack('<L', len(key)) + key + self.encode(value)
-
-		return data
-
-	def _encodeList(self, l):
-		data = struct.pack('<BL', 0x10, len(l))
-		for i in l:
-			data += self.encode(i)
-		return data
-
-	def _encodeInt(self, i):
-		if i < 0:
-			if i >= -128:
-				return struct.pack('<Bb', 0x61, i)
-			elif i >= -32768:
-				return struct.pack('<Bh', 0x63, i)
-			elif i >= -2147483648:
-				return struct.pack('<Bl', 0x65, i)
-			else:
-				return struct.pack('<Bq', 0x67, i)
+		out = []
+		_pdsdEncode(o, out)
+		return ''.join(out)
+
+	def iterencode(self, o, chunkSize=0x10000):
+		return iterDumpPDSD(o, chunkSize)
+
+
+# Incremental encoder. Dicts and lists are walked with an explicit stack and
+# only their headers are encoded up front; the element counts are known from
+# len(). All other values are encoded as a whole. Yields strings of chunkSize
+# bytes, only the last one may be shorter. The concatenation is equal to
+# dumpPDSD(o).
+def iterDumpPDSD(o, chunkSize=0x10000):
+	out = []
+	counted = buffered = 0
+	stack = [iter([(None, o)])]
+	encoders = _PDSD_ENCODERS
+	while stack:
+		try:
+			(header, value) = next(stack[-1])
+		except StopIteration:
+			stack.pop()
+			continue
+
+		if header is not None:
+			out.append(header)
+		typ = type(value)
+		if typ in (dict, list, tuple) and _pdsdIsSmall(value, 64):
+			# not worth walking, encode at once, possibly accelerated
+			out.append(dumpPDSD(value))
+		elif typ is dict or (typ not in encoders and isinstance(value, dict)):
+			out.append(_PDSD_TAG_LEN.pack(0x00, len(value)))
+			stack.append(_pdsdIterDict(value))
+		elif typ in (list, tuple) or (typ not in encoders and
+				isinstance(value, (list, tuple))):
+			out.append(_PDSD_TAG_LEN.pack(0x10, len(value)))
+			stack.append(((None, item) for item in value))
 		else:
-			if i <= 0xff:
-				return struct.pack('<BB', 0x60, i)
-			elif i <= 0xffff:
-				return struct.pack('<BH', 0x62, i)
-			elif i <= 0xffffffff:
-				return struct.pack('<BL', 0x64, i)
-			else:
-				return struct.pack('<BQ', 0x66, i)
+			_pdsdEncode(value, out)
+
+		# count the buffered bytes from time to time and flush full chunks
+		if len(out) - counted >= 256:
+			buffered += sum(map(len, out[counted:]))
+			counted = len(out)
+			if buffered >= chunkSize:
+				data = ''.join(out)
+				pos = 0
+				while len(data) - pos >= chunkSize:
+					yield data[pos:pos+chunkSize]
+					pos += chunkSize
+				out = [data[pos:]]
+				counted = 1
+				buffered = len(data) - pos
+
+	data = ''.join(out)
+	for pos in xrange(0, len(data), chunkSize):
+		yield data[pos:pos+chunkSize]
+
+# checks if a structure has less than 'budget' elements, at linear cost
+def _pdsdIsSmall(value, budget):
+	todo = [value]
+	while todo:
+		value = todo.pop()
+		budget -= len(value)
+		if budget < 0:
+			return False
+		if isinstance(value, dict):
+			value = value.itervalues()
+		for item in value:
+			if isinstance(item, (dict, list, tuple)):
+				todo.append(item)
+	return True
+
+def _pdsdIterDict(d):
+	keyCache = _PDSD_KEY_CACHE
+	for key, value in d.iteritems():
+		header = keyCache.get(key)
+		if header is None:
+			header = _pdsdEncodeKey(key)
+		yield (header, value)
 
 
 def __decode_link(dct):
@@ -1618,14 +3143,306 @@ def __encode_link(obj):
 		raise TypeError(repr(obj) + " is not serializable")
 
 
-def loadPDSD(store, s):
-	dec = Decoder(store)
-	return dec.decode(s)
+# Lazy access to PDSD data. Containers are only indexed when accessed and
+# their children are decoded on demand. This is cheap if only a small part of
+# a large structure is needed, e.g. when it was cached as raw string.
+
+def _pdsdSkipDict(s, i):
+	elements = _PDSD_UINT32.unpack_from(s, i)[0]
+	i += 4
+	unpack = _PDSD_UINT32.unpack_from
+	skippers = _PDSD_SKIPPERS
+	for x in xrange(elements):
+		i += unpack(s, i)[0] + 4
+		i = skippers[ord(s[i])](s, i+1)
+	return i
+
+def _pdsdSkipList(s, i):
+	elements = _PDSD_UINT32.unpack_from(s, i)[0]
+	i += 4
+	skippers = _PDSD_SKIPPERS
+	for x in xrange(elements):
+		i = skippers[ord(s[i])](s, i+1)
+	return i
+
+def _pdsdSkipString(s, i):
+	return i + 4 + _PDSD_UINT32.unpack_from(s, i)[0]
+
+def _pdsdSkipLink(s, i):
+	return i + 1 + ord(s[i])
+
+def _pdsdSkipInvalid(s, i):
+	raise TypeError("Invalid tag")
+
+_PDSD_SKIPPERS = [_pdsdSkipInvalid] * 256
+_PDSD_SKIPPERS[0x00] = _pdsdSkipDict
+_PDSD_SKIPPERS[0x10] = _pdsdSkipList
+_PDSD_SKIPPERS[0x20] = _pdsdSkipString
+_PDSD_SKIPPERS[0x30] = lambda s, i: i + 1
+_PDSD_SKIPPERS[0x40] = _pdsdSkipLink
+_PDSD_SKIPPERS[0x41] = _pdsdSkipLink
+for (tag, code) in [(0x50, 'f'), (0x51, 'd'), (0x60, 'B'), (0x61, 'b'),
+                    (0x62, 'H'), (0x63, 'h'), (0x64, 'L'), (0x65, 'l'),
+                    (0x66, 'Q'), (0x67, 'q')]:
+	_PDSD_SKIPPERS[tag] = (lambda size: lambda s, i: i + size)(_PDSD_FORMATS[code].size)
+del tag, code
+
+
+# decode the value at position i, containers are returned as lazy views
+def _pdsdLoadLazy(store, s, i):
+	tag = ord(s[i])
+	if tag == 0x00:
+		return LazyDict(store, s, i)
+	elif tag == 0x10:
+		return LazyList(store, s, i)
+	else:
+		return _PDSD_DECODERS[tag](s, i+1, store)[0]
 
+# fully decode the value at position i
+def _pdsdDecodeAt(store, s, i):
+	if _pdsd:
+		end = _PDSD_SKIPPERS[ord(s[i])](s, i+1)
+		return _pdsd.decode(store, s[i:end])
+	else:
+		return _PDSD_DECODERS[ord(s[i])](s, i+1, store)[0]
 
-def dumpPDSD(o):
-	enc = Encoder()
-	return enc.encode(o)
+
+class _LazyContainer(object):
+	__slots__ = ['_store', '_s', '_pos', '_values']
+
+	def __init__(self, store, s, pos):
+		self._store = store
+		self._s = s
+		self._pos = pos
+		self._values = None
+
+	def decode(self):
+		return _pdsdDecodeAt(self._store, self._s, self._pos)
+
+	def select(self, selector, lazy=False):
+		return _pdsdSelect(self._store, self._s, self._pos, selector, lazy)
+
+	def __eq__(self, other):
+		if isinstance(other, _LazyContainer):
+			other = other.decode()
+		return self.decode() == other
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	__hash__ = None
+
+	def __deepcopy__(self, memo):
+		return self.decode()
+
+	def __repr__(self):
+		return "%s(%r)" % (self.__class__.__name__, self.decode())
+
+
+class LazyDict(_LazyContainer):
+	__slots__ = ['__offsets']
+
+	def __index(self):
+		s = self._s
+		i = self._pos + 1
+		elements = _PDSD_UINT32.unpack_from(s, i)[0]
+		i += 4
+		offsets = {}
+		unpack = _PDSD_UINT32.unpack_from
+		skippers = _PDSD_SKIPPERS
+		keyCache = _PDSD_KEY_DECODE_CACHE
+		for x in xrange(elements):
+			length = unpack(s, i)[0]
+			i += 4
+			raw = s[i:i+length]
+			key = keyCache.get(raw)
+			if key is None:
+				key = _pdsdDecodeKey(raw)
+			i += length
+			offsets[key] = i
+			i = skippers[ord(s[i])](s, i+1)
+		self.__offsets = offsets
+		self._values = {}
+
+	def __getitem__(self, key):
+		if self._values is None:
+			self.__index()
+		try:
+			return self._values[key]
+		except KeyError:
+			value = self._values[key] = _pdsdLoadLazy(self._store, self._s,
+				self.__offsets[key])
+			return value
+
+	def get(self, key, default=None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
+
+	def __contains__(self, key):
+		if self._values is None:
+			self.__index()
+		return key in self.__offsets
+
+	has_key = __contains__
+
+	def __len__(self):
+		return _PDSD_UINT32.unpack_from(self._s, self._pos+1)[0]
+
+	def __iter__(self):
+		if self._values is None:
+			self.__index()
+		return iter(self.__offsets)
+
+	iterkeys = __iter__
+
+	def keys(self):
+		return list(self)
+
+	def itervalues(self):
+		for key in self:
+			yield self[key]
+
+	def values(self):
+		return list(self.itervalues())
+
+	def iteritems(self):
+		for key in self:
+			yield (key, self[key])
+
+	def items(self):
+		return list(self.iteritems())
+
+
+class LazyList(_LazyContainer):
+	__slots__ = ['__offsets']
+
+	def __index(self):
+		s = self._s
+		i = self._pos + 5
+		offsets = []
+		append = offsets.append
+		skippers = _PDSD_SKIPPERS
+		for x in xrange(len(self)):
+			append(i)
+			i = skippers[ord(s[i])](s, i+1)
+		self.__offsets = offsets
+		self._values = {}
+
+	def __getitem__(self, index):
+		if self._values is None:
+			self.__index()
+		if isinstance(index, slice):
+			return [ self[i] for i in xrange(*index.indices(len(self))) ]
+		if index < 0:
+			index += len(self.__offsets)
+		if index < 0 or index >= len(self.__offsets):
+			raise IndexError('list index out of range')
+		try:
+			return self._values[index]
+		except KeyError:
+			value = self._values[index] = _pdsdLoadLazy(self._store, self._s,
+				self.__offsets[index])
+			return value
+
+	def __len__(self):
+		return _PDSD_UINT32.unpack_from(self._s, self._pos+1)[0]
+
+	def __iter__(self):
+		for i in xrange(len(self)):
+			yield self[i]
+
+
+# Parse a selector like the server: "/key" selects a dict entry, "#n" a list
+# element.
+def _pdsdParseSelector(selector):
+	ops = []
+	i = 0
+	while i < len(selector):
+		op = selector[i]
+		end = i + 1
+		while end < len(selector) and selector[end] not in "/#":
+			end += 1
+		spec = selector[i+1:end]
+		if op == '/':
+			if isinstance(spec, unicode):
+				spec = spec.encode('utf-8')
+			ops.append(spec)
+		elif op == '#':
+			try:
+				ops.append(int(spec))
+			except ValueError:
+				raise IOError('EINVAL')
+		else:
+			raise IOError('EINVAL')
+		i = end
+	return ops
+
+def _pdsdSelect(store, s, i, selector, lazy):
+	unpack = _PDSD_UINT32.unpack_from
+	skippers = _PDSD_SKIPPERS
+	for op in _pdsdParseSelector(selector):
+		tag = ord(s[i])
+		if tag != 0x00 and tag != 0x10:
+			raise IOError('EINVAL')
+		elements = unpack(s, i+1)[0]
+		i += 5
+		if tag == 0x00 and isinstance(op, str):
+			for x in xrange(elements):
+				length = unpack(s, i)[0]
+				i += 4
+				found = (s[i:i+length] == op)
+				i += length
+				if found:
+					break
+				i = skippers[ord(s[i])](s, i+1)
+			else:
+				raise IOError('ENOENT')
+		elif tag == 0x10 and isinstance(op, int) and (0 <= op < elements):
+			for x in xrange(op):
+				i = skippers[ord(s[i])](s, i+1)
+		else:
+			raise IOError('EINVAL')
+	if lazy:
+		return _pdsdLoadLazy(store, s, i)
+	else:
+		return _pdsdDecodeAt(store, s, i)
+
+
+# Returns a lazy view of the PDSD string s. Scalars are decoded directly.
+def loadLazyPDSD(store, s):
+	return _pdsdLoadLazy(store, str(s), 0)
+
+# Evaluates a selector on a PDSD string like Handle.getData() does on the
+# server. Only the selected value is decoded. If lazy is True containers are
+# returned as lazy views.
+def selectPDSD(store, s, selector, lazy=False):
+	return _pdsdSelect(store, str(s), 0, selector, lazy)
+
+
+# Use the accelerated codec if it was built (see "make pdsd"). Encoder and
+# Decoder are always the pure Python implementation.
+try:
+	from . import _pdsd
+	_pdsd.setup(RevLink, DocLink)
+except ImportError:
+	_pdsd = None
+
+if _pdsd:
+	def loadPDSD(store, s):
+		return _pdsd.decode(store, s)
+
+	def dumpPDSD(o):
+		return _pdsd.encode(o)
+else:
+	def loadPDSD(store, s):
+		dec = Decoder(store)
+		return dec.decode(s)
+
+	def dumpPDSD(o):
+		enc = Encoder()
+		return enc.encode(o)
 
 
 def loadJSON(s):
@@ -0,0 +1,428 @@
+# vim: set fileencoding=utf-8 :
+#
+# PeerDrive
+# Copyright (C) 2011  Jan Klötzke <jan DOT kloetzke AT freenet DOT de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import os, os.path, time, heapq, atexit, sqlite3
+from datetime import datetime
+
+from .connector import Connector
+
+_A = 1
+_B = 2
+_BOTH = _A | _B
+_STALE = 4
+
+# Client side view of the revision graph. The parents and the mtime of every
+# revision that was visited are cached and new revisions are always fetched
+# in batches with statMany(), i.e. one round trip per level of the history
+# instead of one per revision. Revisions are immutable so the cache never
+# needs to be invalidated. Revisions that cannot be found are treated as
+# roots.
+#
+# If a HistoryIndex is given then revisions are looked up there first and
+# every revision whose complete history was visited is added to it together
+# with its generation number. The generation numbers let isAncestor() stop
+# at revisions that are too old to be a descendant of the queried ancestor
+# and once the history of a document is indexed all queries are answered
+# without the server.
+#
+# The stat() calls are restricted to 'stores' if given, just like
+# Connector().stat().
+class RevGraph(object):
+	BATCH = 512
+
+	def __init__(self, stores=[], connector=None, index=None):
+		self.__stores = list(stores)
+		self.__connector = connector
+		self.__index = index
+		self.__nodes = {}
+		self.__generations = {}
+		self.fetches = 0
+
+	def __len__(self):
+		return len(self.__nodes)
+
+	def __contains__(self, rev):
+		return rev in self.__nodes
+
+	# makes sure that the given revisions are cached
+	def fetch(self, revs):
+		missing = [ rev for rev in set(revs) if rev not in self.__nodes ]
+		if missing and self.__index is not None:
+			for (rev, (parents, generation, mtime)) in self.__index.get(missing).items():
+				self.__nodes[rev] = (parents, mtime)
+				self.__generations[rev] = (generation, True)
+			missing = [ rev for rev in missing if rev not in self.__nodes ]
+		if not missing:
+			return
+		c = self.__connector or Connector()
+		for i in xrange(0, len(missing), RevGraph.BATCH):
+			stats = c.statMany(missing[i:i+RevGraph.BATCH], self.__stores)
+			self.fetches += 1
+			for (rev, stat) in stats.items():
+				if isinstance(stat, IOError):
+					self.__nodes[rev] = ((), None)
+				else:
+					self.__nodes[rev] = (tuple(stat.parents()),
+						_timestamp(stat.mtime()))
+
+	def parents(self, rev):
+		self.fetch([rev])
+		return list(self.__nodes[rev][0])
+
+	# returns None if the revision is unknown
+	def mtime(self, rev):
+		self.fetch([rev])
+		mtime = self.__nodes[rev][1]
+		if mtime is None:
+			return None
+		else:
+			return datetime.fromtimestamp(mtime)
+
+	# The generation number of a root revision is 1, all other revisions are
+	# one generation above their highest parent, i.e. a revision can only be
+	# an ancestor of revisions with a higher generation number. Needs the
+	# complete history of the revision unless it is already indexed. Returns
+	# None if part of the history cannot be found.
+	def generation(self, rev):
+		self.__complete([rev])
+		(generation, complete) = self.__generations[rev]
+		if complete:
+			return generation
+		else:
+			return None
+
+	# Returns the best common ancestors of 'a' and 'b', newest first. There is
+	# more than one if the history contains criss-cross merges. None of the
+	# returned revisions is an ancestor of another one. If 'a' is an ancestor
+	# of 'b' then the result is [a] and vice versa.
+	def mergeBases(self, a, b):
+		bases = self.__paint(a, b)
+		if len(bases) > 1:
+			bases = [ rev for rev in bases if not any(other != rev and
+				self.isAncestor(rev, other) for other in bases) ]
+		self.fetch(bases)
+		return sorted(bases, key=self.__sortKey, reverse=True)
+
+	# Returns the newest of the best common ancestors or None if the
+	# revisions do not share any history.
+	def mergeBase(self, a, b):
+		bases = self.mergeBases(a, b)
+		if bases:
+			return bases[0]
+		else:
+			return None
+
+	# Is 'a' an ancestor of 'b'? Every revision is its own ancestor. Uses the
+	# generation numbers if both revisions are indexed already.
+	def isAncestor(self, a, b):
+		if a == b:
+			return True
+		self.fetch([a, b])
+		self.__complete([a, b], False)
+		(limit, completeA) = self.__generations.get(a, (None, False))
+		(_, completeB) = self.__generations.get(b, (None, False))
+		if not (completeA and completeB):
+			return a in self.__paint(a, b)
+		# the ancestors of indexed revisions are indexed too
+		level = [b]
+		seen = set(level)
+		while level:
+			parents = set(p for rev in level for p in self.__nodes[rev][0])
+			if a in parents:
+				return True
+			self.fetch(parents)
+			level = [ p for p in parents if p not in seen and
+				self.__generations[p][0] > limit ]
+			seen.update(level)
+		return False
+
+	# Returns 'rev' and all its ancestors, newest first. If 'topological' is
+	# set then every revision is listed before its parents even if the
+	# clocks of the stores were skewed.
+	def history(self, rev, topological=False):
+		seen = set([rev])
+		level = [rev]
+		while level:
+			self.fetch(level)
+			nextLevel = []
+			for r in level:
+				for parent in self.__nodes[r][0]:
+					if parent not in seen:
+						seen.add(parent)
+						nextLevel.append(parent)
+			level = nextLevel
+		if topological or self.__index is not None:
+			self.__complete([rev])
+		if topological:
+			key = lambda r: (self.__generations[r][0], self.__sortKey(r))
+		else:
+			key = self.__sortKey
+		return sorted(seen, key=key, reverse=True)
+
+	def __sortKey(self, rev):
+		return (self.__nodes[rev][1] or 0, rev)
+
+	# Calculates the generation numbers of the given revisions and their
+	# ancestors. Missing revisions count as generation 0 so that the numbers
+	# still sort the known part of the history but they are marked as
+	# incomplete, just like all their descendants. Only complete revisions
+	# are added to the index. If 'walk' is not set then no revisions are
+	# fetched and only revisions whose history is already cached get a
+	# generation number.
+	def __complete(self, revs, walk=True):
+		pending = set()
+		level = set(revs)
+		while level:
+			if walk:
+				self.fetch(level)
+			level = [ rev for rev in level if rev in self.__nodes and
+				rev not in self.__generations and rev not in pending ]
+			pending.update(level)
+			level = set(parent for rev in level for parent in self.__nodes[rev][0])
+
+		added = []
+		unknown = set()
+		for rev in pending:
+			stack = [rev]
+			while stack:
+				r = stack[-1]
+				if r in self.__generations or r in unknown:
+					stack.pop()
+					continue
+				if r not in self.__nodes:
+					unknown.add(r)
+					stack.pop()
+					continue
+				(parents, mtime) = self.__nodes[r]
+				todo = [ p for p in parents if p not in self.__generations and
+					p not in unknown ]
+				if todo:
+					stack.extend(todo)
+					continue
+				stack.pop()
+				if any(p in unknown for p in parents):
+					unknown.add(r)
+					continue
+				generation = 1
+				complete = mtime is not None
+				for p in parents:
+					generation = max(generation, self.__generations[p][0] + 1)
+					complete = complete and self.__generations[p][1]
+				if mtime is None:
+					generation = 0
+				self.__generations[r] = (generation, complete)
+				if complete:
+					added.append((r, parents, generation, mtime))
+		if added and self.__index is not None:
+			self.__index.put(added)
+
+	# Walks down from both revisions at the same time and marks every revision
+	# with the side(s) from which it was reached. A revision that is reached
+	# from both sides is a common ancestor. Its own ancestors are marked stale
+	# as they cannot be the best common ancestors. The walk stops as soon as
+	# only stale revisions are left, i.e. at the first common frontier.
+	#
+	# Only the revisions that are not cached yet need a round trip. They are
+	# collected and fetched together while the marks are propagated through
+	# the cached part of the graph right away, newest revisions first. This
+	# is important for the stale marks: they would never catch up with a
+	# single sided walk if they could only advance by one level per round
+	# trip too. Returns the common ancestors that were not marked stale.
+	def __paint(self, a, b):
+		if a == b:
+			return [a]
+		flags = { a : _A, b : _B }
+		done = {}
+		pending = set([a, b])
+		candidates = []
+		while any(not flags[rev] & _STALE for rev in pending):
+			self.fetch(pending)
+			queue = [ self.__queueKey(rev) for rev in pending ]
+			heapq.heapify(queue)
+			pending = set()
+			while queue:
+				rev = heapq.heappop(queue)[1]
+				f = flags[rev]
+				if done.get(rev) == f:
+					continue
+				done[rev] = f
+				if (f & _BOTH == _BOTH) and not (f & _STALE):
+					candidates.append(rev)
+					f |= _STALE
+				for parent in self.__nodes[rev][0]:
+					old = flags.get(parent, 0)
+					if old | f != old:
+						flags[parent] = old | f
+						if parent in self.__nodes:
+							heapq.heappush(queue, self.__queueKey(parent))
+						else:
+							pending.add(parent)
+		if self.__index is not None:
+			self.__complete(flags.keys(), False)
+		return [ r for r in candidates if not flags[r] & _STALE ]
+
+	def __queueKey(self, rev):
+		return (-(self.__nodes[rev][1] or 0), rev)
+
+
+# Persistent index of the revision graph that is used by RevGraph. It stores
+# the parents, the generation number and the mtime of every revision whose
+# complete history is known in a sqlite database under settingsPath() that
+# is shared by all client processes. The history of a document is just the
+# closure of its revisions so a single table serves all documents. Entries
+# never become invalid because revisions are immutable, they are only added
+# once the whole history below them is indexed and are thus always
+# consistent.
+#
+# New entries are buffered and written in one transaction when FLUSH_COUNT
+# entries are pending or on flush(). Like with the DiskCache errors of the
+# database are never raised to the caller, the revisions are then just
+# fetched from the server again.
+class HistoryIndex(object):
+	FLUSH_COUNT = 1024
+	TIMEOUT = 10
+	BATCH = 512
+
+	def __init__(self, path=None):
+		if path is None:
+			from . import settingsPath
+			path = os.path.join(settingsPath(), 'history.db')
+		self.path = path
+		self.__pending = {}
+		self.__db = None
+		try:
+			if not os.path.exists(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+			self.__db = sqlite3.connect(path, timeout=HistoryIndex.TIMEOUT)
+			self.__db.text_factory = str
+			self.__db.execute("PRAGMA journal_mode=WAL")
+			self.__db.execute("PRAGMA synchronous=NORMAL")
+			with self.__db:
+				self.__db.execute("""CREATE TABLE IF NOT EXISTS revs (
+					rev BLOB PRIMARY KEY, parents BLOB, generation INTEGER,
+					mtime REAL)""")
+		except (OSError, sqlite3.Error) as e:
+			if self.__db is not None:
+				self.__db.close()
+			raise IOError("Cannot open history index '%s': %s" % (path, e))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.close()
+		return False
+
+	def __len__(self):
+		self.flush()
+		try:
+			return self.__db.execute("SELECT count(*) FROM revs").fetchone()[0]
+		except sqlite3.Error:
+			return 0
+
+	# Returns a dict of all indexed revisions: rev -> (parents, generation,
+	# mtime). Unknown revisions are omitted.
+	def get(self, revs):
+		result = {}
+		query = []
+		for rev in revs:
+			if rev in self.__pending:
+				result[rev] = self.__pending[rev]
+			else:
+				query.append(rev)
+		try:
+			for i in xrange(0, len(query), HistoryIndex.BATCH):
+				batch = query[i:i+HistoryIndex.BATCH]
+				rows = self.__db.execute("""SELECT rev, parents, generation,
+					mtime FROM revs WHERE rev IN (%s)""" % ",".join("?" * len(batch)),
+					[ buffer(rev) for rev in batch ]).fetchall()
+				for (rev, parents, generation, mtime) in rows:
+					result[str(rev)] = (_decodeRevs(str(parents)), generation, mtime)
+		except sqlite3.Error:
+			pass
+		return result
+
+	# adds a list of (rev, parents, generation, mtime) tuples
+	def put(self, entries):
+		for (rev, parents, generation, mtime) in entries:
+			self.__pending[rev] = (tuple(parents), generation, mtime)
+		if len(self.__pending) >= HistoryIndex.FLUSH_COUNT:
+			self.flush()
+
+	def flush(self):
+		if not self.__pending:
+			return
+		rows = [ (buffer(rev), buffer(_encodeRevs(parents)), generation, mtime)
+			for (rev, (parents, generation, mtime)) in self.__pending.items() ]
+		self.__pending = {}
+		try:
+			with self.__db:
+				self.__db.executemany("""INSERT OR REPLACE INTO revs
+					(rev, parents, generation, mtime) VALUES (?, ?, ?, ?)""", rows)
+		except sqlite3.Error:
+			pass
+
+	def clear(self):
+		self.__pending = {}
+		try:
+			with self.__db:
+				self.__db.execute("DELETE FROM revs")
+		except sqlite3.Error:
+			pass
+
+	def close(self):
+		if self.__db is not None:
+			self.flush()
+			self.__db.close()
+			self.__db = None
+
+
+_historyIndex = None
+_historyIndexFailed = False
+
+# Returns the HistoryIndex of the user that is shared by all RevGraphs of the
+# process or None if it cannot be opened.
+def historyIndex():
+	global _historyIndex, _historyIndexFailed
+	if _historyIndex is None and not _historyIndexFailed:
+		try:
+			_historyIndex = HistoryIndex()
+			atexit.register(_historyIndex.close)
+		except IOError:
+			_historyIndexFailed = True
+	return _historyIndex
+
+
+def _encodeRevs(revs):
+	return "".join(chr(len(rev)) + rev for rev in revs)
+
+
+def _decodeRevs(data):
+	revs = []
+	pos = 0
+	while pos < len(data):
+		length = ord(data[pos])
+		revs.append(data[pos+1:pos+1+length])
+		pos += 1 + length
+	return tuple(revs)
+
+
+def _timestamp(mtime):
+	return time.mktime(mtime.timetuple()) + mtime.microsecond / 1000000.0
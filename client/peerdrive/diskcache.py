@@ -0,0 +1,203 @@
+# vim: set fileencoding=utf-8 :
+#
+# PeerDrive
+# Copyright (C) 2011  Jan Klötzke <jan DOT kloetzke AT freenet DOT de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import os, os.path, time, sqlite3, collections
+
+# Persistent backing store of the connector's RevCache, shared by all client
+# processes of a user. It keeps the undecoded server replies of stat() and
+# getLinks() and the PDSD encoded data of (rev, selector) pairs in a sqlite
+# database. Revisions are immutable so different processes can only ever
+# write the same value for a key and sqlite takes care of the locking.
+#
+# New entries are buffered and written in one transaction when FLUSH_COUNT
+# entries are pending or on flush(). The access time of an entry is updated
+# at most once per ATIME_GRANULARITY seconds. If the total size of all values
+# exceeds the budget the least recently used entries are removed until the
+# database is down to EVICT_RATIO of the budget.
+#
+# Errors of the database are never raised to the caller. The cache then just
+# behaves as if the entry was missing.
+class DiskCache(object):
+	BUDGET = 64 << 20
+	FLUSH_COUNT = 256
+	ATIME_GRANULARITY = 60
+	EVICT_RATIO = 0.75
+	TIMEOUT = 10
+
+	def __init__(self, path=None, budget=None):
+		if path is None:
+			from . import settingsPath
+			path = os.path.join(settingsPath(), 'revcache.db')
+		self.path = path
+		self.budget = DiskCache.BUDGET if budget is None else budget
+		self.__pending = collections.OrderedDict()
+		self.__touched = set()
+		self.__db = None
+		try:
+			if not os.path.exists(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+			self.__db = sqlite3.connect(path, timeout=DiskCache.TIMEOUT)
+			self.__db.text_factory = str
+			self.__db.execute("PRAGMA journal_mode=WAL")
+			self.__db.execute("PRAGMA synchronous=NORMAL")
+			with self.__db:
+				self.__db.execute("""CREATE TABLE IF NOT EXISTS entries (
+					kind TEXT, rev BLOB, scope BLOB, selector TEXT,
+					value BLOB, size INTEGER, atime INTEGER,
+					PRIMARY KEY (kind, rev, scope, selector))""")
+				self.__db.execute("""CREATE INDEX IF NOT EXISTS entries_atime
+					ON entries (atime)""")
+		except (OSError, sqlite3.Error) as e:
+			if self.__db is not None:
+				self.__db.close()
+			raise IOError("Cannot open cache '%s': %s" % (path, e))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.close()
+		return False
+
+	# returns None if the entry is not cached
+	def get(self, key):
+		if key in self.__pending:
+			return self.__pending[key]
+		row = _row(key)
+		try:
+			result = self.__db.execute("""SELECT value, atime FROM entries
+				WHERE kind=? AND rev=? AND scope=? AND selector=?""",
+				row).fetchone()
+		except sqlite3.Error:
+			return None
+		if result is None:
+			return None
+		(value, atime) = result
+		if atime + DiskCache.ATIME_GRANULARITY < time.time():
+			self.__touched.add(row)
+		return str(value)
+
+	def put(self, key, value):
+		self.__pending[key] = value
+		if len(self.__pending) >= DiskCache.FLUSH_COUNT:
+			self.flush()
+
+	def delete(self, keys):
+		self.flush()
+		try:
+			with self.__db:
+				self.__db.executemany("""DELETE FROM entries
+					WHERE kind=? AND rev=? AND scope=? AND selector=?""",
+					[ _row(key) for key in keys ])
+		except sqlite3.Error:
+			pass
+
+	# iterates over all cached (key, value) pairs
+	def entries(self):
+		self.flush()
+		try:
+			rows = self.__db.execute("""SELECT kind, rev, scope, selector,
+				value FROM entries""").fetchall()
+		except sqlite3.Error:
+			rows = []
+		for (kind, rev, scope, selector, value) in rows:
+			yield (_key(kind, str(rev), str(scope), selector), str(value))
+
+	def size(self):
+		self.flush()
+		try:
+			return self.__db.execute(
+				"SELECT total(size) FROM entries").fetchone()[0]
+		except sqlite3.Error:
+			return 0
+
+	def flush(self):
+		if not self.__pending and not self.__touched:
+			return
+		now = int(time.time())
+		rows = [ _row(key) + (buffer(value), len(value), now)
+			for (key, value) in self.__pending.items() ]
+		touched = [ (now,) + row for row in self.__touched ]
+		self.__pending = collections.OrderedDict()
+		self.__touched = set()
+		try:
+			with self.__db:
+				self.__db.executemany("""INSERT OR REPLACE INTO entries
+					(kind, rev, scope, selector, value, size, atime)
+					VALUES (?, ?, ?, ?, ?, ?, ?)""", rows)
+				self.__db.executemany("""UPDATE entries SET atime=?
+					WHERE kind=? AND rev=? AND scope=? AND selector=?""",
+					touched)
+			if rows:
+				self.__evict()
+		except sqlite3.Error:
+			pass
+
+	def clear(self):
+		self.__pending = collections.OrderedDict()
+		self.__touched = set()
+		try:
+			with self.__db:
+				self.__db.execute("DELETE FROM entries")
+		except sqlite3.Error:
+			pass
+
+	def close(self):
+		if self.__db is not None:
+			self.flush()
+			self.__db.close()
+			self.__db = None
+
+	def __evict(self):
+		db = self.__db
+		total = db.execute("SELECT total(size) FROM entries").fetchone()[0]
+		if total <= self.budget:
+			return
+		excess = total - self.budget * DiskCache.EVICT_RATIO
+		victims = []
+		cursor = db.execute("SELECT rowid, size FROM entries ORDER BY atime, rowid")
+		for (rowid, size) in cursor:
+			victims.append((rowid,))
+			excess -= size
+			if excess <= 0:
+				break
+		cursor.close()
+		with db:
+			db.executemany("DELETE FROM entries WHERE rowid=?", victims)
+
+
+# The keys are the same as in the RevCache:
+#   ('stat', rev, stores), ('links', rev, stores), ('data', store, rev, selector)
+
+def _row(key):
+	if key[0] == 'data':
+		(kind, store, rev, selector) = key
+		return (kind, buffer(rev), buffer(store), selector)
+	else:
+		(kind, rev, stores) = key
+		return (kind, buffer(rev), buffer(''.join(stores)), '')
+
+
+def _key(kind, rev, scope, selector):
+	if kind == 'data':
+		return (kind, scope, rev, selector)
+	else:
+		stores = tuple(scope[i:i+16] for i in xrange(0, len(scope), 16))
+		return (kind, rev, stores)
@@ -0,0 +1,63 @@
+# vim: set fileencoding=utf-8 :
+#
+# PeerDrive
+# Copyright (C) 2011  Jan Klötzke <jan DOT kloetzke AT freenet DOT de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Helpers for meta data extractors.
+#
+# An extractor is started either with a single file name, printing the
+# extracted meta data as JSON, or with "--serve". In the latter case it first
+# prints a greeting line and then reads one JSON encoded path per line from
+# stdin, answering each with a single line of JSON (null on errors).
+
+from __future__ import absolute_import
+
+import sys, json, traceback
+
+PROTOCOL = 1
+
+def greeting():
+	return json.dumps({ "protocol" : PROTOCOL })
+
+
+def serve(extract):
+	output = sys.stdout
+	sys.stdout = sys.stderr # stray prints must not disturb the protocol
+	output.write(greeting() + '\n')
+	output.flush()
+	while True:
+		line = sys.stdin.readline()
+		if not line:
+			break
+		try:
+			path = json.loads(line).encode('utf8')
+			result = extract(path)
+		except Exception:
+			traceback.print_exc()
+			result = None
+		output.write(json.dumps(result) + '\n')
+		output.flush()
+
+
+def main(extract):
+	if len(sys.argv) == 2 and sys.argv[1] == "--serve":
+		serve(extract)
+	elif len(sys.argv) == 2:
+		print json.dumps(extract(sys.argv[1]))
+	else:
+		print >>sys.stderr, "usage: %s <file> | --serve" % sys.argv[0]
+		sys.exit(1)
@@ -23,7 +23,7 @@ import sys, os, subprocess, pickle, datetime
 
 from ..connector import Watch, Connector
 from ..registry import Registry
-from .. import struct
+from .. import struct, dag
 from .utils import showDocument, showProperties
 
 
@@ -157,11 +157,18 @@ class DocButton(QtGui.QToolButton, Watch):
 	def __fillMenu(self, menu, menuLink):
 		menu.clear()
 		c = struct.Folder(menuLink)
+		items = c.items()
+		struct.updateLinks([ link for (title, link) in items ], self.__store)
+
+		# stat all entries in one go
+		with Connector().pipeline() as pipe:
+			stats = [ (title, link, pipe.stat(link.rev())) for (title, link)
+				in items if link.rev() ]
+
 		listing = []
-		for (title, link) in c.items():
-			link.update(self.__store)
+		for (title, link, stat) in stats:
 			try:
-				type = Connector().stat(link.rev()).type()
+				type = stat.result().type()
 			except IOError:
 				type = None
 
@@ -920,59 +927,20 @@ class DocumentView(QtGui.QStackedWidget, Watch):
 		return True
 
 
-	# FIXME: This whole method is severely broken. It traverses the _whole_
-	# history and selects the merge base based on the mtime. It has also no
-	# provisions for criss-cross merges...
+	# Returns (fastForward, base). If one revision is an ancestor of the other
+	# then 'base' is the newer one and fastForward is True. Otherwise 'base'
+	# is the newest best common ancestor or None if there is none.
 	def __calculateMergeBase(self, store, mergeRev):
-		stores = [self.__store, store]
-		baseVersions = [self.__rev, mergeRev]
-		#print "Start: ", [rev.encode('hex') for rev in baseVersions]
-		heads = [[rev] for rev in baseVersions] # list of heads for each rev
-		paths = [set([rev]) for rev in baseVersions] # visited revs for each rev
-		times = { }
-
-		# traverse all paths from all baseVersions
-		addedSth = True
-		while addedSth:
-			addedSth = False
-			for i in xrange(len(heads)):
-				oldHeads = heads[i]
-				newHeads = []
-				for head in oldHeads:
-					try:
-						stat = Connector().stat(head, stores)
-						parents = stat.parents()
-						times[head] = stat.mtime()
-						for parent in parents:
-							newHeads.append(parent)
-							paths[i].add(parent)
-							addedSth = True
-					except:
-						pass
-				heads[i] = newHeads
-
-		#print "End:"
-		#for path in paths:
-		#	print "  Path: ", [rev.encode('hex') for rev in path]
-
-		# determine youngest common version
-		commonBase = reduce(lambda x, y: x&y, paths)
-		if len(commonBase) == 0:
-			return (False, None)
+		graph = dag.RevGraph([self.__store, store], index=dag.historyIndex())
+		bases = graph.mergeBases(self.__rev, mergeRev)
+		if bases == [mergeRev]:
+			return (True, self.__rev)
+		elif bases == [self.__rev]:
+			return (True, mergeRev)
+		elif bases:
+			return (False, bases[0])
 		else:
-			# fast-forward merge?
-			# criteria: all base versions are in the same path
-			for i in xrange(len(baseVersions)):
-				path = paths[i]
-				all = True
-				for rev in baseVersions:
-					all = all and (rev in path)
-				if all:
-					return (True, baseVersions[i])
-
-			# normal merge
-			mergeBase = max(commonBase, key=lambda x: times[x])
-			return (False, mergeBase)
+			return (False, None)
 
 
 class _ChooseWidget(QtGui.QWidget):
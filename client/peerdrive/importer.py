@@ -18,17 +18,21 @@
 
 from __future__ import absolute_import
 
-import os, sys, subprocess
+import os, sys, subprocess, threading, Queue, atexit
 
-from . import struct, connector
+from . import struct, connector, extractor as extractorProtocol
 from .connector import Connector
 from .registry import Registry
 
 try:
 	import magic
-	mimeGuess = magic.open(magic.MAGIC_MIME)
-	mimeGuess.load()
+	def __openMagic():
+		guess = magic.open(magic.MAGIC_MIME)
+		guess.load()
+		return guess
+	mimeGuess = __openMagic()
 except ImportError:
+	__openMagic = lambda: None
 	mimeGuess = None
 
 
@@ -37,17 +41,197 @@ class ImporterError(Exception):
     pass
 
 
-def __runExtractor(extractor, path):
+def _startExtractor(extractor, args, **kwargs):
 	if sys.platform == "win32":
-		proc = subprocess.Popen([extractor, path], shell=True,
-			stdout=subprocess.PIPE, creationflags=0x08000000)
+		return subprocess.Popen([extractor] + args, shell=True,
+			creationflags=0x08000000, **kwargs)
 	else:
-		proc = subprocess.Popen(['./'+extractor, path], stdout=subprocess.PIPE)
+		return subprocess.Popen(['./'+extractor] + args, **kwargs)
+
+
+def _runExtractorOnce(extractor, path):
+	proc = _startExtractor(extractor, [path], stdout=subprocess.PIPE)
 	data = proc.stdout.read()
 	proc.wait()
+	if not data.strip():
+		return None
 	return connector.loadJSON(data)
 
 
+class _ExtractorError(Exception):
+	pass
+
+class _ExtractorDied(_ExtractorError):
+	pass
+
+
+# A long running extractor process speaking the protocol of
+# peerdrive.extractor. The output is read by a separate thread so that we can
+# wait for an answer with a timeout.
+class _ExtractorProcess(object):
+
+	def __init__(self, extractor, timeout):
+		self.__timeout = timeout
+		self.__lines = Queue.Queue()
+		self.__proc = _startExtractor(extractor, ["--serve"],
+			stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+		reader = threading.Thread(target=self.__reader)
+		reader.daemon = True
+		reader.start()
+		try:
+			greeting = self.__readLine()
+		except _ExtractorError:
+			self.kill()
+			raise
+		if greeting != extractorProtocol.greeting():
+			self.kill()
+			raise _ExtractorError("Extractor does not support protocol")
+
+	def __reader(self):
+		for line in iter(self.__proc.stdout.readline, ''):
+			self.__lines.put(line.rstrip('\r\n'))
+		self.__lines.put(None)
+
+	def __readLine(self):
+		try:
+			line = self.__lines.get(True, self.__timeout)
+		except Queue.Empty:
+			raise _ExtractorError("Extractor timed out")
+		if line is None:
+			raise _ExtractorDied("Extractor died")
+		return line
+
+	def extract(self, path):
+		try:
+			self.__proc.stdin.write(connector.dumpJSON(path.decode('utf8')) + '\n')
+			self.__proc.stdin.flush()
+		except IOError:
+			raise _ExtractorDied("Extractor died")
+		return connector.loadJSON(self.__readLine())
+
+	def close(self):
+		try:
+			self.__proc.stdin.close()
+		except IOError:
+			pass
+		self.__proc.wait()
+
+	def kill(self):
+		try:
+			self.__proc.kill()
+		except OSError:
+			pass
+		self.__proc.wait()
+
+
+# Pool of extractor processes for a single extractor. Each concurrent caller
+# gets its own process. Extractors which do not answer the protocol greeting
+# are run once per file as before.
+class _ExtractorPool(object):
+	TIMEOUT = 60
+
+	def __init__(self, extractor):
+		self.__extractor = extractor
+		self.__lock = threading.Lock()
+		self.__idle = []
+		self.__persistent = True
+
+	def run(self, path):
+		try:
+			path.decode('utf8')
+		except UnicodeError:
+			return _runExtractorOnce(self.__extractor, path)
+
+		# retry once if the extractor crashed
+		for attempt in xrange(2):
+			proc = self.__acquire()
+			if not proc:
+				return _runExtractorOnce(self.__extractor, path)
+			try:
+				result = proc.extract(path)
+			except _ExtractorDied:
+				proc.kill()
+				continue
+			except _ExtractorError:
+				proc.kill()
+				return None
+			self.__release(proc)
+			return result
+
+		return None
+
+	def __acquire(self):
+		with self.__lock:
+			if not self.__persistent:
+				return None
+			if self.__idle:
+				return self.__idle.pop()
+		try:
+			return _ExtractorProcess(self.__extractor, _ExtractorPool.TIMEOUT)
+		except (_ExtractorError, OSError):
+			with self.__lock:
+				self.__persistent = False
+			return None
+
+	def __release(self, proc):
+		with self.__lock:
+			self.__idle.append(proc)
+
+	def close(self):
+		with self.__lock:
+			idle = self.__idle
+			self.__idle = []
+		for proc in idle:
+			proc.close()
+
+
+__extractorPools = {}
+__extractorLock = threading.Lock()
+
+def __runExtractor(extractor, path):
+	with __extractorLock:
+		pool = __extractorPools.get(extractor)
+		if not pool:
+			pool = __extractorPools[extractor] = _ExtractorPool(extractor)
+	return pool.run(path)
+
+
+@atexit.register
+def __closeExtractors():
+	for pool in __extractorPools.values():
+		pool.close()
+
+
+# File object wrapper that reports the number of bytes read so far
+class _ProgressReader(object):
+	STEP = 0x100000
+
+	def __init__(self, file, path, progress):
+		self.__file = file
+		self.__path = path
+		self.__progress = progress
+		self.__size = os.fstat(file.fileno()).st_size
+		self.__done = 0
+		self.__reported = 0
+
+	def read(self, size):
+		data = self.__file.read(size)
+		self.__done += len(data)
+		if (self.__done - self.__reported >= _ProgressReader.STEP) or not data:
+			self.__reported = self.__done
+			self.__progress(self.__path, self.__done, self.__size)
+		return data
+
+
+# Stream the file into the handle with a fixed amount of memory. The optional
+# progress callback is called as progress(path, done, total) while copying.
+def __writeFile(writer, path, progress=None):
+	with open(path, "rb") as file:
+		if progress:
+			file = _ProgressReader(file, path, progress)
+		writer.writeFrom('_', file)
+
+
 def __merge(old, new):
 	for (key, newValue) in new.items():
 		if key in old:
@@ -64,8 +248,57 @@ def __merge(old, new):
 			old[key] = newValue
 
 
+def __getUti(path, guess):
+	uti = None
+	if guess:
+		mime = guess.file(path)
+		uti = Registry().getUtiFromMime(mime, None)
+	if not uti:
+		ext  = os.path.splitext(path)[1].lower()
+		uti  = Registry().getUtiFromExtension(ext)
+	return uti
+
+
+# determine file type and meta data; returns (uti, meta)
+def __prepareFile(path, name, guess):
+	uti = __getUti(path, guess)
+	meta = {
+		"org.peerdrive.annotation" : {
+			"title"   : name,
+			"origin"  : path
+		}
+	}
+
+	extractor = Registry().getExtractor(uti)
+	if extractor:
+		additionalMeta = __runExtractor(extractor, path)
+		if additionalMeta:
+			__merge(meta, additionalMeta)
+
+	return (uti, meta)
+
+
+def __uploadFile(store, path, uti, meta, progress, conn=None):
+	writer = (conn or Connector()).create(store, uti, "")
+	try:
+		writer.setData('', meta)
+		__writeFile(writer, path, progress)
+		writer.commit("Import from external file system")
+		return writer
+	except:
+		writer.close()
+		raise
+
+
 # returns a commited writer, None or throws an IOError
-def importFile(store, path, name="", progress=None):
+#
+# Directories are imported recursively. If jobs is greater than one the files
+# are imported by a pool of worker threads, each with its own connection to
+# the server. The main thread only creates the folders.
+#
+# done(path, size) is called by the calling thread for every file that was
+# uploaded and committed.
+def importFile(store, path, name="", progress=None, jobs=1, done=None):
 	if not name:
 		name = os.path.basename(path)
 
@@ -73,47 +306,26 @@ def importFile(store, path, name="", progress=None):
 		if progress:
 			progress(path)
 
-		# determine file type
-		uti = None
-		if mimeGuess:
-			mime = mimeGuess.file(path)
-			uti = Registry().getUtiFromMime(mime, None)
-		if not uti:
-			ext  = os.path.splitext(path)[1].lower()
-			uti  = Registry().getUtiFromExtension(ext)
-		meta = {
-			"org.peerdrive.annotation" : {
-				"title"   : name,
-				"origin"  : path
-			}
-		}
-
-		extractor = Registry().getExtractor(uti)
-		if extractor:
-			additionalMeta = __runExtractor(extractor, path)
-			if additionalMeta:
-				__merge(meta, additionalMeta)
-
-		with open(path, "rb") as file:
-			writer = Connector().create(store, uti, "")
-			try:
-				writer.setData('', meta)
-				writer.write('_', file.read())
-				writer.commit("Import from external file system")
-				return writer
-			except:
-				writer.close()
-				raise
+		(uti, meta) = __prepareFile(path, name, mimeGuess)
+		handle = __uploadFile(store, path, uti, meta, progress)
+		if done:
+			done(path, handle.tell('_'))
+		return handle
 	elif os.path.isdir(path):
+		if jobs > 1:
+			return __importTree(store, path, name, progress, jobs, done)
+
 		handles = []
 		try:
 			for entry in os.listdir(path):
-				handle = importFile(store, os.path.join(path, entry), entry, progress)
-				handles.append(handle)
+				handle = importFile(store, os.path.join(path, entry), entry,
+					progress, done=done)
+				if handle:
+					handles.append(handle)
 
 			folder = struct.Folder()
-			for handle in handles:
-				folder.append(connector.DocLink(store, handle.getDoc()))
+			folder.extend([ connector.DocLink(store, h.getDoc(), False)
+				for h in handles ])
 
 			return folder.create(store, name)
 		finally:
@@ -123,18 +335,145 @@ def importFile(store, path, name="", progress=None):
 		return None
 
 
-def overwriteFile(link, path):
+class _TreeNode(object):
+	__slots__ = ['name', 'path', 'children', 'doc', 'size']
+
+	def __init__(self, name, path, children=None):
+		self.name = name
+		self.path = path
+		self.children = children
+		self.doc = None
+		self.size = 0
+
+
+def __scanTree(name, path, files):
+	if os.path.isfile(path):
+		node = _TreeNode(name, path)
+		files.append(node)
+		return node
+	elif os.path.isdir(path):
+		children = [ __scanTree(entry, os.path.join(path, entry), files) for
+			entry in os.listdir(path) ]
+		return _TreeNode(name, path, [ c for c in children if c ])
+	else:
+		return None
+
+
+def __importWorker(store, pool, tasks, results, abort, progress):
+	guess = __openMagic()
+	while not abort.is_set():
+		try:
+			node = tasks.get_nowait()
+		except Queue.Empty:
+			return
+		try:
+			(uti, meta) = __prepareFile(node.path, node.name, guess)
+			if progress:
+				progress(node.path)
+			handle = __uploadFile(store, node.path, uti, meta, progress, pool)
+			node.size = handle.tell('_')
+			result = (node, handle, None)
+		except:
+			result = (node, None, sys.exc_info())
+
+		# the queue is bounded; don't block forever if the import was aborted
+		while not abort.is_set():
+			try:
+				results.put(result, True, 0.1)
+				break
+			except Queue.Full:
+				pass
+		else:
+			# nobody will pick up the handle anymore
+			if result[1]:
+				result[1].close()
+
+
+def __createFolders(store, node):
+	handles = []
+	try:
+		links = []
+		for child in node.children:
+			if child.children is not None:
+				handle = __createFolders(store, child)
+				handles.append(handle)
+				links.append(connector.DocLink(store, handle.getDoc(), False))
+			elif child.doc:
+				links.append(connector.DocLink(store, child.doc, False))
+
+		folder = struct.Folder()
+		folder.extend(links)
+		return folder.create(store, node.name)
+	finally:
+		for handle in handles:
+			handle.close()
+
+
+def __importTree(store, path, name, progress, jobs, done):
+	files = []
+	root = __scanTree(name, path, files)
+
+	# The registry must be instantiated by the main thread. The default
+	# connection is not thread safe and hence only used by the main thread.
+	# The workers use the connection pool.
+	Registry()
+	pool = connector.ConnectionPool(jobs)
+
+	# progress callbacks are serialized
+	if progress:
+		lock = threading.Lock()
+		def report(*args):
+			with lock:
+				progress(*args)
+	else:
+		report = None
+
+	tasks = Queue.Queue()
+	for node in files:
+		tasks.put(node)
+	results = Queue.Queue(jobs * 2)
+	abort = threading.Event()
+	workers = [ threading.Thread(target=__importWorker,
+		args=(store, pool, tasks, results, abort, report)) for i in xrange(jobs) ]
+	for worker in workers:
+		worker.daemon = True
+		worker.start()
+
+	handles = []
+	try:
+		for i in xrange(len(files)):
+			(node, handle, error) = results.get()
+			if error:
+				raise error[0], error[1], error[2]
+			handles.append(handle)
+			node.doc = handle.getDoc()
+			if done:
+				done(node.path, node.size)
+
+		return __createFolders(store, root)
+	finally:
+		abort.set()
+		for worker in workers:
+			worker.join()
+		# drain uploads that finished after an error
+		while True:
+			try:
+				(node, handle, error) = results.get_nowait()
+			except Queue.Empty:
+				break
+			if handle:
+				handles.append(handle)
+		for handle in handles:
+			handle.close()
+		pool.close()
+
+
+def overwriteFile(link, path, progress=None):
 	if not os.path.isfile(path):
 		return False
 
 	# determine file type
-	uti = None
-	if mimeGuess:
-		mime = mimeGuess.file(path)
-		uti = Registry().getUtiFromMime(mime, None)
-	if not uti:
-		ext  = os.path.splitext(path)[1].lower()
-		uti  = Registry().getUtiFromExtension(ext)
+	uti = __getUti(path, mimeGuess)
 
 	link.update()
 	store = link.store()
@@ -152,8 +491,9 @@ def overwriteFile(link, path):
 			if additionalMeta:
 				__merge(meta, additionalMeta)
 
-		with open(path, "rb") as file:
-			writer.writeAll('_', file.read())
+		writer.seek('_', 0)
+		writer.truncate('_')
+		__writeFile(writer, path, progress)
 		writer.setData('', meta)
 		writer.setType(uti)
 		writer.commit("Overwritten from external file system")
@@ -225,11 +565,15 @@ def importObjectByPath(path, uti, data, spec, overwrite=False, flags=[]):
 		return False
 
 
-def importFileByPath(impPath, impFile, overwrite=False, progress=None, error=None):
+# done(path, size) is called for every file that ended up in the folder after
+# it was saved. Files of failed or skipped items are not reported.
+def importFileByPath(impPath, impFile, overwrite=False, progress=None, error=None,
+                     jobs=1, done=None):
 	# resolve the path
 	(store, folder, name) = struct.walkPath(impPath, True)
 
 	# create the object and add to dict
+	imported = []
 	if isinstance(impFile, list):
 		counter = 0
 		handles = []
@@ -241,10 +585,13 @@ def importFileByPath(impPath, impFile, overwrite=False, progress=None, error=Non
 					nn = "%s%d" % (name, counter)
 				if progress:
 					progress(f, nn)
-				handle = importFile(store, f)
+				files = []
+				handle = importFile(store, f, jobs=jobs,
+					done=lambda *args: files.append(args))
 				if handle:
 					handles.append(handle)
-					folder[nn] = connector.DocLink(store, handle.getDoc())
+					folder.append(connector.DocLink(store, handle.getDoc()))
+					imported.extend(files)
 				elif error:
 					error(f, nn)
 			folder.save()
@@ -255,13 +602,17 @@ def importFileByPath(impPath, impFile, overwrite=False, progress=None, error=Non
 		if (name in folder) and (not overwrite):
 			raise ImporterError("Duplicate item name")
 
-		handle = importFile(store, impFile, name)
+		handle = importFile(store, impFile, name, jobs=jobs,
+			done=lambda *args: imported.append(args))
+		if not handle:
+			raise ImporterError("Invalid file")
 		try:
-			if handle:
-				folder[name] = connector.DocLink(store, handle.getDoc())
-				folder.save()
-			else:
-				raise ImporterError("Invalid file")
+			folder.append(connector.DocLink(store, handle.getDoc()))
+			folder.save()
 		finally:
 			handle.close()
 
+	if done:
+		for (path, size) in imported:
+			done(path, size)
+
@@ -0,0 +1,62 @@
+# vim: set fileencoding=utf-8 :
+#
+# PeerDrive
+# Copyright (C) 2011  Jan Klötzke <jan DOT kloetzke AT freenet DOT de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+from PyQt4 import QtCore, QtNetwork
+
+# Connection to the server for Qt applications. Incoming data is processed as
+# soon as the event loop notices it and indications that arrive while a
+# request is pending are dispatched later from the event loop.
+class QtTransport(QtCore.QObject):
+	dispatchReady = QtCore.pyqtSignal()
+
+	def __init__(self, host, port, readReady, dispatch):
+		super(QtTransport, self).__init__()
+		self.__socket = QtNetwork.QTcpSocket()
+		self.__socket.readyRead.connect(readReady)
+		self.__socket.connectToHost(host, port)
+		if not self.__socket.waitForConnected(1000):
+			raise IOError("Could not connect to server!")
+		self.__socket.setSocketOption(QtNetwork.QAbstractSocket.LowDelayOption, 1)
+		self.dispatchReady.connect(dispatch, QtCore.Qt.QueuedConnection)
+
+	def write(self, data):
+		if self.__socket.write(data) == -1:
+			raise IOError("Could not send request to server: "
+				+ str(self.__socket.errorString()))
+
+	def flush(self):
+		while self.__socket.flush():
+			self.__socket.waitForBytesWritten(10000)
+
+	# timeout in milliseconds, -1 waits forever
+	def waitForReadyRead(self, timeout):
+		return self.__socket.waitForReadyRead(timeout)
+
+	def readAll(self):
+		return str(self.__socket.readAll())
+
+	def errorString(self):
+		return str(self.__socket.errorString())
+
+	def deferDispatch(self):
+		self.dispatchReady.emit()
+
+	def close(self):
+		self.__socket.disconnectFromHost()
@@ -37,7 +37,17 @@ class _Registry(connector.Watch):
 	def loadRegistry(self):
 		self.__regLink.update()
 		with self.connection.peek(self.__regLink.store(), self.__regLink.rev()) as r:
-			self.registry = r.getData('/org.peerdrive.registry')
+			self._buildIndexes(r.getData('/org.peerdrive.registry'))
+
+	# The registry and its lookup indexes are replaced together by a single
+	# assignment when the registry is (re)loaded. Importer threads query the
+	# registry concurrently and every lookup uses just one _RegistryIndex.
+	def _buildIndexes(self, registry):
+		self.__index = _RegistryIndex(registry)
+
+	@property
+	def registry(self):
+		return self.__index.registry
 
 	def triggered(self, event, store):
 		if event == connector.Watch.EVENT_MODIFIED:
@@ -56,79 +66,127 @@ class _Registry(connector.Watch):
 		return reduce(lambda x,y: x+y, self.searchAll(uti, "meta").values(), [])
 
 	def getUtiFromExtension(self, ext, default = "public.data"):
-		for (uti, spec) in self.registry.items():
-			if "extensions" in spec:
-				if ext in spec["extensions"]:
-					return uti
-		return default
+		return self.__index.extensions.get(ext, default)
 
 	def getUtiFromMime(self, mime, default = "public.data"):
 		mime = mime.split(';')[0].strip()
 		# maybe support mime parameters too?
-		for (uti, spec) in self.registry.items():
-			if "mimetypes" in spec:
-				if mime in spec["mimetypes"]:
-					return uti
-		return default
+		return self.__index.mimetypes.get(mime, default)
 
 	def getExtractor(self, uti):
 		return self.search(uti, "extractor")
 
 	def getExecutables(self, uti):
-		preliminary = self.__getExecutables(uti)
-		# remove duplicate items
-		result = []
-		for i in preliminary:
-			if i not in result:
-				result.append(i)
-		return result
+		return self.__index.getExecutables(uti)
 
 	def conformes(self, uti, superClass):
-		if uti == superClass:
-			return True
-		result = False
-		item = self.registry.get(uti, {})
-		for i in item.get("conforming", []):
-			result = result or self.conformes(i, superClass)
-		return result
+		return superClass in self.__index.getAncestors(uti)
+
+	def search(self, uti, key, recursive=True, default=None):
+		return self.__index.search(uti, key, recursive, default)
+
+	def searchAll(self, uti, key):
+		return self.__index.searchAll(uti, key)
+
+
+# Lookup indexes and memoized searches of one version of the registry. The
+# caches only ever get entries that were computed from this registry.
+class _RegistryIndex(object):
+
+	def __init__(self, registry):
+		self.registry = registry
+		self.extensions = {}
+		self.mimetypes = {}
+		for (uti, spec) in registry.items():
+			for ext in spec.get("extensions", []):
+				self.extensions.setdefault(ext, uti)
+			for mime in spec.get("mimetypes", []):
+				self.mimetypes.setdefault(mime, uti)
+		self.__ancestors = {}
+		self.__searchCache = {}
+		self.__searchAllCache = {}
+		self.__execCache = {}
 
-	def __getExecutables(self, uti):
+	def getExecutables(self, uti):
+		result = self.__execCache.get(uti)
+		if result is None:
+			preliminary = self.__getExecutables(uti, set())
+			# remove duplicate items
+			result = []
+			for i in preliminary:
+				if i not in result:
+					result.append(i)
+			self.__execCache[uti] = result
+		return result[:]
+
+	# returns the set of the UTI itself and all UTIs it conforms to
+	def getAncestors(self, uti):
+		ancestors = self.__ancestors.get(uti)
+		if ancestors is None:
+			ancestors = set([uti])
+			todo = [uti]
+			while todo:
+				item = self.registry.get(todo.pop(), {})
+				for i in item.get("conforming", []):
+					if i not in ancestors:
+						ancestors.add(i)
+						todo.append(i)
+			self.__ancestors[uti] = ancestors
+		return ancestors
+
+	def __getExecutables(self, uti, visited):
+		if uti in visited:
+			return []
+		visited.add(uti)
 		item = self.registry.get(uti, {})
-		data = item.get("exec", [])
+		data = list(item.get("exec", []))
 		for i in item.get("conforming", []):
-			data.extend(self.__getExecutables(i))
+			data.extend(self.__getExecutables(i, visited))
 		return data
 
-	def search(self, uti, key, recursive=True, default=None):
-		if uti not in self.registry:
+	def search(self, uti, key, recursive, default):
+		if not recursive:
+			return self.registry.get(uti, {}).get(key, default)
+
+		try:
+			data = self.__searchCache[(uti, key)]
+		except KeyError:
+			data = self.__searchCache[(uti, key)] = self.__search(uti, key, set())
+		if data is None:
 			return default
+		return data
 
+	# depth first search along the "conforming" graph
+	def __search(self, uti, key, visited):
+		if (uti in visited) or (uti not in self.registry):
+			return None
+		visited.add(uti)
 		item = self.registry[uti]
 		if key in item:
 			return item[key]
-		elif not recursive:
-			return default
-		elif "conforming" not in item:
-			return default
-		else:
-			for i in item["conforming"]:
-				data = self.search(i, key)
-				if not (data is None):
-					return data
-			return default
+		for i in item.get("conforming", []):
+			data = self.__search(i, key, visited)
+			if not (data is None):
+				return data
+		return None
 
 	def searchAll(self, uti, key):
-		if uti not in self.registry:
-			return {}
+		data = self.__searchAllCache.get((uti, key))
+		if data is None:
+			data = self.__searchAllCache[(uti, key)] = self.__searchAll(uti, key, set())
+		return data.copy()
 
+	def __searchAll(self, uti, key, visited):
+		if (uti in visited) or (uti not in self.registry):
+			return {}
+		visited.add(uti)
 		item = self.registry[uti]
 		if key in item:
 			data = { uti : item[key] }
 		else:
 			data = {}
-		if "conforming" in item:
-			for i in item["conforming"]:
-				data.update(self.searchAll(i, key))
+		for i in item.get("conforming", []):
+			data.update(self.__searchAll(i, key, visited))
 		return data
 
 
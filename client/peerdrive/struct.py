@@ -18,7 +18,7 @@
 
 from __future__ import absolute_import
 
-import struct, copy
+import struct, copy, gc, itertools
 
 from . import connector
 
@@ -101,7 +101,51 @@ def __mergeDict(base, versions):
 	return (newDict, conflict)
 
 
+# The items of lists are compared by their canonical forms. They are
+# hashable and equal if and only if the original values are equal so that
+# the differences can be computed with sets instead of comparing every item
+# with every other one. The canonical forms cannot contain reference cycles
+# so the garbage collector is held off while they exist. Otherwise it would
+# scan all of them over and over again on large lists.
 def __mergeList(base, versions):
+	gcEnabled = gc.isenabled()
+	gc.disable()
+	try:
+		try:
+			baseKeys = [ _canonical(item) for item in base ]
+			verKeys = [ [ _canonical(item) for item in ver ] for ver in versions ]
+		except TypeError:
+			return __mergeListSlow(base, versions)
+
+		baseSet = set(baseKeys)
+		removed = set()
+		added = []
+		addedSet = set()
+		for (ver, keys) in itertools.izip(versions, verKeys):
+			# check for removed items
+			removed.update(baseSet.difference(keys))
+			# check for added items
+			for (item, key) in itertools.izip(ver, keys):
+				if key not in baseSet and key not in addedSet:
+					addedSet.add(key)
+					added.append(item)
+
+		# apply diff, only the first occurrence of a removed item is dropped
+		newList = []
+		for (item, key) in itertools.izip(base, baseKeys):
+			if key in removed:
+				removed.remove(key)
+			else:
+				newList.append(item)
+		newList.extend(added)
+		return (newList, False)
+	finally:
+		if gcEnabled:
+			gc.enable()
+
+
+# fallback for items that have no canonical form
+def __mergeListSlow(base, versions):
 	added   = []
 	removed = []
 	for ver in versions:
@@ -125,6 +169,28 @@ def __mergeList(base, versions):
 	return (newList, False)
 
 
+_HASHABLE = set([str, unicode, int, long, float, bool, type(None),
+	connector.RevLink, connector.DocLink])
+
+# Returns a hashable representation of a PDSD value. Dicts, lists and tuples
+# are tagged because they never compare equal to each other. Raises
+# TypeError for unhashable values of other types.
+def _canonical(value):
+	t = type(value)
+	if t in _HASHABLE:
+		return value
+	elif t is dict:
+		return ('d', frozenset([ (key, item if type(item) in _HASHABLE
+			else _canonical(item)) for (key, item) in value.iteritems() ]))
+	elif t is list:
+		return ('l', tuple([ _canonical(item) for item in value ]))
+	elif t is tuple:
+		return ('t', tuple([ _canonical(item) for item in value ]))
+	else:
+		hash(value)
+		return value
+
+
 ###############################################################################
 # PeerDrive folder object
 ###############################################################################
@@ -159,8 +225,9 @@ class Folder(object):
 
 	def __doCache(self):
 		if not self.__didCache:
-			self.__content = [ (readTitle(i['']), i) for (t, i) in
-				self.__content ]
+			titles = readTitles([ i[''] for (t, i) in self.__content ])
+			self.__content = [ (title, i) for (title, (t, i)) in
+				zip(titles, self.__content) ]
 			self.__didCache = True
 
 	def create(self, store, name=None):
@@ -171,8 +238,7 @@ class Folder(object):
 		if not name:
 			name = "New folder"
 		self.__meta = { "title" : name }
-		for (descr, item) in self.__content:
-			item[''].update(self.__store)
+		updateLinks([ item[''] for (descr, item) in self.__content ], self.__store)
 		content = [ item for (descr, item) in self.__content ]
 		w = connector.Connector().create(store, "org.peerdrive.folder", "")
 		try:
@@ -243,6 +309,14 @@ class Folder(object):
 			link.update(self.__store)
 		self.__content.append( (readTitle(link), { '' : link }) )
 
+	# append many links with a constant number of round-trips to the server
+	def extend(self, links):
+		if self.__store:
+			updateLinks(links, self.__store)
+		titles = readTitles(links)
+		self.__content.extend([ (title, { '' : link }) for (title, link) in
+			zip(titles, links) ])
+
 	def get(self, name):
 		self.__doCache()
 		i = self.__index(name, False)
@@ -269,14 +343,40 @@ class Folder(object):
 def readTitle(link, default=None):
 	rev = link.rev()
 	if rev:
-		try:
-			with connector.Connector().peek(link.store(), rev) as r:
-				return r.getData("/org.peerdrive.annotation/title")
-		except IOError:
-			pass
+		# goes through the revision cache without opening a handle on a hit
+		item = (link.store(), rev, "/org.peerdrive.annotation/title")
+		title = connector.Connector().getDataMany([item])[item]
+		if not isinstance(title, IOError):
+			return title
 
 	return default
 
+# bulk version of readTitle()
+def readTitles(links, default=None):
+	updateLinks(links)
+	selector = "/org.peerdrive.annotation/title"
+	items = [ (link.store(), link.rev(), selector) for link in links
+		if link.rev() ]
+	titles = connector.Connector().getDataMany(items)
+	result = []
+	for link in links:
+		title = titles.get((link.store(), link.rev(), selector), default)
+		if isinstance(title, IOError):
+			title = default
+		result.append(title)
+	return result
+
+# update many links with a single round-trip to the server
+def updateLinks(links, newStore=None):
+	docs = [ link.doc() for link in links if link.doc() ]
+	lookups = connector.Connector().lookupDocMany(docs)
+	for link in links:
+		lookup = lookups.get(link.doc())
+		if isinstance(lookup, IOError):
+			raise lookup
+		link.update(newStore, lookup)
+	return links
+
 
 class FSTab(object):
 	def __init__(self):
@@ -18,7 +18,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from PyQt4 import QtCore, QtGui
-from peerdrive import Connector, Registry, struct, connector
+from peerdrive import Connector, Registry, struct, connector, dag
 from peerdrive.gui.widgets import DocButton, RevButton
 from peerdrive.gui.utils import showDocument
 
@@ -293,19 +293,7 @@ class HistoryTab(QtGui.QWidget):
 		self.setLayout(layout)
 
 	def load(self, store, rev):
-		revs = []
-		heads = [rev]
-		while len(heads) > 0:
-			newHeads = []
-			for rev in heads:
-				try:
-					if rev not in revs:
-						revs.append(rev)
-						newHeads.extend(Connector().stat(rev, [store]).parents())
-				except IOError:
-					pass
-			heads = newHeads
-
+		revs = dag.RevGraph([store], index=dag.historyIndex()).history(rev, True)
 		self.__historyListBox.setRevs(store, revs)
 
 
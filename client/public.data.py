@@ -17,9 +17,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import sys, optparse, subprocess, os.path, stat, tempfile
+import sys, optparse, subprocess, os.path, stat, tempfile, shutil
 from peerdrive import Connector, Registry, fuse
-from peerdrive.connector import Link
+from peerdrive.connector import Link, PartReader
 
 usage = ("usage: %prog [options] <Document>\n\n"
 	"Document:\n"
@@ -69,7 +69,7 @@ if not path:
 	if not os.path.isfile(path):
 		with open(path, "wb") as file:
 			with Connector().peek(link.store(), link.rev()) as reader:
-				file.write(reader.readAll('_'))
+				shutil.copyfileobj(PartReader(reader, '_'), file)
 		os.chmod(path, stat.S_IREAD)
 
 
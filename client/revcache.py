@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# PeerDrive
+# Copyright (C) 2012  Jan Klötzke <jan DOT kloetzke AT freenet DOT de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys, optparse
+from peerdrive import Connector
+from peerdrive.diskcache import DiskCache
+
+parser = optparse.OptionParser(usage="usage: %prog [options]",
+	description="Inspect the persistent revision cache of the clients.")
+parser.add_option("-f", "--file", metavar="PATH",
+	help="Cache database [default: revcache.db in the settings directory]")
+parser.add_option("-v", "--verify", action="store_true",
+	help="Compare all entries with the server and drop invalid ones")
+parser.add_option("-n", "--dry-run", action="store_true",
+	help="Only report invalid entries when verifying")
+parser.add_option("-c", "--clear", action="store_true",
+	help="Remove all entries")
+
+(options, args) = parser.parse_args()
+if len(args) != 0:
+	parser.error("incorrect number of arguments")
+
+if options.verify:
+	try:
+		cache = Connector().enableDiskCache(options.file)
+		invalid = Connector().verifyDiskCache(not options.dry_run)
+	except IOError as error:
+		print "Verify failed: " + str(error)
+		sys.exit(2)
+	for key in invalid:
+		print "invalid: %s rev:%s" % (key[0], key[2 if key[0] == 'data' else 1].encode('hex'))
+	print "%d invalid entries" % len(invalid)
+else:
+	cache = DiskCache(options.file)
+
+if options.clear:
+	cache.clear()
+
+entries = {}
+for (key, value) in cache.entries():
+	(count, size) = entries.get(key[0], (0, 0))
+	entries[key[0]] = (count+1, size+len(value))
+for (kind, (count, size)) in sorted(entries.items()):
+	print "%-6s %8d entries %10d bytes" % (kind, count, size)
+print "total  %8d bytes of %d" % (cache.size(), cache.budget)
+if options.verify:
+	Connector().disableDiskCache()
+else:
+	cache.close()
@@ -2,9 +2,22 @@ import unittest
 import time
 import subprocess
 import datetime
+import StringIO
+import collections
+import copy
+import tempfile
+import shutil
+import os.path
+import threading
+import random
+import gc
 from peerdrive import Connector
 from peerdrive import connector
 from peerdrive import struct
+from peerdrive import diskcache
+from peerdrive import aio
+from peerdrive import dag
+from views import diff3
 
 STORE1 = 'rem1'
 STORE2 = 'rem2'
@@ -146,6 +159,61 @@ class TestReadWrite(CommonParts):
 
 		self.assertEqual(dataOrig, dataRead)
 
+	def test_readback_stream(self):
+		dataOrig = 'abcdefghijklmnopqrstuvwxyz' * 1024
+		w = self.create(self.store1)
+		w.writeAll('FILE', dataOrig)
+		w.commit()
+		rev = w.getRev()
+
+		with Connector().peek(self.store1, rev) as r:
+			self.assertEqual(dataOrig, ''.join(r.iterRead('FILE')))
+			r.seek('FILE', 10)
+			buf = bytearray(100)
+			self.assertEqual(r.readinto('FILE', buf), 100)
+			self.assertEqual(dataOrig[10:110], str(buf))
+			reader = connector.PartReader(r, 'FILE')
+			self.assertEqual(dataOrig, reader.read())
+			self.assertEqual(r.tell('FILE'), 110)
+
+	def test_readback_readahead(self):
+		dataOrig = 'abcdefghijklmnopqrstuvwxyz' * 4096
+		w = self.create(self.store1)
+		w.writeAll('FILE', dataOrig)
+		w.commit()
+		rev = w.getRev()
+
+		for (window, maxWindow) in [(1, 1), (4, 4), (2, 64)]:
+			with Connector().peek(self.store1, rev) as r:
+				r.setReadAhead(window, maxWindow)
+				self.assertEqual(dataOrig, r.readAll('FILE'))
+				r.seek('FILE', 100)
+				self.assertEqual(dataOrig[100:50000], r.read('FILE', 49900))
+				self.assertEqual(r.tell('FILE'), 50000)
+
+	def test_write_stream(self):
+		dataOrig = 'abcdefghijklmnopqrstuvwxyz' * 4096
+		w = self.create(self.store1)
+		w.setWriteWindow(4)
+		self.assertEqual(w.writeFrom('FILE', StringIO.StringIO(dataOrig)),
+			len(dataOrig))
+		w.seek('FILE', 10)
+		w.write('FILE', 'fubar')
+		w.commit()
+		rev = w.getRev()
+
+		self.assertRevContent(self.store1, rev,
+			{'FILE' : dataOrig[:10] + 'fubar' + dataOrig[15:]})
+
+	def test_write_pdsd(self):
+		data = { 'org.peerdrive.folder' : [ { '' : i } for i in xrange(20000) ] }
+		w = self.create(self.store1)
+		self.assertEqual(w.writePDSD('PDSD', data), len(connector.dumpPDSD(data)))
+		w.commit()
+		rev = w.getRev()
+
+		self.assertRevContent(self.store1, rev, {'PDSD' : connector.dumpPDSD(data)})
+
 	def test_mtime(self):
 		w = self.create(self.store1)
 		w.writeAll('FILE', "fubar")
@@ -156,6 +224,229 @@ class TestReadWrite(CommonParts):
 		self.assertTrue(s.mtime() <= now)
 		self.assertTrue(s.mtime() > now - datetime.timedelta(seconds=3))
 
+	def test_rev_cache(self):
+		w = self.create(self.store1)
+		w.writeAll('FILE', "fubar")
+		w.commit()
+		rev = w.getRev()
+		cache = Connector().revCache
+		s = Connector().stat(rev)
+		hits = cache.hits
+		self.assertTrue(Connector().stat(rev) is s)
+		self.assertEqual(cache.hits, hits+1)
+		self.assertEqual(Connector().statMany([rev])[rev].size('FILE'), 5)
+
+
+
+class TestDocCache(CommonParts):
+
+	def setUp(self):
+		CommonParts.setUp(self)
+		self.cache = Connector().enableDocCache(4)
+
+	def tearDown(self):
+		Connector().disableDocCache()
+		CommonParts.tearDown(self)
+
+	def test_hit(self):
+		w = self.create(self.store1)
+		w.commit()
+		doc = w.getDoc()
+		l = Connector().lookupDoc(doc)
+		hits = self.cache.hits
+		self.assertTrue(Connector().lookupDoc(doc) is l)
+		self.assertEqual(self.cache.hits, hits+1)
+		self.assertEqual(Connector().lookupDocMany([doc])[doc].revs(), [w.getRev()])
+
+	def test_commit(self):
+		w = self.create(self.store1)
+		w.commit()
+		doc = w.getDoc()
+		self.assertEqual(Connector().lookupDoc(doc).revs(), [w.getRev()])
+		w.write('FILE', 'update')
+		w.commit()
+		self.assertEqual(Connector().lookupDoc(doc).revs(), [w.getRev()])
+
+	def test_foreign_update(self):
+		w = self.create(self.store1)
+		w.commit()
+		doc = w.getDoc()
+		rev1 = w.getRev()
+		self.assertEqual(Connector().lookupDoc(doc, [self.store1]).revs(), [rev1])
+
+		# update through another connection
+		watch = self.watchDoc(doc, connector.Watch.EVENT_MODIFIED)
+		other = connector._Connector()
+		with other.update(self.store1, doc, rev1) as w:
+			w.write('FILE', 'update')
+			w.commit()
+			rev2 = w.getRev()
+		self.assertTrue(watch.waitForWatch())
+		self.assertEqual(Connector().lookupDoc(doc, [self.store1]).revs(), [rev2])
+
+	def test_evict(self):
+		docs = []
+		for i in xrange(6):
+			w = self.create(self.store1)
+			w.commit()
+			docs.append(w.getDoc())
+		lookups = Connector().lookupDocMany(docs)
+		self.assertEqual(len(lookups), 6)
+		self.assertEqual(len(self.cache), 4)
+		Connector().lookupDoc(docs[0])
+		self.assertEqual(len(self.cache), 4)
+		self.assertTrue(docs[0] in self.cache)
+
+
+class TestAsyncConnector(CommonParts):
+
+	def run_coroutine(self, func):
+		return aio.getLoop().runUntilComplete(aio.coroutine(func)())
+
+	def test_many(self):
+		revs = []
+		for i in xrange(10):
+			w = self.create(self.store1)
+			w.writeAll('FILE', 'data%d' % i)
+			w.commit()
+			revs.append(w.getRev())
+
+		def check():
+			c = yield aio.connect()
+			try:
+				stats = yield aio.gather([ c.stat(rev) for rev in revs ])
+				handles = yield aio.gather([ c.peek(self.store1, rev) for rev in revs ])
+				data = yield aio.gather([ h.read('FILE') for h in handles ])
+				yield aio.gather([ h.close() for h in handles ])
+			finally:
+				c.close()
+			raise aio.Return((stats, data))
+
+		(stats, data) = self.run_coroutine(check)
+		self.assertEqual([ s.type() for s in stats ], ['public.data'] * 10)
+		self.assertEqual(data, [ 'data%d' % i for i in xrange(10) ])
+
+	def test_write(self):
+		def write():
+			c = yield aio.connect()
+			try:
+				w = yield c.create(self.store1, 'public.data', 'org.peerdrive.test-py')
+				yield w.writeAll('FILE', 'x' * 300000)
+				yield w.commit()
+				yield w.close()
+			finally:
+				c.close()
+			raise aio.Return(w.getRev())
+
+		rev = self.run_coroutine(write)
+		with Connector().peek(self.store1, rev) as r:
+			self.assertEqual(r.readAll('FILE'), 'x' * 300000)
+
+	def test_error(self):
+		def stat():
+			c = yield aio.connect()
+			try:
+				yield c.stat('\0' * 16)
+			finally:
+				c.close()
+
+		self.assertRaises(IOError, self.run_coroutine, stat)
+
+	def test_watch(self):
+		w = self.create(self.store1)
+		w.commit()
+		doc = w.getDoc()
+		rev = w.getRev()
+
+		class Watch(connector.Watch):
+			def triggered(self, cause, store):
+				if not self.fired.done():
+					self.fired.setResult(cause)
+
+		def watch():
+			c = yield aio.connect()
+			try:
+				watch = Watch(connector.Watch.TYPE_DOC, doc)
+				watch.fired = aio.Future()
+				yield c.watch(watch)
+				with Connector().update(self.store1, doc, rev) as u:
+					u.write('FILE', 'update')
+					u.commit()
+				cause = yield watch.fired
+				yield c.unwatch(watch)
+			finally:
+				c.close()
+			raise aio.Return(cause)
+
+		self.assertEqual(self.run_coroutine(watch), connector.Watch.EVENT_MODIFIED)
+
+
+class TestConnectionPool(CommonParts):
+
+	def setUp(self):
+		CommonParts.setUp(self)
+		self.pool = connector.ConnectionPool(3)
+
+	def tearDown(self):
+		self.pool.close()
+		CommonParts.tearDown(self)
+
+	def test_threads(self):
+		results = {}
+		def work(i):
+			try:
+				with self.pool.create(self.store1, 'public.data', 'org.peerdrive.test-py') as w:
+					w.writeAll('FILE', 'data%d' % i)
+					w.commit()
+					self.assertEqual(self.pool.lookupDoc(w.getDoc()).revs(), [w.getRev()])
+				with self.pool.peek(self.store1, w.getRev()) as r:
+					results[i] = r.readAll('FILE')
+			except Exception as e:
+				results[i] = e
+
+		threads = [ threading.Thread(target=work, args=(i,)) for i in xrange(8) ]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		self.assertEqual(results, dict((i, 'data%d' % i) for i in xrange(8)))
+		metrics = self.pool.metrics()
+		self.assertEqual(len(metrics), 3)
+		self.assertEqual(sum(m['inFlight'] for m in metrics), 0)
+		self.assertEqual(sum(m['users'] for m in metrics), 0)
+		self.assertTrue(all(m['requests'] > 0 for m in metrics))
+
+	def test_pinned(self):
+		with self.pool.connection() as busy:
+			w = self.pool.create(self.store1, 'public.data', 'org.peerdrive.test-py')
+			self.assertTrue(w.connector is not busy)
+			w.writeAll('FILE', 'pinned')
+			w.commit()
+			w.close()
+
+	def test_watch(self):
+		w = self.create(self.store1)
+		w.commit()
+		doc = w.getDoc()
+
+		class Watch(connector.Watch):
+			received = False
+			def triggered(self, cause, store):
+				self.received = True
+
+		watch = Watch(connector.Watch.TYPE_DOC, doc)
+		self.pool.watch(watch)
+		try:
+			with self.pool.update(self.store1, doc, w.getRev()) as u:
+				u.write('FILE', 'update')
+				u.commit()
+			latest = time.time() + 3
+			while not watch.received and time.time() < latest:
+				self.pool.process(100)
+			self.assertTrue(watch.received)
+		finally:
+			self.pool.unwatch(watch)
+
 
 class TestFlags(CommonParts):
 
@@ -872,6 +1163,426 @@ class TestSynchronization(CommonParts):
 			pdsd = sorted(struct.loads(self.store1, r.readAll('PDSD')))
 			self.assertEqual(pdsd, [{'':2},{'':3}])
 
+class PDSDConformance(object):
+	# Shared tests of the PDSD codec. Derived classes define encode(obj) and
+	# decode(store, data) for the implementation to test.
+
+	STORE = 's' * 16
+
+	VECTORS = [
+		({}, '\x00\x00\x00\x00\x00'),
+		({'a' : 1}, '\x00\x01\x00\x00\x00\x01\x00\x00\x00a\x60\x01'),
+		([], '\x10\x00\x00\x00\x00'),
+		([True, False], '\x10\x02\x00\x00\x00\x30\x01\x30\x00'),
+		(u'\xe4', '\x20\x02\x00\x00\x00\xc3\xa4'),
+		(0, '\x60\x00'),
+		(255, '\x60\xff'),
+		(256, '\x62\x00\x01'),
+		(65536, '\x64\x00\x00\x01\x00'),
+		(2**32, '\x66\x00\x00\x00\x00\x01\x00\x00\x00'),
+		(2**64-1, '\x66' + '\xff' * 8),
+		(-1, '\x61\xff'),
+		(-129, '\x63\x7f\xff'),
+		(-32769, '\x65\xff\x7f\xff\xff'),
+		(-2**31-1, '\x67\xff\xff\xff\x7f\xff\xff\xff\xff'),
+		(1.5, '\x51\x00\x00\x00\x00\x00\x00\xf8\x3f'),
+	]
+
+	def test_vectors(self):
+		for (obj, data) in self.VECTORS:
+			self.assertEqual(self.encode(obj), data)
+			self.assertEqual(self.decode(self.STORE, data), obj)
+
+	def test_types(self):
+		self.assertEqual(self.encode('abc'), self.encode(u'abc'))
+		self.assertEqual(self.encode((1, 2)), self.encode([1, 2]))
+		self.assertEqual(self.encode(3L), self.encode(3))
+		self.assertTrue(isinstance(self.decode(self.STORE, '\x20\x00\x00\x00\x00'), unicode))
+		self.assertTrue(self.decode(self.STORE, '\x30\x01') is True)
+		self.assertTrue(isinstance(self.decode(self.STORE, '\x66' + '\x01' * 8), int))
+		self.assertTrue(isinstance(self.decode(self.STORE, '\x66' + '\xff' * 8), long))
+		self.assertEqual(self.decode(self.STORE, '\x50\x00\x00\xc0\x3f'), 1.5)
+
+	def test_links(self):
+		doc = connector.DocLink(self.STORE, 'doc', False)
+		rev = connector.RevLink(self.STORE, 'rev')
+		data = self.encode([doc, rev])
+		self.assertEqual(data, '\x10\x02\x00\x00\x00\x41\x03doc\x40\x03rev')
+		(doc, rev) = self.decode('t' * 16, data)
+		self.assertTrue(isinstance(doc, connector.DocLink))
+		self.assertEqual((doc.store(), doc.doc()), ('t' * 16, 'doc'))
+		self.assertTrue(isinstance(rev, connector.RevLink))
+		self.assertEqual((rev.store(), rev.rev()), ('t' * 16, 'rev'))
+
+	def test_dict_subclass(self):
+		d = collections.OrderedDict([('z', 1), ('a', 2)])
+		self.assertEqual(self.encode(d),
+			'\x00\x02\x00\x00\x00\x01\x00\x00\x00z\x60\x01\x01\x00\x00\x00a\x60\x02')
+
+	def test_nested(self):
+		obj = { u'list' : [ { u'x' : -5, u'y' : u'str' }, [], 1e10 ],
+			u'meta' : { u'title' : u'\u20ac' } }
+		self.assertEqual(self.decode(self.STORE, self.encode(obj)), obj)
+
+	def test_errors(self):
+		self.assertRaises(TypeError, self.encode, {1 : 2})
+		self.assertRaises(TypeError, self.encode, None)
+		self.assertRaises(TypeError, self.encode, [object()])
+		self.assertRaises(TypeError, self.decode, self.STORE, '\x99')
+		self.assertRaises(connector.struct.error, self.decode, self.STORE, '')
+		self.assertRaises(connector.struct.error, self.decode, self.STORE, '\x10\x01\x00')
+		self.assertRaises(connector.struct.error, self.decode, self.STORE,
+			'\x10\x01\x00\x00\x00')
+
+
+class TestPDSDPython(PDSDConformance, unittest.TestCase):
+
+	def encode(self, obj):
+		return connector.Encoder().encode(obj)
+
+	def decode(self, store, data):
+		return connector.Decoder(store).decode(data)
+
+	def test_iterencode(self):
+		obj = { u'a' : [ { u'b' : i, u'c' : [u'x'] * (i % 100) } for i in xrange(1000) ] }
+		for chunkSize in [1, 13, 4096]:
+			chunks = list(connector.iterDumpPDSD(obj, chunkSize))
+			self.assertEqual(''.join(chunks), self.encode(obj))
+			for chunk in chunks[:-1]:
+				self.assertEqual(len(chunk), chunkSize)
+
+
+@unittest.skipIf(connector._pdsd is None, "accelerated codec not built")
+class TestPDSDNative(PDSDConformance, unittest.TestCase):
+
+	def encode(self, obj):
+		return connector._pdsd.encode(obj)
+
+	def decode(self, store, data):
+		return connector._pdsd.decode(store, data)
+
+
+class TestLazyPDSD(unittest.TestCase):
+
+	STORE = 's' * 16
+
+	def setUp(self):
+		self.obj = {
+			u'org.peerdrive.annotation' : { u'title' : u'\xe4', u'tags' : [u'a', u'b'] },
+			u'org.peerdrive.folder' : [ { u'' : connector.DocLink(self.STORE, 'doc', False) },
+				{ u'n' : 42 } ],
+			u'x' : 1.5
+		}
+		self.raw = connector.dumpPDSD(self.obj)
+
+	def test_view(self):
+		view = connector.loadLazyPDSD(self.STORE, self.raw)
+		self.assertEqual(len(view), 3)
+		self.assertEqual(sorted(view.keys()), sorted(self.obj.keys()))
+		self.assertEqual(view['org.peerdrive.annotation']['title'], u'\xe4')
+		self.assertEqual(view['org.peerdrive.folder'][-1]['n'], 42)
+		self.assertEqual(view['org.peerdrive.folder'][0][''].doc(), 'doc')
+		self.assertEqual(view.get('nope', 0), 0)
+		self.assertTrue('x' in view)
+		self.assertEqual(view, self.obj)
+		self.assertEqual(copy.deepcopy(view), self.obj)
+		self.assertTrue(isinstance(copy.deepcopy(view), dict))
+		lst = connector.loadLazyPDSD(None, connector.dumpPDSD([1, 2, 3]))
+		self.assertEqual(lst[-3], 1)
+		self.assertRaises(IndexError, lambda: lst[-5])
+		self.assertRaises(IndexError, lambda: lst[3])
+
+	def test_select(self):
+		sel = lambda s: connector.selectPDSD(self.STORE, self.raw, s)
+		self.assertEqual(sel(''), self.obj)
+		self.assertEqual(sel('/org.peerdrive.annotation/title'), u'\xe4')
+		self.assertEqual(sel('/org.peerdrive.annotation/tags#1'), u'b')
+		self.assertEqual(sel('/org.peerdrive.folder#1/n'), 42)
+		self.assertEqual(sel('/org.peerdrive.folder#1'), { u'n' : 42 })
+		self.assertRaises(IOError, sel, '/nope')
+		self.assertRaises(IOError, sel, '/x/y')
+		self.assertRaises(IOError, sel, '/org.peerdrive.folder#2')
+		self.assertRaises(IOError, sel, 'x')
+		raw = connector.dumpPDSD({ 'a' : True })
+		self.assertRaises(IOError, connector.selectPDSD, None, raw, '/a/b')
+
+
+class TestRevCache(unittest.TestCase):
+
+	def test_lru(self):
+		cache = connector.RevCache(10)
+		cache.put('a', 1, 4)
+		cache.put('b', 2, 4)
+		self.assertEqual(cache.get('a'), 1)
+		cache.put('c', 3, 4)
+		self.assertEqual(cache.get('b'), None)
+		self.assertEqual(cache.get('a'), 1)
+		self.assertEqual(cache.get('c'), 3)
+		self.assertEqual((cache.hits, cache.misses, cache.evictions), (3, 1, 1))
+		self.assertEqual(cache.size, 8)
+
+	def test_budget(self):
+		cache = connector.RevCache(10)
+		cache.put('a', 1, 11)
+		self.assertFalse('a' in cache)
+		cache.put('a', 1, 4)
+		cache.put('a', 2, 6)
+		self.assertEqual((len(cache), cache.size), (1, 6))
+		cache.put('b', 3, 2)
+		cache.setBudget(5)
+		self.assertEqual(cache.get('a'), None)
+		self.assertEqual(cache.get('b'), 3)
+		cache.clear()
+		self.assertEqual((len(cache), cache.size), (0, 0))
+
+
+class TestDiskCache(unittest.TestCase):
+
+	STORE = 's' * 16
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, 'revcache.db')
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def test_persist(self):
+		stat = ('stat', 'r' * 16, (self.STORE, 't' * 16))
+		data = ('data', self.STORE, 'r' * 16, '/org.peerdrive.annotation')
+		with diskcache.DiskCache(self.path) as cache:
+			cache.put(stat, 'stat\0reply')
+			cache.put(data, 'pdsd')
+			self.assertEqual(cache.get(data), 'pdsd')
+		with diskcache.DiskCache(self.path) as cache:
+			self.assertEqual(cache.get(stat), 'stat\0reply')
+			self.assertEqual(cache.get(data), 'pdsd')
+			self.assertEqual(cache.get(('links', 'r' * 16, ())), None)
+			self.assertEqual(sorted(cache.entries()),
+				sorted([(stat, 'stat\0reply'), (data, 'pdsd')]))
+			cache.delete([stat])
+			self.assertEqual(cache.get(stat), None)
+
+	def test_evict(self):
+		with diskcache.DiskCache(self.path, 1000) as cache:
+			for i in xrange(100):
+				cache.put(('data', self.STORE, '%016d' % i, ''), 'x' * 100)
+			cache.flush()
+			self.assertTrue(cache.size() <= 1000)
+			self.assertEqual(cache.get(('data', self.STORE, '%016d' % 99, '')),
+				'x' * 100)
+
+
+class TestStructMerge(unittest.TestCase):
+
+	def test_list(self):
+		base = [1, 2, 3, 2, 4]
+		(result, conflict) = struct.merge(base, [[1, 3, 4, 5], [1, 2, 3, 2, 4, 6, 5]])
+		self.assertEqual(result, [1, 3, 2, 4, 5, 6])
+		self.assertFalse(conflict)
+
+	def test_nested(self):
+		a = connector.DocLink('s'*16, 'a'*16, False)
+		b = connector.DocLink('s'*16, 'b'*16, False)
+		base = [{'': a, 'x': [1]}, {'': b}]
+		(result, conflict) = struct.merge(base, [[{'': a, 'x': [1]}],
+			[{'': b}, {'': a, 'x': [1]}, {'': b, 'x': (1,)}]])
+		self.assertEqual(result, [{'': a, 'x': [1]}, {'': b, 'x': (1,)}])
+
+	def test_dict(self):
+		base = { 'a' : 1, 'b' : [1, 2], 'c' : 'x' }
+		(result, conflict) = struct.merge(base, [{ 'a' : 1, 'b' : [2], 'd' : 1 },
+			{ 'a' : 2, 'b' : [1, 2, 3], 'c' : 'x', 'd' : 1 }])
+		self.assertEqual(result, { 'a' : 2, 'b' : [2, 3], 'd' : 1 })
+		self.assertFalse(conflict)
+		(result, conflict) = struct.merge(base, [{ 'c' : 'y' }, { 'c' : 'z' }])
+		self.assertEqual(result, { 'c' : 'y' })
+		self.assertTrue(conflict)
+
+	def test_gc_restored(self):
+		class Broken(object):
+			def __hash__(self):
+				raise ValueError("broken")
+
+		self.assertTrue(gc.isenabled())
+		self.assertRaises(ValueError, struct.merge, [1], [[1, Broken()], [1]])
+		self.assertTrue(gc.isenabled())
+
+
+class TestDiff3(unittest.TestCase):
+
+	def test_clean(self):
+		base = "a\nb\nc\nd\ne\n"
+		result = diff3.text_merge(base, "a\nB\nc\nd\ne\n", "a\nb\nc\nd\nE\nf\n")
+		self.assertEqual(result, "a\nB\nc\nd\nE\nf\n")
+
+	def test_same_change(self):
+		base = "a\nb\nc\n"
+		(result, conflicts) = diff3.text_merge3(base, "a\nx\nc\n", "a\nx\nc\n")
+		self.assertEqual(result, "a\nx\nc\n")
+		self.assertFalse(conflicts)
+
+	def test_conflict(self):
+		base = "a\nb\nc\n"
+		(result, conflicts) = diff3.text_merge3(base, "a\nx\nc\n", "a\ny\nc\n")
+		self.assertEqual(result, "a\n<<<<<<<<<<<<<<<<<<<<<<<<<\nx\n"
+			"=========================\ny\n>>>>>>>>>>>>>>>>>>>>>>>>>\nc\n")
+		self.assertTrue(conflicts)
+		self.assertEqual(diff3.text_merge(base, "a\nx\nc\n", "a\ny\nc\n", 0), None)
+
+	def test_repeated(self):
+		base = "x\n" * 10
+		result = diff3.text_merge(base, "x\n" * 5 + "y\n" + "x\n" * 5,
+			"x\n" * 8)
+		self.assertEqual(result, "x\n" * 5 + "y\n" + "x\n" * 3)
+
+
+class TestRevGraph(unittest.TestCase):
+
+	class FakeStat(object):
+		def __init__(self, parents, mtime):
+			self.__parents = parents
+			self.__mtime = mtime
+
+		def parents(self):
+			return self.__parents
+
+		def mtime(self):
+			return self.__mtime
+
+	# serves the stat()s of a graph given as { rev : [parents] }, the mtime
+	# is the number of the revision unless given in 'mtimes'
+	class FakeConnector(object):
+		def __init__(self, graph, mtimes={}):
+			self.graph = graph
+			self.mtimes = mtimes
+			self.fetches = 0
+
+		def statMany(self, revs, stores=[]):
+			self.fetches += 1
+			return dict((rev, TestRevGraph.FakeStat(self.graph[rev],
+				datetime.datetime.fromtimestamp(self.mtimes.get(rev, int(rev[1:])))))
+				for rev in revs)
+
+	def graph(self, edges, index=None):
+		return dag.RevGraph(connector=TestRevGraph.FakeConnector(edges),
+			index=index)
+
+	def test_fastforward(self):
+		g = self.graph({ 'r0' : [], 'r1' : ['r0'], 'r2' : ['r1'] })
+		self.assertEqual(g.mergeBases('r2', 'r0'), ['r0'])
+		self.assertEqual(g.mergeBases('r0', 'r2'), ['r0'])
+		self.assertEqual(g.mergeBase('r1', 'r1'), 'r1')
+		self.assertTrue(g.isAncestor('r0', 'r2'))
+		self.assertFalse(g.isAncestor('r2', 'r0'))
+
+	def test_crisscross(self):
+		#   r0 - r1 - r3 - r5
+		#     \     X
+		#      r2 - r4 - r6
+		g = self.graph({ 'r0' : [], 'r1' : ['r0'], 'r2' : ['r0'],
+			'r3' : ['r1', 'r2'], 'r4' : ['r2', 'r1'], 'r5' : ['r3'],
+			'r6' : ['r4'] })
+		self.assertEqual(g.mergeBases('r5', 'r6'), ['r2', 'r1'])
+		self.assertEqual(g.mergeBase('r5', 'r6'), 'r2')
+		self.assertEqual(g.history('r6'), ['r6', 'r4', 'r2', 'r1', 'r0'])
+
+	def test_unrelated(self):
+		g = self.graph({ 'r0' : [], 'r1' : [] })
+		self.assertEqual(g.mergeBases('r0', 'r1'), [])
+		self.assertEqual(g.mergeBase('r0', 'r1'), None)
+
+	def test_index(self):
+		edges = { 'r0' : [], 'r1' : ['r0'], 'r2' : ['r0'], 'r3' : ['r1', 'r2'],
+			'r4' : ['r3'], 'r5' : ['r2'] }
+		tmp = tempfile.mkdtemp()
+		try:
+			with dag.HistoryIndex(os.path.join(tmp, 'history.db')) as index:
+				# r1 is older than its parent
+				c = TestRevGraph.FakeConnector(edges, { 'r1' : -1 })
+				g = dag.RevGraph(connector=c, index=index)
+				self.assertEqual(g.history('r4'), ['r4', 'r3', 'r2', 'r0', 'r1'])
+				self.assertEqual(g.history('r4', True), ['r4', 'r3', 'r2', 'r1', 'r0'])
+				self.assertEqual(g.generation('r4'), 4)
+				self.assertEqual(len(index), 5)
+
+				# indexed revisions do not need the server anymore
+				c = TestRevGraph.FakeConnector(edges)
+				g = dag.RevGraph(connector=c, index=index)
+				self.assertTrue(g.isAncestor('r2', 'r4'))
+				self.assertFalse(g.isAncestor('r4', 'r1'))
+				self.assertEqual(g.mergeBases('r4', 'r1'), ['r1'])
+				self.assertEqual(c.fetches, 0)
+
+				# new revisions are added once their parents are indexed
+				self.assertEqual(g.mergeBase('r4', 'r5'), 'r2')
+				self.assertEqual(c.fetches, 1)
+				self.assertEqual(index.get(['r5'])['r5'][:2], (('r2',), 3))
+		finally:
+			shutil.rmtree(tmp)
+
+	def test_random(self):
+		rnd = random.Random(4711)
+		edges = { 'r0' : [] }
+		heads = ['r0'] * 3
+		for i in xrange(1, 300):
+			b = rnd.randrange(3)
+			parents = set([heads[b], heads[rnd.randrange(3)]])
+			heads[b] = 'r%d' % i
+			edges[heads[b]] = list(parents)
+
+		closure = {}
+		for i in xrange(300):
+			rev = 'r%d' % i
+			closure[rev] = set([rev]).union(*[ closure[p] for p in edges[rev] ])
+		ancestors = closure.get
+
+		for i in xrange(20):
+			(a, b) = (rnd.choice(edges.keys()), rnd.choice(edges.keys()))
+			common = ancestors(a) & ancestors(b)
+			best = [ r for r in common if not any(r != other and
+				r in ancestors(other) for other in common) ]
+			g = self.graph(edges)
+			self.assertEqual(set(g.mergeBases(a, b)), set(best))
+			self.assertEqual(g.isAncestor(a, b), a in ancestors(b))
+
+
+class TestAioLoop(unittest.TestCase):
+
+	def test_coroutine(self):
+		@aio.coroutine
+		def double(x):
+			result = yield aio.sleep(0.01, x)
+			raise aio.Return(result * 2)
+
+		@aio.coroutine
+		def main():
+			result = yield aio.gather([ double(i) for i in xrange(5) ])
+			raise aio.Return(result)
+
+		self.assertEqual(aio.getLoop().runUntilComplete(main()), [0, 2, 4, 6, 8])
+
+	def test_exception(self):
+		@aio.coroutine
+		def fail():
+			yield aio.sleep(0)
+			raise IOError('failed')
+
+		@aio.coroutine
+		def main():
+			try:
+				yield fail()
+			except IOError:
+				raise aio.Return(True)
+
+		self.assertTrue(aio.getLoop().runUntilComplete(main()))
+		self.assertRaises(IOError, aio.getLoop().runUntilComplete, fail())
+		result = aio.getLoop().runUntilComplete(aio.gather([fail(), aio.sleep(0, 1)],
+			returnExceptions=True))
+		self.assertTrue(isinstance(result[0], IOError))
+		self.assertEqual(result[1], 1)
+
+
 if __name__ == '__main__':
 	unittest.main()
 
@@ -2,10 +2,18 @@
 """
     MoinMoin - diff3 algorithm
 
+    The lines of all three versions are mapped to integers first. Both
+    versions are then diffed against the common ancestor with a patience
+    diff that falls back to the linear space O(ND) algorithm of Myers for
+    the regions between the unique lines. Regions where the ancestor is
+    unchanged in both versions separate the chunks that have to be merged.
+
     @copyright: 2002 by Florian Festi
     @license: GNU GPL, see COPYING for details.
 """
 
+import bisect
+
 def text_merge(old, other, new, allow_conflicts=1,
                marker1='<<<<<<<<<<<<<<<<<<<<<<<<<\n',
                marker2='=========================\n',
@@ -13,185 +21,243 @@ def text_merge(old, other, new, allow_conflicts=1,
     """ do line by line diff3 merge with three strings"""
     result = merge(old.splitlines(1), other.splitlines(1), new.splitlines(1),
                    allow_conflicts, marker1, marker2, marker3)
+    if result is None:
+        return None
     return ''.join(result)
 
+def text_merge3(old, other, new,
+                marker1='<<<<<<<<<<<<<<<<<<<<<<<<<\n',
+                marker2='=========================\n',
+                marker3='>>>>>>>>>>>>>>>>>>>>>>>>>\n'):
+    """ like text_merge but always merges and returns (text, conflicts)"""
+    (result, conflicts) = merge3(old.splitlines(1), other.splitlines(1),
+                                 new.splitlines(1), marker1, marker2, marker3)
+    return (''.join(result), conflicts)
+
 def merge(old, other, new, allow_conflicts=1,
           marker1='<<<<<<<<<<<<<<<<<<<<<<<<<\n',
           marker2='=========================\n',
           marker3='>>>>>>>>>>>>>>>>>>>>>>>>>\n'):
     """ do line by line diff3 merge
         input must be lists containing single lines
+        returns None if there are conflicts and allow_conflicts is not set
     """
-    old_nr, other_nr, new_nr = 0, 0, 0
-    old_len, other_len, new_len = len(old), len(other), len(new)
+    (result, conflicts) = merge3(old, other, new, marker1, marker2, marker3)
+    if conflicts and not allow_conflicts:
+        return None
+    return result
+
+def merge3(old, other, new,
+           marker1='<<<<<<<<<<<<<<<<<<<<<<<<<\n',
+           marker2='=========================\n',
+           marker3='>>>>>>>>>>>>>>>>>>>>>>>>>\n'):
+    """ do line by line diff3 merge, returns (lines, conflicts)
+        chunks that were changed in the same way by both versions do not
+        conflict
+    """
+    ids = {}
+    old_ids = [ids.setdefault(line, len(ids)) for line in old]
+    other_ids = [ids.setdefault(line, len(ids)) for line in other]
+    new_ids = [ids.setdefault(line, len(ids)) for line in new]
+
+    # base line -> line in the version or -1
+    other_map = [-1] * len(old)
+    for (i, j) in diff(old_ids, other_ids):
+        other_map[i] = j
+    new_map = [-1] * len(old)
+    for (i, k) in diff(old_ids, new_ids):
+        new_map[i] = k
+
     result = []
-    while old_nr < old_len and other_nr < other_len  and new_nr < new_len:
-        # unchanged
-        if old[old_nr] == other[other_nr] == new[new_nr]:
+    conflicts = False
+    old_nr, other_nr, new_nr = 0, 0, 0
+    old_len = len(old)
+    while True:
+        # find the next base line that is unchanged in both versions
+        i = old_nr
+        while i < old_len and (other_map[i] < 0 or new_map[i] < 0):
+            i += 1
+        if i < old_len:
+            other_m, new_m = other_map[i], new_map[i]
+        else:
+            other_m, new_m = len(other), len(new)
+
+        # merge the chunk before it
+        old_chunk = old_ids[old_nr:i]
+        other_chunk = other_ids[other_nr:other_m]
+        new_chunk = new_ids[new_nr:new_m]
+        if other_chunk == old_chunk:
+            result.extend(new[new_nr:new_m])
+        elif new_chunk == old_chunk or new_chunk == other_chunk:
+            result.extend(other[other_nr:other_m])
+        else:
+            conflicts = True
+            result.append(marker1)
+            result.extend(other[other_nr:other_m])
+            result.append(marker2)
+            result.extend(new[new_nr:new_m])
+            result.append(marker3)
+        if i >= old_len:
+            break
+
+        # copy the unchanged lines
+        old_nr, other_nr, new_nr = i, other_m, new_m
+        while (old_nr < old_len and other_map[old_nr] == other_nr and
+               new_map[old_nr] == new_nr):
             result.append(old[old_nr])
             old_nr += 1
             other_nr += 1
             new_nr += 1
-        else:
-            new_match = find_match(old, new, old_nr, new_nr)
-            other_match = find_match(old, other, old_nr, other_nr)
-            # new is changed
-            if new_match != (old_nr, new_nr):
-                new_changed_lines = new_match[0] - old_nr
-                # other is unchanged
-                if match(old, other, old_nr, other_nr,
-                         new_changed_lines) == new_changed_lines:
-                    result.extend(new[new_nr:new_match[1]])
-                    old_nr = new_match[0]
-                    new_nr = new_match[1]
-                    other_nr += new_changed_lines
-                # both changed, conflict!
-                else:
-                    if not allow_conflicts: return None
-                    old_m, other_m, new_m = tripple_match(
-                        old, other, new, other_match, new_match)
-                    result.append(marker1)
-                    result.extend(other[other_nr:other_m])
-                    result.append(marker2)
-                    result.extend(new[new_nr:new_m])
-                    result.append(marker3)
-                    old_nr, other_nr, new_nr = old_m, other_m, new_m
-            # other is changed
-            else:
-                other_changed_lines = other_match[0] - other_nr
-                # new is unchanged
-                if match(old, new, old_nr, new_nr,
-                         other_changed_lines) == other_changed_lines:
-                    result.extend(other[other_nr:other_match[1]])
-                    old_nr = other_match[0]
-                    other_nr = other_match[1]
-                    new_nr += other_changed_lines
-                # both changed, conflict!
-                else:
-                    if not allow_conflicts: return None
-                    old_m, other_m, new_m = tripple_match(
-                        old, other, new, other_match, new_match)
-                    result.append(marker1)
-                    result.extend(other[other_nr:other_m])
-                    result.append(marker2)
-                    result.extend(new[new_nr:new_m])
-                    result.append(marker3)
-                    old_nr, other_nr, new_nr = old_m, other_m, new_m
-
-    # process tail
-    # all finished
-    if old_nr==old_len and other_nr==other_len  and new_nr==new_len:
-        pass
-    # new added lines
-    elif old_nr==old_len and other_nr==other_len:
-        result.extend(new[new_nr:])
-    # other added lines
-    elif old_nr==old_len and new_nr==new_len:
-        result.extend(other[other_nr])
-    # new deleted lines
-    elif (new_nr==new_len and (old_len-old_nr==other_len-other_nr) and
-          match(old, other, old_nr, other_nr, old_len-old_nr) ==
-          old_len-old_nr):
-        pass
-    # other deleted lines
-    elif (other_nr==other_len and (old_len-old_nr==new_len-new_nr) and
-          match(old, new, old_nr, new_nr, old_len-old_nr) ==
-          old_len-old_nr):
-        pass
-    # conflict
-    else:
-        if not allow_conflicts: return None
-        result.append(marker1)
-        result.extend(other[other_nr:])
-        result.append(marker2)
-        result.extend(new[new_nr:])
-        result.append(marker3)
-    return result
 
-def tripple_match(old, other, new, other_match, new_match):
-    """find next matching pattern unchanged in both other and new
-       return the position in all three lists
+    return (result, conflicts)
+
+def diff(list1, list2):
+    """ return the matching (index1, index2) pairs of a common subsequence
+        of two lists of hashable items, ordered by index
     """
-    while 1:
-        difference = new_match[0]-other_match[0]
-        # new changed more lines
-        if difference > 0:
-            match_len = match(old, other, other_match[0], other_match[1],
-                              difference)
-            if match_len == difference:
-                return (new_match[0], other_match[1]+difference, new_match[1])
-            else:
-                other_match =  find_match(old, other,
-                                          other_match[0] + match_len,
-                                          other_match[1] + match_len)
-        # other changed more lines
-        elif difference < 0:
-            difference = -difference
-            match_len = match(old, new, new_match[0], new_match[1],
-                              difference)
-            if match_len == difference:
-                return (other_match[0], other_match[1],
-                        new_match[0]+difference)
-            else:
-                new_match =  find_match(old, new,
-                                        new_match[0] + match_len,
-                                        new_match[1] + match_len)
-        # both conflicts change same number of lines
-        # or no match till the end
-        else:
-            return (new_match[0], other_match[1], new_match[1])
+    matches = []
+    _patience(list1, 0, len(list1), list2, 0, len(list2), matches)
+    return matches
 
-def match(list1, list2, nr1, nr2, maxcount=3):
-    """ return the number matching items after the given positions
-        maximum maxcount lines are are processed
+def _patience(a, alo, ahi, b, blo, bhi, matches):
+    """ patience diff of a[alo:ahi] and b[blo:bhi]: the lines that are
+        unique in both ranges are matched up by a longest increasing
+        subsequence and the gaps between them are diffed recursively
     """
-    i = 0
-    len1 = len(list1)
-    len2 = len(list2)
-    while nr1 < len1 and nr2 < len2 and list1[nr1] == list2[nr2]:
-        nr1 += 1
-        nr2 += 1
-        i += 1
-        if i >= maxcount and maxcount>0: break
-    return i
-
-def find_match(list1, list2, nr1, nr2, mincount=3):
-    """searches next matching pattern with lenght mincount
-       if no pattern is found len of the both lists is returned
+    # common prefix and suffix
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        matches.append((alo, blo))
+        alo += 1
+        blo += 1
+    suffix = []
+    while alo < ahi and blo < bhi and a[ahi-1] == b[bhi-1]:
+        ahi -= 1
+        bhi -= 1
+        suffix.append((ahi, bhi))
+    if alo < ahi and blo < bhi:
+        anchors = _unique_lcs(a, alo, ahi, b, blo, bhi)
+        if anchors:
+            for (i, j) in anchors:
+                if alo < i and blo < j:
+                    _patience(a, alo, i, b, blo, j, matches)
+                matches.append((i, j))
+                alo, blo = i + 1, j + 1
+            _patience(a, alo, ahi, b, blo, bhi, matches)
+        else:
+            _myers(a, alo, ahi, b, blo, bhi, matches)
+    suffix.reverse()
+    matches.extend(suffix)
+
+def _unique_lcs(a, alo, ahi, b, blo, bhi):
+    """ return the longest increasing sequence of (index1, index2) pairs of
+        the items that occur exactly once in both ranges. If there are none
+        then the items that occur equally often in both ranges are paired
+        up in order of their occurrences instead, e.g. in files that repeat
+        the same blocks of lines many times.
     """
-    len1 = len(list1)
-    len2 = len(list2)
-    hit1 = None
-    hit2 = None
-    idx1 = nr1
-    idx2 = nr2
-
-    while ((idx1 < len1) or (idx2 < len2)):
-        i =  nr1
-        while i <= idx1:
-            hit_count = match(list1, list2, i, idx2, mincount)
-            if hit_count >= mincount:
-                hit1 = (i, idx2)
-                break
-            i = i + 1
-
-        i = nr2
-        while i < idx2:
-            hit_count = match(list1, list2, idx1, i, mincount)
-            if hit_count >= mincount:
-                hit2 = (idx1, i)
-                break
-            i = i + 1
-
-        if hit1 or hit2: break
-        if idx1 < len1: idx1 = idx1 + 1
-        if idx2 < len2: idx2 = idx2 + 1
-
-    if hit1 and hit2:
-        #XXXX which one?
-        return hit1
-    elif hit1: return hit1
-    elif hit2: return hit2
-    else: return (len1, len2)
+    pos1 = {}
+    for i in xrange(alo, ahi):
+        pos1.setdefault(a[i], []).append(i)
+    pos2 = {}
+    for j in xrange(blo, bhi):
+        line = b[j]
+        if line in pos1:
+            pos2.setdefault(line, []).append(j)
+    pairs = [(pos1[l][0], js[0]) for (l, js) in pos2.iteritems()
+             if len(js) == 1 and len(pos1[l]) == 1]
+    if not pairs:
+        for (line, js) in pos2.iteritems():
+            if len(js) == len(pos1[line]):
+                pairs.extend(zip(pos1[line], js))
+    if not pairs:
+        return []
+    pairs.sort()
 
+    # patience sorting
+    tops = []
+    top_index = []
+    back = [None] * len(pairs)
+    for (n, (i, j)) in enumerate(pairs):
+        pile = bisect.bisect_left(tops, j)
+        if pile == len(tops):
+            tops.append(j)
+            top_index.append(n)
+        else:
+            tops[pile] = j
+            top_index[pile] = n
+        if pile > 0:
+            back[n] = top_index[pile-1]
+    result = []
+    n = top_index[-1]
+    while n is not None:
+        result.append(pairs[n])
+        n = back[n]
+    result.reverse()
+    return result
 
+def _myers(a, alo, ahi, b, blo, bhi, matches):
+    """ Myers' linear space O(ND) diff of a[alo:ahi] and b[blo:bhi]: the
+        middle snake of the shortest edit script splits the problem in two
+    """
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        matches.append((alo, blo))
+        alo += 1
+        blo += 1
+    suffix = []
+    while alo < ahi and blo < bhi and a[ahi-1] == b[bhi-1]:
+        ahi -= 1
+        bhi -= 1
+        suffix.append((ahi, bhi))
+    if alo < ahi and blo < bhi:
+        (x, y, u, v) = _middle_snake(a, alo, ahi, b, blo, bhi)
+        _myers(a, alo, x, b, blo, y, matches)
+        for n in xrange(u - x):
+            matches.append((x + n, y + n))
+        _myers(a, u, ahi, b, v, bhi, matches)
+    suffix.reverse()
+    matches.extend(suffix)
+
+def _middle_snake(a, alo, ahi, b, blo, bhi):
+    """ return the (x, y, u, v) start and end of the middle snake """
+    n = ahi - alo
+    m = bhi - blo
+    delta = n - m
+    odd = delta & 1
+    maxd = (n + m + 1) // 2
+    # furthest x reached on each diagonal k = x - y, only the diagonals
+    # that were visited are stored because the number of differences is
+    # usually much smaller than the length of the ranges
+    vf = {1: 0}
+    vb = {1: 0}
+    for d in xrange(maxd + 1):
+        # forward paths
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and vf[k-1] < vf[k+1]):
+                x = vf[k+1]
+            else:
+                x = vf[k-1] + 1
+            y = x - k
+            x0 = x
+            while x < n and y < m and a[alo+x] == b[blo+y]:
+                x += 1
+                y += 1
+            vf[k] = x
+            if odd and delta - d < k < delta + d:
+                if x + vb[delta-k] >= n:
+                    return (alo + x0, blo + x0 - k, alo + x, blo + y)
+        # reverse paths, counted from the ends
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and vb[k-1] < vb[k+1]):
+                x = vb[k+1]
+            else:
+                x = vb[k-1] + 1
+            y = x - k
+            x0 = x
+            while x < n and y < m and a[ahi-1-x] == b[bhi-1-y]:
+                x += 1
+                y += 1
+            vb[k] = x
+            if not odd and -d <= delta - k <= d:
+                if x + vf[delta-k] >= n:
+                    return (ahi - x, bhi - y, ahi - x0, bhi - x0 + k)
+    raise AssertionError("no middle snake")
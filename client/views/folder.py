@@ -42,13 +42,17 @@ def countFilesRecursive(path):
 def makeProgressHelper(p):
 	i = [0]
 
-	def progressHelper(path):
+	def progressHelper(path, done=None, total=None):
 		QtCore.QCoreApplication.processEvents()
-		p.setValue(i[0])
 		if len(path) > 50:
 			path = '...' + path[-50:]
-		p.setLabelText(path)
-		i[0] += 1
+		if done is None:
+			# next file
+			p.setValue(i[0])
+			p.setLabelText(path)
+			i[0] += 1
+		elif total:
+			p.setLabelText("%s (%d%%)" % (path, done * 100 / total))
 		if p.wasCanceled():
 			raise AbortException
 
@@ -117,6 +121,8 @@ class MetaColumnInfo(object):
 				item = item[step]
 			else:
 				return self.__default
+		if isinstance(item, (connector.LazyDict, connector.LazyList)):
+			item = item.decode()
 		return self.__convert(item)
 
 	def update(self, metaData, data):
@@ -217,8 +223,58 @@ def _columnFactory(key):
 	return None
 
 
+# Results of the bulk queries done when a whole folder is loaded. Entries that
+# are not contained fall back to regular queries.
+class _FolderPrefetch(object):
+	ANNOTATION = "/org.peerdrive.annotation"
+
+	def __init__(self, store, items):
+		c = Connector()
+		links = [ item[''] for item in items ]
+		docs = [ link.doc() for link in links if link.doc() ]
+		self.__lookups = c.lookupDocMany(docs)
+		revs = set()
+		for link in links:
+			if link.doc():
+				l = self.__lookups[link.doc()]
+				if not isinstance(l, IOError) and (store in l.stores()):
+					revs.add(l.rev(store))
+			elif link.rev():
+				revs.add(link.rev())
+		self.__stats = c.statMany(revs)
+		self.__metaData = c.getDataMany([ (store, rev, self.ANNOTATION)
+			for rev in revs ], raw=True)
+		self.__store = store
+
+	def lookupDoc(self, doc):
+		if doc not in self.__lookups:
+			return Connector().lookupDoc(doc)
+		return self.__get(self.__lookups[doc])
+
+	def stat(self, rev):
+		if rev not in self.__stats:
+			return Connector().stat(rev)
+		return self.__get(self.__stats[rev])
+
+	# returns a lazy view, the columns usually need only a few keys
+	def metaData(self, rev):
+		key = (self.__store, rev, self.ANNOTATION)
+		if key not in self.__metaData:
+			with Connector().peek(self.__store, rev) as r:
+				raw = r.getRawData(self.ANNOTATION)
+		else:
+			raw = self.__get(self.__metaData[key])
+		return connector.loadLazyPDSD(self.__store, raw)
+
+	@staticmethod
+	def __get(result):
+		if isinstance(result, IOError):
+			raise result
+		return result
+
+
 class FolderEntry(Watch):
-	def __init__(self, item, model, columns):
+	def __init__(self, item, model, columns, prefetch=None):
 		self.__model = model
 		self.__item  = copy.deepcopy(item)
 		self.__valid = False
@@ -230,7 +286,11 @@ class FolderEntry(Watch):
 		self.__columnDefs = columns[:]
 		self.__metaData = None
 
-		link = self.__item[''].update(self.__model.getStore())
+		link = self.__item['']
+		if prefetch and link.doc():
+			link.update(model.getStore(), prefetch.lookupDoc(link.doc()))
+		else:
+			link.update(model.getStore())
 		self.__store = model.getStore()
 		self.__doc = link.doc()
 
@@ -239,7 +299,7 @@ class FolderEntry(Watch):
 		else:
 			super(FolderEntry, self).__init__(Watch.TYPE_REV, link.rev())
 
-		self.update(False)
+		self.update(False, prefetch)
 
 	def isValid(self):
 		return self.__valid
@@ -312,7 +372,7 @@ class FolderEntry(Watch):
 	def getTypeCode(self):
 		return self.__uti
 
-	def update(self, updateItem = True):
+	def update(self, updateItem = True, prefetch = None):
 		# reset everything
 		self.__valid = False
 		self.__icon = None
@@ -325,7 +385,10 @@ class FolderEntry(Watch):
 		needMerge = False
 		isReplicated = False
 		if self.__doc:
-			l = Connector().lookupDoc(self.__doc)
+			if prefetch:
+				l = prefetch.lookupDoc(self.__doc)
+			else:
+				l = Connector().lookupDoc(self.__doc)
 			isReplicated = len(l.stores()) > 1
 			revisions = l.revs()
 			if len(revisions) == 0:
@@ -339,7 +402,10 @@ class FolderEntry(Watch):
 
 		# stat
 		try:
-			s = Connector().stat(self.__rev)
+			if prefetch:
+				s = prefetch.stat(self.__rev)
+			else:
+				s = Connector().stat(self.__rev)
 		except IOError:
 			return
 		self.__uti = s.type()
@@ -359,9 +425,9 @@ class FolderEntry(Watch):
 		self.__isFolder = Registry().conformes(self.__uti, "org.peerdrive.folder")
 		self.__replacable = not needMerge and not self.__isFolder
 		self.__valid = True
-		self.__updateColumns(s)
+		self.__updateColumns(s, prefetch)
 
-	def __updateColumns(self, stat = None):
+	def __updateColumns(self, stat = None, prefetch = None):
 		# This makes only sense if we're a valid entry
 		if not self.__valid:
 			return
@@ -369,11 +435,18 @@ class FolderEntry(Watch):
 		try:
 			if stat is None:
 				stat = Connector().stat(self.__rev)
-			with Connector().peek(self.__store, self.__rev) as r:
+			if prefetch:
 				try:
-					metaData = r.getData("/org.peerdrive.annotation")
-				except:
+					metaData = prefetch.metaData(self.__rev)
+				except IOError:
 					metaData = { }
+			else:
+				with Connector().peek(self.__store, self.__rev) as r:
+					try:
+						metaData = connector.loadLazyPDSD(self.__store,
+							r.getRawData("/org.peerdrive.annotation"))
+					except:
+						metaData = { }
 
 			for i in xrange(len(self.__columnDefs)):
 				column = self.__columnDefs[i]
@@ -428,7 +501,9 @@ class FolderModel(QtCore.QAbstractTableModel):
 		self.__store = handle.getStore()
 		self._listing = []
 		data = handle.getData('/org.peerdrive.folder')
-		listing = [ FolderEntry(item, self, self._columns) for item in data ]
+		prefetch = _FolderPrefetch(self.__store, data)
+		listing = [ FolderEntry(item, self, self._columns, prefetch) for item
+			in data ]
 		for entry in listing:
 			if entry.isValid() or (not self.__autoClean):
 				self.__typeCodes.add(entry.getTypeCode())
@@ -1180,7 +1255,7 @@ class FolderWidget(widgets.DocumentView):
 			with Connector().peek(srcStore, srcRev) as r:
 				w.set_data('', r.get_data(''))
 				for att in info.attachments():
-					w.write(att, r.readAll(att))
+					w.writeFrom(att, connector.PartReader(r, att))
 				w.setFlags(r.stat().flags())
 			w.commit("Created from template")
 			destDoc = w.getDoc()
@@ -87,10 +87,9 @@ class TextEdit(widgets.DocumentView):
 			elif rev2File == baseFile:
 				newFile = rev1File
 			else:
-				newFile = diff3.text_merge(baseFile, rev1File, rev2File)
-				# the diff3 module is broken, basically there's never a clean
-				# merge
-				conflicts = True
+				(newFile, newConflicts) = diff3.text_merge3(baseFile, rev1File,
+					rev2File)
+				conflicts = conflicts or newConflicts
 			writer.writeAll('FILE', newFile)
 
 		return conflicts